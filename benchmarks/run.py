@@ -0,0 +1,276 @@
+"""
+Offline benchmarks for the message, event and persistence hot paths.
+
+    python -m benchmarks.run                 # run and compare against benchmarks/baselines.json
+    python -m benchmarks.run --save          # run and record the results as the new baselines
+    python -m benchmarks.run --only settings # run the benchmarks whose name contains "settings"
+
+A benchmark regresses when its throughput falls more than --tolerance below its
+baseline; the run then exits with status 1.
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+# The client reads its credentials at construction; nothing here talks to cTrader
+for _name in ("CTRADER_CLIENT_ID", "CTRADER_CLIENT_SECRET", "TELEGRAM_BOT_TOKEN"):
+    os.environ.setdefault(_name, "benchmark")
+
+from twisted.internet.task import Clock
+
+from pepper_bot.backtest.broker import SimulatedBroker
+from pepper_bot.core import config, database
+from pepper_bot.ctrader.client import CTraderApiClient, EXECUTION_EVENT, SPOT_EVENT
+from pepper_bot.ctrader.fake_server import FakeOpenApiServer, listen
+from pepper_bot.ctrader.symbols import SymbolInfo
+from pepper_bot.trading.position_manager import PositionManager
+from pepper_bot.trading.submission import StraddleSubmitter
+from pepper_bot.trading.trailing import TrailingStopEngine
+from ctrader_open_api.messages.OpenApiCommonMessages_pb2 import ProtoMessage
+from ctrader_open_api.messages.OpenApiMessages_pb2 import ProtoOASpotEvent, ProtoOASubscribeSpotsRes
+from ctrader_open_api.messages.OpenApiModelMessages_pb2 import ProtoOAOrderType, ProtoOATradeSide
+
+BASELINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+DEFAULT_TOLERANCE = 0.25
+REPEATS = 5
+
+EURUSD = SymbolInfo(1, "EURUSD", 5, 4, 10_000_000, 100_000, 100_000_000, 100_000)
+
+
+def measure(operation: Callable[[], Any], count: int, repeats: int = REPEATS) -> Dict[str, float]:
+    """Runs operation count times per repeat and reports the best repeat."""
+    best = float("inf")
+    gc.collect()
+    for _ in range(repeats):
+        start = time.perf_counter_ns()
+        for _ in range(count):
+            operation()
+        best = min(best, time.perf_counter_ns() - start)
+    return {"ns_per_op": best / count, "ops_per_sec": count * 1e9 / best}
+
+
+def _client() -> CTraderApiClient:
+    return CTraderApiClient("127.0.0.1", 1, use_tls=False)
+
+
+def _frame(message, client_msg_id: str = None) -> ProtoMessage:
+    frame = ProtoMessage(payloadType=message.payloadType, payload=message.SerializeToString())
+    if client_msg_id:
+        frame.clientMsgId = client_msg_id
+    return frame
+
+
+def bench_on_websocket_message() -> Dict[str, Dict[str, float]]:
+    client = _client()
+    client.register_handler(SPOT_EVENT, client.ticks.on_spot_event)
+    client.register_handler(EXECUTION_EVENT, lambda event: None)
+
+    broker = SimulatedBroker()
+    broker.feed(1, 1, 1.085, 1.0851)
+    results = []
+    broker.place_order(1, 1, ProtoOAOrderType.MARKET, ProtoOATradeSide.BUY, 100_000).addCallback(results.append)
+
+    spot = _frame(ProtoOASpotEvent(ctidTraderAccountId=1, symbolId=1, bid=108500, ask=108510, timestamp=1))
+    execution = _frame(results[0])
+    # Nobody handles subscription responses here, so they are dropped undecoded
+    unhandled = _frame(ProtoOASubscribeSpotsRes(ctidTraderAccountId=1))
+
+    on_message = client._on_websocket_message
+    return {
+        "spot_event": measure(lambda: on_message(None, spot), 20_000),
+        "execution_event": measure(lambda: on_message(None, execution), 10_000),
+        "unhandled": measure(lambda: on_message(None, unhandled), 50_000),
+    }
+
+
+def bench_handle_execution_event() -> Dict[str, Dict[str, float]]:
+    results = {}
+    for open_straddles in (1, 100, 10_000):
+        clock = Clock()
+        broker = SimulatedBroker(clock)
+        broker.feed(1, 1, 1.085, 1.0851)
+        manager = PositionManager(broker, 1, 2, trailing_engine=TrailingStopEngine(broker, clock=clock))
+
+        events = []
+        for _ in range(open_straddles):
+            legs = []
+            broker.place_order(1, 1, ProtoOAOrderType.MARKET, ProtoOATradeSide.BUY, 100_000).addCallback(legs.append)
+            broker.place_order(2, 1, ProtoOAOrderType.MARKET, ProtoOATradeSide.SELL, 100_000).addCallback(legs.append)
+            manager.add_straddle("EURUSD", legs[0], legs[1], 1)
+            events.append(legs[0])
+        unknown = []
+        broker.place_order(1, 1, ProtoOAOrderType.MARKET, ProtoOATradeSide.BUY, 100_000).addCallback(unknown.append)
+
+        fill = events[len(events) // 2]
+        handle = manager.handle_execution_event
+        results[f"fill_{open_straddles}_straddles"] = measure(lambda: handle(fill), 20_000)
+        results[f"unknown_{open_straddles}_straddles"] = measure(lambda: handle(unknown[0]), 20_000)
+    return results
+
+
+def bench_settings() -> Dict[str, Dict[str, float]]:
+    try:
+        config.get_all_settings()
+        return {
+            "get_all_settings": measure(config.get_all_settings, 100_000),
+            "get_settings": measure(config.get_settings, 100_000),
+        }
+    finally:
+        config.stop_watching()
+
+
+def bench_log_trade() -> Dict[str, Dict[str, float]]:
+    trade = {
+        "symbol": "EURUSD", "side": "BUY", "entry_price": 1.085, "exit_price": 1.086,
+        "pnl": 10.0, "duration_seconds": 60,
+    }
+    count = 10_000
+    original_db_file = database.DB_FILE
+    with tempfile.TemporaryDirectory() as directory:
+        database.DB_FILE = os.path.join(directory, "trades.db")
+        try:
+            database.initialize_db()
+
+            def insert_batch():
+                for _ in range(count):
+                    database.log_trade(trade)
+                database.flush_trades()
+
+            # One operation is a whole batch committed to disk
+            result = measure(insert_batch, 1, repeats=3)
+            enqueue = measure(lambda: database.log_trade(trade), count, repeats=1)
+            database.flush_trades()
+        finally:
+            database.close_db()
+            database.DB_FILE = original_db_file
+    return {
+        "committed": {"ns_per_op": result["ns_per_op"] / count, "ops_per_sec": result["ops_per_sec"] * count},
+        "enqueue": enqueue,
+    }
+
+
+def bench_straddle_round_trip() -> Dict[str, Dict[str, float]]:
+    """Submits straddles one after another against the local stand-in server over loopback TCP."""
+    from twisted.internet import defer, reactor
+
+    count = 500
+    server = FakeOpenApiServer(accounts=(1, 2))
+    port = listen(server, 0)
+    client = CTraderApiClient("127.0.0.1", port.getHost().port, use_tls=False)
+    client.access_token = "benchmark"
+    submitter = StraddleSubmitter(client, client, settings=config.get_settings)
+    outcome: Dict[str, Any] = {}
+
+    @defer.inlineCallbacks
+    def run(_):
+        try:
+            yield defer.gatherResults([client.authorize_trading_account(1), client.authorize_trading_account(2)])
+            submitter.prepare(EURUSD, 1, 2)
+            samples: List[int] = []
+            for _ in range(count):
+                start = time.perf_counter_ns()
+                yield submitter.submit(EURUSD, 1, 2)
+                samples.append(time.perf_counter_ns() - start)
+            samples.sort()
+            outcome["result"] = {
+                "ns_per_op": sum(samples) / count,
+                "ops_per_sec": count * 1e9 / sum(samples),
+                "p50_ms": samples[count // 2] / 1e6,
+                "p99_ms": samples[int(count * 0.99)] / 1e6,
+            }
+        except Exception as e:
+            outcome["error"] = e
+        finally:
+            client.websocket_client.stopService()
+            port.stopListening()
+            reactor.stop()
+
+    def start():
+        client.add_session_callback(lambda: run(None))
+        client.connect()
+
+    reactor.callWhenRunning(start)
+    reactor.run(installSignalHandlers=False)
+    config.stop_watching()
+    if "error" in outcome:
+        raise outcome["error"]
+    return {"submit_to_ack": outcome["result"]}
+
+
+# The round trip runs the reactor, which can only be started once, so it goes last
+BENCHMARKS: Dict[str, Callable[[], Dict[str, Dict[str, float]]]] = {
+    "on_websocket_message": bench_on_websocket_message,
+    "handle_execution_event": bench_handle_execution_event,
+    "settings": bench_settings,
+    "log_trade": bench_log_trade,
+    "straddle_round_trip": bench_straddle_round_trip,
+}
+
+
+def compare(results: Dict[str, Dict[str, float]], baselines: Dict[str, Dict[str, float]],
+            tolerance: float) -> List[str]:
+    """Returns the benchmarks whose throughput fell more than tolerance below their baseline."""
+    regressions = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            continue
+        ratio = result["ops_per_sec"] / baseline["ops_per_sec"]
+        print(f"{name:55s} {result['ops_per_sec']:>14,.0f} ops/s  {ratio:6.2f}x baseline")
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the bot's hot paths.")
+    parser.add_argument("--save", action="store_true", help=f"Record the results in {BASELINES_FILE}")
+    parser.add_argument("--only", help="Only run benchmarks whose name contains this")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed throughput drop before a result counts as a regression")
+    args = parser.parse_args()
+
+    # Hot paths log at INFO; measure them as they run with the default WARNING level
+    logging.basicConfig(level=logging.WARNING)
+
+    results: Dict[str, Dict[str, float]] = {}
+    for group, benchmark in BENCHMARKS.items():
+        if args.only and args.only not in group:
+            continue
+        for name, result in benchmark().items():
+            key = f"{group}.{name}"
+            results[key] = result
+            print(f"{key:55s} {result['ns_per_op']:>14,.0f} ns/op {result['ops_per_sec']:>14,.0f} ops/s")
+
+    baselines = {}
+    if os.path.exists(BASELINES_FILE):
+        with open(BASELINES_FILE, "r") as f:
+            baselines = json.load(f).get("results", {})
+
+    if args.save:
+        baselines.update(results)
+        with open(BASELINES_FILE, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "results": dict(sorted(baselines.items())),
+            }, f, indent=4)
+            f.write("\n")
+        print(f"Saved {len(results)} results to {BASELINES_FILE}")
+        return
+
+    regressions = compare(results, baselines, args.tolerance)
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,13 @@
 import asyncio
 import threading
+
+from pepper_bot.core.runtime import get_runtime_mode, install_asyncio_reactor, SINGLE_LOOP
+
+# The asyncio reactor has to be installed before anything imports the default reactor
+RUNTIME_MODE = get_runtime_mode()
+if RUNTIME_MODE == SINGLE_LOOP:
+    install_asyncio_reactor()
+
 from twisted.internet import reactor
 
 import sys
@@ -8,9 +16,10 @@ import json
 import signal
 import logging
 
-from pepper_bot.core.database import initialize_db
+from pepper_bot.core.database import initialize_db, close_db
 from pepper_bot.core.env import load_credentials
 from pepper_bot.core.logger import setup_logging
+from pepper_bot.core.metrics import get_metrics_port, start_http_server
 from pepper_bot.ctrader.manager import CTraderManager
 from pepper_bot.telegram.bot import run_bot
 from pepper_bot.trading.position_manager import PositionManager
@@ -28,10 +37,13 @@ async def main():
     setup_logging()
     logging.info("Application starting...")
 
-    # Start Twisted in a background thread
-    twisted_thread = threading.Thread(target=run_twisted, daemon=True)
-    twisted_thread.start()
-    logging.info("Twisted reactor thread started.")
+    if RUNTIME_MODE == SINGLE_LOOP:
+        logging.info("Twisted reactor is running on the asyncio event loop.")
+    else:
+        # Start Twisted in a background thread
+        twisted_thread = threading.Thread(target=run_twisted, daemon=True)
+        twisted_thread.start()
+        logging.info("Twisted reactor thread started.")
 
     loop = asyncio.get_running_loop()
     initialize_db()
@@ -44,18 +56,25 @@ async def main():
         logging.error(f"Error loading credentials: {e}")
         return
 
+    metrics_port = get_metrics_port()
+    metrics_server = start_http_server(metrics_port) if metrics_port is not None else None
+
     ctrader_manager = CTraderManager()
     logging.info("Starting CTraderManager...")
     await ctrader_manager.start()
     logging.info("cTrader clients are ready.")
 
+    # Pick up the straddles left open by a previous run before taking any commands
+    await ctrader_manager.warm_start()
+    logging.info("Open positions reconciled.")
+
     logging.info("Starting Telegram bot...")
     await run_bot(credentials["telegram_token"].strip(), ctrader_manager)
     logging.info("Telegram bot started.")
 
     # Keep the application alive until it is manually stopped
     stop_event = asyncio.Event()
-    
+
     # Signal handlers are not supported on Windows, so we use a try-except
     try:
         loop.add_signal_handler(signal.SIGINT, stop_event.set)
@@ -63,17 +82,35 @@ async def main():
     except NotImplementedError:
         # Signal handlers not supported on Windows - just log and continue
         logging.info("Signal handlers not supported on this platform.")
-    
+
     logging.info("Application running. Press Ctrl+C to exit.")
     await stop_event.wait()
 
     # Gracefully shut down
     logging.info("Shutting down...")
-    reactor.callFromThread(reactor.stop)
+    ctrader_manager.stop()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    close_db()
+    if RUNTIME_MODE != SINGLE_LOOP:
+        reactor.callFromThread(reactor.stop)
+
+
+def run_single_loop():
+    """Runs main() as a task on the loop driven by the asyncio reactor, stopping the reactor when it returns."""
+    def start():
+        task = asyncio.get_event_loop().create_task(main())
+        task.add_done_callback(lambda _: reactor.stop())
+
+    reactor.callWhenRunning(start)
+    reactor.run(installSignalHandlers=False)
 
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if RUNTIME_MODE == SINGLE_LOOP:
+            run_single_loop()
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logging.info("KeyboardInterrupt caught, shutting down.")
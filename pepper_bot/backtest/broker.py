@@ -0,0 +1,177 @@
+import itertools
+from typing import Callable, Dict, List
+
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import Clock
+
+from pepper_bot.ctrader.client import CTraderApiError, EXECUTION_EVENT
+from pepper_bot.ctrader.ticks import PRICE_SCALE, TickStream
+from ctrader_open_api.messages.OpenApiMessages_pb2 import (
+    ProtoOAAmendPositionSLTPReq, ProtoOAExecutionEvent, ProtoOANewOrderReq,
+)
+from ctrader_open_api.messages.OpenApiModelMessages_pb2 import (
+    ProtoOAExecutionType, ProtoOAOrderStatus, ProtoOAOrderType, ProtoOAPayloadType, ProtoOAPositionStatus,
+    ProtoOATradeSide,
+)
+
+
+class SimulatedPosition:
+    __slots__ = ("position_id", "order_id", "account_id", "symbol_id", "is_buy", "volume", "entry_price",
+                 "stop_loss", "open_timestamp", "exit_price", "close_timestamp")
+
+    def __init__(self, position_id: int, order_id: int, account_id: int, symbol_id: int, is_buy: bool,
+                 volume: int, entry_price: float, stop_loss: float, open_timestamp: int):
+        self.position_id = position_id
+        self.order_id = order_id
+        self.account_id = account_id
+        self.symbol_id = symbol_id
+        self.is_buy = is_buy
+        self.volume = volume
+        self.entry_price = entry_price
+        self.stop_loss = stop_loss
+        self.open_timestamp = open_timestamp
+        self.exit_price = 0.0
+        self.close_timestamp = 0
+
+    @property
+    def pnl(self) -> float:
+        """Profit in quote currency; volumes are in cents of the base asset."""
+        direction = 1 if self.is_buy else -1
+        return (self.exit_price - self.entry_price) * direction * self.volume / 100
+
+
+class SimulatedBroker:
+    """
+    Stands in for CTraderApiClient during replays: fills market orders at the current
+    quote, keeps stop losses, and stops positions out as recorded ticks are fed in.
+    Everything happens synchronously on a virtual clock driven by tick timestamps.
+    """
+
+    def __init__(self, clock: Clock = None):
+        self.clock = clock or Clock()
+        self.ticks = TickStream()
+        self._handlers: Dict[int, List[Callable]] = {}
+        self._ids = itertools.count(1)
+
+        self.positions: Dict[int, SimulatedPosition] = {}
+        self._by_symbol: Dict[int, Dict[int, SimulatedPosition]] = {}
+        self.closed: List[SimulatedPosition] = []
+        self.amends = 0
+
+    # Handler registration, as on CTraderApiClient
+
+    def register_handler(self, payload_type: int, handler: Callable) -> None:
+        self._handlers.setdefault(payload_type, []).append(handler)
+
+    def unregister_handler(self, payload_type: int, handler: Callable) -> None:
+        handlers = self._handlers.get(payload_type)
+        if handlers and handler in handlers:
+            handlers.remove(handler)
+
+    def subscribe_to_execution_events(self, callback: Callable):
+        self.register_handler(EXECUTION_EVENT, callback)
+
+    def subscribe_to_ticks(self, ctid_trader_account_id: int, symbol_id: int) -> Deferred:
+        return succeed(None)
+
+    def _emit(self, event) -> None:
+        for handler in self._handlers.get(EXECUTION_EVENT, ()):
+            handler(event)
+
+    # Market data
+
+    def feed(self, symbol_id: int, timestamp: int, bid: float, ask: float) -> None:
+        """Feeds one recorded tick: advances the clock, triggers stops, then publishes the quote."""
+        delta = timestamp / 1000 - self.clock.seconds()
+        if delta > 0:
+            self.clock.advance(delta)
+
+        # Stops trigger against the level in force when the tick arrives
+        positions = self._by_symbol.get(symbol_id)
+        if positions:
+            for position in list(positions.values()):
+                if position.stop_loss and (
+                        (position.is_buy and bid <= position.stop_loss)
+                        or (not position.is_buy and ask >= position.stop_loss)):
+                    self._close(position, bid if position.is_buy else ask, timestamp)
+
+        self.ticks.push(self.ticks.ring(symbol_id), bid, ask, timestamp)
+
+    # Trading requests
+
+    def place_order(self, ctid_trader_account_id: int, symbol_id: int, order_type: int, trade_side: int,
+                    volume: int, stop_loss: float = None, take_profit: float = None,
+                    relative_stop_loss: int = None, relative_take_profit: int = None) -> Deferred:
+        if order_type != ProtoOAOrderType.MARKET:
+            return fail(CTraderApiError("NOT_SUPPORTED", "Only market orders are simulated"))
+        ring = self.ticks.latest(symbol_id)
+        if ring is None:
+            return fail(CTraderApiError("MARKET_CLOSED", f"No quote for symbol {symbol_id}"))
+
+        is_buy = trade_side == ProtoOATradeSide.BUY
+        entry = ring.ask if is_buy else ring.bid
+        if relative_stop_loss:
+            distance = relative_stop_loss / PRICE_SCALE
+            stop_loss = entry - distance if is_buy else entry + distance
+
+        position = SimulatedPosition(next(self._ids), next(self._ids), ctid_trader_account_id, symbol_id, is_buy,
+                                     volume, entry, stop_loss or 0.0, ring.timestamp)
+        self.positions[position.position_id] = position
+        self._by_symbol.setdefault(symbol_id, {})[position.position_id] = position
+
+        event = self._event(position, ProtoOAExecutionType.ORDER_FILLED, ProtoOAPositionStatus.POSITION_STATUS_OPEN)
+        self._emit(event)
+        return succeed(event)
+
+    def send_payload(self, payload_type: int, payload: bytes, account_id: int = 0, timeout: float = None,
+                     position_id: int = 0, order_id: int = 0) -> Deferred:
+        if payload_type == ProtoOAPayloadType.PROTO_OA_NEW_ORDER_REQ:
+            request = ProtoOANewOrderReq.FromString(payload)
+            return self.place_order(request.ctidTraderAccountId, request.symbolId, request.orderType,
+                                    request.tradeSide, request.volume, relative_stop_loss=request.relativeStopLoss)
+        if payload_type == ProtoOAPayloadType.PROTO_OA_AMEND_POSITION_SLTP_REQ:
+            request = ProtoOAAmendPositionSLTPReq.FromString(payload)
+            return self.modify_position(request.ctidTraderAccountId, request.positionId, stop_loss=request.stopLoss)
+        return fail(CTraderApiError("NOT_SUPPORTED", f"Payload type {payload_type} is not simulated"))
+
+    def modify_position(self, ctid_trader_account_id: int, position_id: int, stop_loss: float = None,
+                        take_profit: float = None, trailing_stop: bool = False) -> Deferred:
+        position = self.positions.get(position_id)
+        if position is None:
+            return fail(CTraderApiError("POSITION_NOT_FOUND", f"Position {position_id} is not open"))
+        if stop_loss:
+            position.stop_loss = stop_loss
+        self.amends += 1
+        return succeed(self._event(position, ProtoOAExecutionType.ORDER_REPLACED,
+                                   ProtoOAPositionStatus.POSITION_STATUS_OPEN))
+
+    def _close(self, position: SimulatedPosition, price: float, timestamp: int) -> None:
+        del self.positions[position.position_id]
+        del self._by_symbol[position.symbol_id][position.position_id]
+        position.exit_price = price
+        position.close_timestamp = timestamp
+        self.closed.append(position)
+        self._emit(self._event(position, ProtoOAExecutionType.ORDER_FILLED,
+                               ProtoOAPositionStatus.POSITION_STATUS_CLOSED))
+
+    def _event(self, position: SimulatedPosition, execution_type: int, position_status: int) -> ProtoOAExecutionEvent:
+        event = ProtoOAExecutionEvent(ctidTraderAccountId=position.account_id, executionType=execution_type)
+        trade_data = event.position.tradeData
+        trade_data.symbolId = position.symbol_id
+        trade_data.volume = position.volume
+        trade_data.tradeSide = ProtoOATradeSide.BUY if position.is_buy else ProtoOATradeSide.SELL
+        trade_data.openTimestamp = position.open_timestamp
+        event.position.positionId = position.position_id
+        event.position.positionStatus = position_status
+        event.position.swap = 0
+        event.position.price = position.entry_price
+        if position.stop_loss:
+            event.position.stopLoss = position.stop_loss
+
+        event.order.orderId = position.order_id
+        event.order.tradeData.CopyFrom(trade_data)
+        event.order.orderType = ProtoOAOrderType.MARKET
+        event.order.orderStatus = ProtoOAOrderStatus.ORDER_STATUS_FILLED
+        event.order.positionId = position.position_id
+        event.order.executionPrice = position.exit_price or position.entry_price
+        return event
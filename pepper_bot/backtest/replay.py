@@ -0,0 +1,160 @@
+import bisect
+import dataclasses
+import itertools
+import logging
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from twisted.internet.task import Clock
+
+from pepper_bot.backtest.broker import SimulatedBroker, SimulatedPosition
+from pepper_bot.core.config import Settings, get_settings
+from pepper_bot.ctrader.recorder import TICKS_DIR, iter_ticks, list_tick_files
+from pepper_bot.ctrader.symbols import SymbolCatalogue, SymbolInfo
+from pepper_bot.trading.position_manager import PositionManager
+from pepper_bot.trading.submission import StraddleSubmitter
+from pepper_bot.trading.trailing import TrailingStopEngine
+
+# Accounts the simulated straddle legs are booked on
+BUY_ACCOUNT_ID = 1
+SELL_ACCOUNT_ID = 2
+
+
+def load_recorded_ticks(symbol: str, start_day: str = None, end_day: str = None,
+                        directory: str = TICKS_DIR) -> Iterator[Tuple[int, float, float]]:
+    """Yields the recorded (timestamp, bid, ask) ticks of a symbol between two 'YYYY-MM-DD' days, in order."""
+    return itertools.chain.from_iterable(iter_ticks(path) for path in list_tick_files(directory, symbol,
+                                                                                      start_day, end_day))
+
+
+@dataclasses.dataclass
+class ReplayResult:
+    """Outcome of one replay: the closed positions, what is still open, and the activity behind it."""
+    symbol: str
+    stop_loss: int
+    trailing_stop: int
+    ticks: int = 0
+    straddles: int = 0
+    amends: int = 0
+    trades: List[SimulatedPosition] = dataclasses.field(default_factory=list)
+    open_pnl: float = 0.0
+
+    @property
+    def pnl(self) -> float:
+        return sum(trade.pnl for trade in self.trades)
+
+    @property
+    def win_rate(self) -> Optional[float]:
+        if not self.trades:
+            return None
+        return sum(trade.pnl > 0 for trade in self.trades) / len(self.trades)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "symbol": self.symbol,
+            "stop_loss": self.stop_loss,
+            "trailing_stop": self.trailing_stop,
+            "ticks": self.ticks,
+            "straddles": self.straddles,
+            "trades": len(self.trades),
+            "amends": self.amends,
+            "pnl": self.pnl,
+            "open_pnl": self.open_pnl,
+            "win_rate": self.win_rate,
+        }
+
+
+class ReplayEngine:
+    """
+    Replays recorded ticks through the live PositionManager, TrailingStopEngine and
+    StraddleSubmitter against a SimulatedBroker, on a virtual clock driven by the tick
+    timestamps. A replay is deterministic and runs as fast as the ticks can be read.
+
+    Straddles are opened at the first tick at or after each of entry_times (ms since the
+    epoch), or, without entry_times, whenever no straddle is active.
+    """
+
+    def __init__(self, symbol: SymbolInfo, settings: Settings = None, stop_loss: int = None,
+                 trailing_stop: int = None, trailing_step: int = None, volume: float = None,
+                 entry_times: Sequence[int] = None, min_interval: float = 0.25):
+        self.symbol = symbol
+        self.settings = _override(settings or get_settings(), symbol.name, stop_loss=stop_loss,
+                                  trailing_stop=trailing_stop, trailing_step=trailing_step, volume=volume)
+        self.entry_times = sorted(entry_times) if entry_times is not None else None
+
+        self.clock = Clock()
+        self.broker = SimulatedBroker(self.clock)
+        settings_provider = lambda: self.settings
+        # Trailing distances and stop prices use the replayed symbol's point size and digits
+        self.symbols = SymbolCatalogue(cache_file=None)
+        self.symbols.add(symbol)
+        self.trailing_engine = TrailingStopEngine(self.broker, min_interval=min_interval, clock=self.clock)
+        self.position_manager = PositionManager(self.broker, BUY_ACCOUNT_ID, SELL_ACCOUNT_ID,
+                                                trailing_engine=self.trailing_engine, symbols=self.symbols,
+                                                settings=settings_provider)
+        self.submitter = StraddleSubmitter(self.broker, self.broker, settings=settings_provider)
+        self.position_manager.start_monitoring()
+        self.result = ReplayResult(symbol.name, self.settings.stop_loss[symbol.name],
+                                   self.settings.trailing_stop[symbol.name])
+
+    def run(self, ticks: Iterable[Tuple[int, float, float]]) -> ReplayResult:
+        """Feeds (timestamp, bid, ask) ticks through the simulation and returns the result."""
+        symbol_id = self.symbol.symbol_id
+        feed = self.broker.feed
+        result = self.result
+        next_entry = 0
+        for timestamp, bid, ask in ticks:
+            feed(symbol_id, timestamp, bid, ask)
+            result.ticks += 1
+
+            if self.entry_times is None:
+                if not self.position_manager.active_straddles:
+                    self._open()
+            elif next_entry < len(self.entry_times) and timestamp >= self.entry_times[next_entry]:
+                # Several entry times between two ticks collapse into one straddle
+                next_entry = bisect.bisect_right(self.entry_times, timestamp, next_entry)
+                self._open()
+
+        result.amends = self.broker.amends
+        result.trades = list(self.broker.closed)
+        ring = self.broker.ticks.latest(symbol_id)
+        if ring is not None:
+            for position in self.broker.positions.values():
+                exit_price = ring.bid if position.is_buy else ring.ask
+                direction = 1 if position.is_buy else -1
+                result.open_pnl += (exit_price - position.entry_price) * direction * position.volume / 100
+        return result
+
+    def _open(self) -> None:
+        d = self.submitter.submit(self.symbol, BUY_ACCOUNT_ID, SELL_ACCOUNT_ID)
+        d.addCallbacks(self._on_submitted, self._on_submit_failed)
+
+    def _on_submitted(self, events: Tuple[Any, Any]) -> None:
+        buy_event, sell_event = events
+        self.position_manager.add_straddle(self.symbol.name, buy_event, sell_event, self.symbol.symbol_id)
+        self.result.straddles += 1
+
+    def _on_submit_failed(self, failure) -> None:
+        logging.warning(f"Replay could not open a straddle on {self.symbol.name}: {failure.getErrorMessage()}")
+
+
+def _override(settings: Settings, symbol: str, **values: Any) -> Settings:
+    """Returns a copy of settings with the given per-symbol values replaced."""
+    changes = {}
+    for name, value in values.items():
+        if value is not None:
+            changes[name] = {**getattr(settings, name), symbol: value}
+    return dataclasses.replace(settings, **changes) if changes else settings
+
+
+def sweep(symbol: SymbolInfo, ticks: Sequence[Tuple[int, float, float]], stop_losses: Iterable[int],
+          trailing_stops: Iterable[int], settings: Settings = None, **options: Any) -> List[ReplayResult]:
+    """
+    Replays the same ticks once per (stop loss, trailing stop) combination, in points.
+    ticks must be re-iterable, e.g. a list or a NumPy array from read_ticks.
+    """
+    settings = settings or get_settings()
+    results = []
+    for stop_loss, trailing_stop in itertools.product(stop_losses, trailing_stops):
+        engine = ReplayEngine(symbol, settings, stop_loss=stop_loss, trailing_stop=trailing_stop, **options)
+        results.append(engine.run(ticks))
+    return results
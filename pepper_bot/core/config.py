@@ -1,34 +1,169 @@
 import json
-from typing import Any, Dict
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
 import threading
+import tempfile
 import os
 
 # Build the absolute path to the settings file
 _SETTINGS_DIR = os.path.abspath(os.path.dirname(__file__))
 SETTINGS_FILE = os.path.join(_SETTINGS_DIR, "settings.json")
 
+# How often the background watcher checks the settings file for external edits
+WATCH_INTERVAL_SECONDS = 1.0
+
+# Serializes writers and reloads; readers never take it
 _lock = threading.Lock()
 
-def get_all_settings() -> Dict[str, Any]:
-    """Loads all settings from the JSON file."""
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    An immutable snapshot of settings.json.
+    Snapshots are shared between threads, so the mappings must be treated as read-only.
+    """
+    pairs: Dict[str, bool] = field(default_factory=dict)
+    stop_loss: Dict[str, int] = field(default_factory=dict)
+    trailing_stop: Dict[str, int] = field(default_factory=dict)
+    trailing_step: Dict[str, int] = field(default_factory=dict)
+    volume: Dict[str, float] = field(default_factory=dict)
+    record_ticks: bool = False
+    raw: Dict[str, Any] = field(default_factory=dict)
+    mtime_ns: int = 0
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], mtime_ns: int = 0) -> "Settings":
+        return cls(
+            pairs=data.get("pairs", {}),
+            stop_loss=data.get("stop_loss", {}),
+            trailing_stop=data.get("trailing_stop", {}),
+            trailing_step=data.get("trailing_step", {}),
+            volume=data.get("volume", {}),
+            record_ticks=bool(data.get("record_ticks", False)),
+            raw=data,
+            mtime_ns=mtime_ns,
+        )
+
+
+_snapshot: Optional[Settings] = None
+_watcher: Optional[threading.Thread] = None
+_watcher_stop = threading.Event()
+
+
+def _file_mtime_ns() -> int:
+    try:
+        return os.stat(SETTINGS_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def _read_file() -> Settings:
+    """Reads and parses the settings file. Must be called with _lock held."""
+    mtime_ns = _file_mtime_ns()
+    try:
+        with open(SETTINGS_FILE, "r") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        data = {}
+    if not isinstance(data, dict):
+        raise ValueError(f"{SETTINGS_FILE} must hold a JSON object, not {type(data).__name__}")
+    return Settings.from_dict(data, mtime_ns)
+
+
+def _watch():
+    """Reloads the snapshot whenever the settings file is changed outside of set_setting."""
+    global _snapshot
+    rejected_mtime_ns = None
+    while not _watcher_stop.wait(WATCH_INTERVAL_SECONDS):
+        snapshot = _snapshot
+        mtime_ns = _file_mtime_ns()
+        if (snapshot is not None and mtime_ns == snapshot.mtime_ns) or mtime_ns == rejected_mtime_ns:
+            continue
+        with _lock:
+            try:
+                _snapshot = _read_file()
+            except (OSError, ValueError):
+                # Half-written or invalid file: keep serving the last good snapshot
+                continue
+            except Exception as e:
+                # Anything else must not end the watcher; the file is retried once it changes
+                rejected_mtime_ns = mtime_ns
+                logging.error(f"Could not reload {SETTINGS_FILE}, keeping the previous settings: {e}")
+
+
+def _ensure_watcher():
+    global _watcher
+    if _watcher is None or not _watcher.is_alive():
+        _watcher_stop.clear()
+        _watcher = threading.Thread(target=_watch, name="settings-watcher", daemon=True)
+        _watcher.start()
+
+
+def stop_watching():
+    """Stops the background settings watcher thread."""
+    global _watcher
+    _watcher_stop.set()
+    if _watcher is not None:
+        _watcher.join()
+        _watcher = None
+
+
+def get_settings() -> Settings:
+    """
+    Returns the current settings snapshot.
+    The file is only read on first use; afterwards this is a plain memory read.
+    """
+    global _snapshot
+    snapshot = _snapshot
+    if snapshot is not None:
+        return snapshot
     with _lock:
-        try:
-            with open(SETTINGS_FILE, "r") as f:
-                return json.load(f)
-        except FileNotFoundError:
-            return {}
+        if _snapshot is None:
+            _snapshot = _read_file()
+            _ensure_watcher()
+        return _snapshot
+
+
+def reload_settings() -> Settings:
+    """Forces the settings to be re-read from disk."""
+    global _snapshot
+    with _lock:
+        _snapshot = _read_file()
+        _ensure_watcher()
+        return _snapshot
+
+
+def get_all_settings() -> Dict[str, Any]:
+    """Returns all settings from the in-memory snapshot. The result must not be mutated."""
+    return get_settings().raw
 
 
 def get_setting(key: str) -> Any:
-    """Loads a specific setting from the JSON file."""
-    settings = get_all_settings()
-    return settings.get(key)
+    """Returns a specific setting from the in-memory snapshot."""
+    return get_settings().raw.get(key)
 
 
 def set_setting(key: str, value: Any) -> None:
-    """Saves a specific setting to the JSON file."""
+    """Saves a specific setting to the JSON file and publishes a new snapshot."""
+    global _snapshot
+    current = get_settings()
     with _lock:
-        settings = get_all_settings()
+        settings = dict(_snapshot.raw if _snapshot is not None else current.raw)
         settings[key] = value
-        with open(SETTINGS_FILE, "w") as f:
-            json.dump(settings, f, indent=2)
+
+        # Write to a temporary file and rename it over the original, so readers
+        # (and the watcher) never see a partially written file
+        fd, tmp_path = tempfile.mkstemp(dir=_SETTINGS_DIR, prefix=".settings.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(settings, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, SETTINGS_FILE)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        _snapshot = Settings.from_dict(settings, _file_mtime_ns())
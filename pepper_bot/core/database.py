@@ -1,5 +1,7 @@
+import logging
+import queue
 import sqlite3
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Callable, Tuple
 import threading
 import os
 
@@ -7,43 +9,313 @@ import os
 _DB_DIR = os.path.abspath(os.path.dirname(__file__))
 DB_FILE = os.path.join(_DB_DIR, "trades.db")
 
+# The writer commits once it has this many rows queued, or after this many seconds
+BATCH_SIZE = 256
+BATCH_INTERVAL_SECONDS = 0.5
+
+# Schema migrations, applied in order; PRAGMA user_version records how many have run
+MIGRATIONS: List[str] = [
+    """
+    CREATE TABLE IF NOT EXISTS trades (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        symbol TEXT NOT NULL,
+        side TEXT NOT NULL,
+        entry_price REAL NOT NULL,
+        exit_price REAL NOT NULL,
+        pnl REAL NOT NULL,
+        duration_seconds INTEGER NOT NULL,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_trades_timestamp ON trades (timestamp);
+    CREATE INDEX IF NOT EXISTS idx_trades_symbol ON trades (symbol, timestamp);
+    """,
+    # Materialized per day and symbol summary, kept current by a trigger on trades
+    """
+    CREATE TABLE IF NOT EXISTS daily_summary (
+        day TEXT NOT NULL,
+        symbol TEXT NOT NULL,
+        trades INTEGER NOT NULL,
+        wins INTEGER NOT NULL,
+        pnl REAL NOT NULL,
+        total_duration_seconds INTEGER NOT NULL,
+        PRIMARY KEY (day, symbol)
+    ) WITHOUT ROWID;
+    CREATE TRIGGER IF NOT EXISTS trg_trades_daily_summary AFTER INSERT ON trades
+    BEGIN
+        INSERT INTO daily_summary (day, symbol, trades, wins, pnl, total_duration_seconds)
+        VALUES (date(NEW.timestamp), NEW.symbol, 1, NEW.pnl > 0, NEW.pnl, NEW.duration_seconds)
+        ON CONFLICT (day, symbol) DO UPDATE SET
+            trades = trades + 1,
+            wins = wins + excluded.wins,
+            pnl = pnl + excluded.pnl,
+            total_duration_seconds = total_duration_seconds + excluded.total_duration_seconds;
+    END;
+    DELETE FROM daily_summary;
+    INSERT INTO daily_summary (day, symbol, trades, wins, pnl, total_duration_seconds)
+    SELECT date(timestamp), symbol, COUNT(*), SUM(pnl > 0), SUM(pnl), SUM(duration_seconds)
+    FROM trades GROUP BY date(timestamp), symbol;
+    """,
+    # The summary is also kept per side, so every report can be read from it
+    """
+    DROP TRIGGER IF EXISTS trg_trades_daily_summary;
+    DROP TABLE IF EXISTS daily_summary;
+    CREATE TABLE daily_summary (
+        day TEXT NOT NULL,
+        symbol TEXT NOT NULL,
+        side TEXT NOT NULL,
+        trades INTEGER NOT NULL,
+        wins INTEGER NOT NULL,
+        pnl REAL NOT NULL,
+        total_duration_seconds INTEGER NOT NULL,
+        PRIMARY KEY (day, symbol, side)
+    ) WITHOUT ROWID;
+    CREATE TRIGGER trg_trades_daily_summary AFTER INSERT ON trades
+    BEGIN
+        INSERT INTO daily_summary (day, symbol, side, trades, wins, pnl, total_duration_seconds)
+        VALUES (date(NEW.timestamp), NEW.symbol, NEW.side, 1, NEW.pnl > 0, NEW.pnl, NEW.duration_seconds)
+        ON CONFLICT (day, symbol, side) DO UPDATE SET
+            trades = trades + 1,
+            wins = wins + excluded.wins,
+            pnl = pnl + excluded.pnl,
+            total_duration_seconds = total_duration_seconds + excluded.total_duration_seconds;
+    END;
+    INSERT INTO daily_summary (day, symbol, side, trades, wins, pnl, total_duration_seconds)
+    SELECT date(timestamp), symbol, side, COUNT(*), SUM(pnl > 0), SUM(pnl), SUM(duration_seconds)
+    FROM trades GROUP BY date(timestamp), symbol, side;
+    """,
+]
+
+# Groupings accepted by get_trade_report, all columns of daily_summary
+REPORT_GROUPS = ("symbol", "day", "side")
+
+# Aggregates of daily_summary rows, shared by the reports
+_SUMMARY_COLUMNS = """
+    SUM(trades) AS trades,
+    SUM(pnl) AS pnl,
+    CAST(SUM(wins) AS REAL) / SUM(trades) AS win_rate,
+    CAST(SUM(total_duration_seconds) AS REAL) / SUM(trades) AS avg_duration_seconds
+"""
+
+_INSERT_TRADE = """
+    INSERT INTO trades (symbol, side, entry_price, exit_price, pnl, duration_seconds)
+    VALUES (:symbol, :side, :entry_price, :exit_price, :pnl, :duration_seconds)
+"""
+
+# Guards the shared read connection and the writer's lifecycle
 _lock = threading.Lock()
+_read_conn: Optional[sqlite3.Connection] = None
+_writer: Optional["_BatchWriter"] = None
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # With WAL, NORMAL only syncs at checkpoints and stays consistent after a crash
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def _migrate(conn: sqlite3.Connection) -> None:
+    """Brings the schema up to date with MIGRATIONS."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+        logging.info(f"Applying database migration {number}.")
+        conn.executescript(f"BEGIN; {script} PRAGMA user_version = {number}; COMMIT;")
+
+
+class _BatchWriter(threading.Thread):
+    """Owns the write connection and commits queued statements in batches."""
+
+    def __init__(self):
+        super().__init__(name="db-writer", daemon=True)
+        self._queue: "queue.Queue[Optional[Callable[[sqlite3.Connection], None]]]" = queue.Queue()
+        self._conn = _connect()
+
+    def submit(self, operation: Callable[[sqlite3.Connection], None]) -> None:
+        self._queue.put_nowait(operation)
+
+    def flush(self) -> None:
+        """Blocks until everything queued so far is committed."""
+        self._queue.join()
+
+    def stop(self) -> None:
+        self._queue.put_nowait(None)
+        self.join()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < BATCH_SIZE:
+                    batch.append(self._queue.get(timeout=BATCH_INTERVAL_SECONDS if len(batch) == 1 else 0))
+            except queue.Empty:
+                pass
+
+            operations = [op for op in batch if op is not None]
+            stopping = len(operations) != len(batch)
+            try:
+                if operations:
+                    self._write(operations)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+        self._conn.close()
+
+    def _write(self, operations: List[Callable[[sqlite3.Connection], None]]) -> None:
+        try:
+            with self._conn:
+                for operation in operations:
+                    operation(self._conn)
+            return
+        except Exception as e:
+            if len(operations) == 1:
+                logging.error(f"Failed to write a queued database operation: {e}")
+                return
+            logging.warning(f"Failed to write {len(operations)} queued database operations ({e}); "
+                            f"writing them one by one.")
+        # The batch was rolled back; only the operations failing on their own are lost
+        for operation in operations:
+            try:
+                with self._conn:
+                    operation(self._conn)
+            except Exception as e:
+                logging.error(f"Failed to write a queued database operation: {e}")
+
 
 def initialize_db():
-    """Initializes the database and creates the trades table if it doesn't exist."""
+    """Initializes the database, applies pending migrations and starts the background writer."""
+    global _read_conn, _writer
+    with _lock:
+        conn = _connect()
+        try:
+            _migrate(conn)
+        finally:
+            conn.close()
+        if _read_conn is None:
+            _read_conn = _connect()
+            _read_conn.row_factory = sqlite3.Row
+        if _writer is None:
+            _writer = _BatchWriter()
+            _writer.start()
+
+
+def close_db():
+    """Commits everything still queued and closes the connections."""
+    global _read_conn, _writer
     with _lock:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS trades (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    symbol TEXT NOT NULL,
-                    side TEXT NOT NULL,
-                    entry_price REAL NOT NULL,
-                    exit_price REAL NOT NULL,
-                    pnl REAL NOT NULL,
-                    duration_seconds INTEGER NOT NULL,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            conn.commit()
+        if _writer is not None:
+            _writer.stop()
+            _writer = None
+        if _read_conn is not None:
+            _read_conn.close()
+            _read_conn = None
+
+
+def flush_trades():
+    """Blocks until all trades logged so far are committed."""
+    writer = _writer
+    if writer is not None:
+        writer.flush()
+
 
 def log_trade(trade_data: Dict[str, Any]):
-    """Logs a completed trade to the database."""
+    """Queues a completed trade to be written to the database. Never blocks on disk I/O."""
+    if _writer is None:
+        initialize_db()
+    row = dict(trade_data)
+    _writer.submit(lambda conn: conn.execute(_INSERT_TRADE, row))
+
+
+def _query(sql: str, params: Any = ()) -> List[Dict[str, Any]]:
+    if _read_conn is None:
+        initialize_db()
     with _lock:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO trades (symbol, side, entry_price, exit_price, pnl, duration_seconds)
-                VALUES (:symbol, :side, :entry_price, :exit_price, :pnl, :duration_seconds)
-            """, trade_data)
-            conn.commit()
+        return [dict(row) for row in _read_conn.execute(sql, params).fetchall()]
+
+
+def get_trades_page(limit: int = 10, before_id: Optional[int] = None,
+                    symbol: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    """
+    Returns one page of trades, newest first, and the cursor for the next page
+    (None on the last page). Pages are keyed on the trade id, which increases with
+    the insertion time, so the cost doesn't grow with the page number.
+    """
+    clauses, params = [], []
+    if before_id is not None:
+        clauses.append("id < ?")
+        params.append(before_id)
+    if symbol is not None:
+        clauses.append("symbol = ?")
+        params.append(symbol)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    rows = _query(f"SELECT * FROM trades {where} ORDER BY id DESC LIMIT ?", (*params, limit + 1))
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1]["id"]
+    return rows, None
+
+
+def get_trade_report(group_by: str, since: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Aggregates trades per symbol, day or side from the materialized daily summary:
+    number of trades, P&L, win rate and average duration. since is an optional
+    'YYYY-MM-DD' lower bound.
+    """
+    if group_by not in REPORT_GROUPS:
+        raise ValueError(f"group_by must be one of {sorted(REPORT_GROUPS)}")
+    where, params = ("WHERE day >= ?", (since,)) if since else ("", ())
+    return _query(f"""
+        SELECT {group_by}, {_SUMMARY_COLUMNS}
+        FROM daily_summary {where}
+        GROUP BY {group_by}
+        ORDER BY {group_by}
+    """, params)
+
+
+def get_trade_summary(since: Optional[str] = None) -> Dict[str, Any]:
+    """Returns the totals over all trades (optionally since a 'YYYY-MM-DD' day)."""
+    where, params = ("WHERE day >= ?", (since,)) if since else ("", ())
+    summary = _query(f"SELECT {_SUMMARY_COLUMNS} FROM daily_summary {where}", params)[0]
+    summary["trades"] = summary["trades"] or 0
+    summary["pnl"] = summary["pnl"] or 0.0
+    return summary
+
+
+def get_daily_summary(since: Optional[str] = None, symbol: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Reads the materialized per day and symbol summary, newest day first."""
+    clauses, params = [], []
+    if since is not None:
+        clauses.append("day >= ?")
+        params.append(since)
+    if symbol is not None:
+        clauses.append("symbol = ?")
+        params.append(symbol)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    return _query(f"""
+        SELECT day, symbol, {_SUMMARY_COLUMNS}
+        FROM daily_summary {where}
+        GROUP BY day, symbol
+        ORDER BY day DESC, symbol
+    """, params)
+
+
+def refresh_daily_summary():
+    """Rebuilds the materialized daily summary from the trades table."""
+    def rebuild(conn: sqlite3.Connection):
+        conn.execute("DELETE FROM daily_summary")
+        conn.execute("""
+            INSERT INTO daily_summary (day, symbol, side, trades, wins, pnl, total_duration_seconds)
+            SELECT date(timestamp), symbol, side, COUNT(*), SUM(pnl > 0), SUM(pnl), SUM(duration_seconds)
+            FROM trades GROUP BY date(timestamp), symbol, side
+        """)
+
+    if _writer is None:
+        initialize_db()
+    _writer.submit(rebuild)
+
 
 def get_all_trades() -> List[Dict[str, Any]]:
-    """Retrieves all trades from the database."""
-    with _lock:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM trades ORDER BY timestamp DESC")
-            return [dict(row) for row in cursor.fetchall()]
+    """Retrieves all trades from the database. Prefer get_trades_page for anything user-facing."""
+    return _query("SELECT * FROM trades ORDER BY timestamp DESC")
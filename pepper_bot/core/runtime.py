@@ -0,0 +1,36 @@
+import asyncio
+import os
+
+# "threaded" runs the Twisted reactor in a background thread next to the asyncio loop;
+# "asyncio" runs Twisted on top of the asyncio loop, so everything shares one thread
+RUNTIME_ENV_VAR = "PEPPER_RUNTIME"
+THREADED = "threaded"
+SINGLE_LOOP = "asyncio"
+
+
+def get_runtime_mode() -> str:
+    """Returns the configured runtime mode."""
+    mode = os.environ.get(RUNTIME_ENV_VAR, THREADED).strip().lower()
+    if mode not in (THREADED, SINGLE_LOOP):
+        raise ValueError(f"{RUNTIME_ENV_VAR} must be '{THREADED}' or '{SINGLE_LOOP}', got '{mode}'")
+    return mode
+
+
+def install_asyncio_reactor() -> asyncio.AbstractEventLoop:
+    """
+    Creates the application's event loop and installs Twisted's asyncio reactor on it.
+    Must be called before anything imports twisted.internet.reactor.
+    """
+    from twisted.internet import asyncioreactor
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    asyncioreactor.install(eventloop=loop)
+    return loop
+
+
+def is_single_loop(loop: asyncio.AbstractEventLoop) -> bool:
+    """True if the installed reactor runs on the given asyncio loop."""
+    from twisted.internet import reactor
+
+    return getattr(reactor, "_asyncioEventloop", None) is loop
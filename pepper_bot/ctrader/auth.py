@@ -1,4 +1,4 @@
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
 import treq
 from twisted.internet.defer import Deferred
@@ -7,10 +7,17 @@ from pepper_bot.core.env import load_credentials
 
 TOKEN_URL = "https://openapi.ctrader.com/apps/token"
 
+_credentials: Optional[Dict[str, Any]] = None
+
+
+class TokenError(Exception):
+    """Raised when the token endpoint answers with an error instead of tokens."""
+
 
 def get_access_token(authorization_code: str, redirect_uri: str) -> Deferred:
     """
     Exchanges an authorization code for an access token and refresh token.
+    Fires with the token endpoint's response (accessToken, refreshToken, expiresIn...).
     """
     credentials = get_credentials()
 
@@ -24,42 +31,39 @@ def get_access_token(authorization_code: str, redirect_uri: str) -> Deferred:
 
     d = treq.get(TOKEN_URL, params=params)
     d.addCallback(treq.json_content)
-
-    def on_token_data(token_data):
-        # In-memory update, no saving to file
-        credentials["accessToken"] = token_data["accessToken"]
-        credentials["refreshToken"] = token_data["refreshToken"]
-        return token_data
-
-    d.addCallback(on_token_data)
+    d.addCallback(_check_token_data)
     return d
 
 
-def refresh_access_token() -> Deferred:
-    """Refreshes an access token using a refresh token."""
-    credentials = get_credentials()
-    if not credentials.get("refreshToken"):
+def refresh_access_token(refresh_token: str) -> Deferred:
+    """Refreshes an access token using a refresh token. Fires with the token endpoint's response."""
+    if not refresh_token:
         raise ValueError("No refresh token found.")
+    credentials = get_credentials()
 
     params = {
         "grant_type": b"refresh_token",
-        "refresh_token": credentials["refreshToken"].encode("utf-8"),
+        "refresh_token": refresh_token.encode("utf-8"),
         "client_id": credentials["clientId"].encode("utf-8"),
         "client_secret": credentials["clientSecret"].encode("utf-8"),
     }
 
     d = treq.post(TOKEN_URL, params=params)
     d.addCallback(treq.json_content)
+    d.addCallback(_check_token_data)
+    return d
 
-    def on_token_data(token_data):
-        credentials["accessToken"] = token_data["accessToken"]
-        credentials["refreshToken"] = token_data["refreshToken"]
-        return token_data
 
-    d.addCallback(on_token_data)
-    return d
+def _check_token_data(token_data: Dict[str, Any]) -> Dict[str, Any]:
+    if token_data.get("errorCode") or not token_data.get("accessToken"):
+        raise TokenError(f"{token_data.get('errorCode') or 'NO_TOKEN'} - "
+                         f"{token_data.get('description') or 'No description'}")
+    return token_data
 
 
 def get_credentials() -> Dict[str, Any]:
-    """Gets the credentials for the application."""
-    return load_credentials()
+    """Gets the credentials for the application, read from the environment on first use."""
+    global _credentials
+    if _credentials is None:
+        _credentials = load_credentials()
+    return _credentials
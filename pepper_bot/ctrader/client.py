@@ -1,123 +1,431 @@
 import logging
-from typing import Dict, Any, List, Callable
+import os
+from collections import deque
+from typing import Dict, Any, FrozenSet, Iterable, List, Callable, Set, Tuple, Union
 
-from twisted.internet.defer import Deferred
+from twisted.application.internet import ClientService
+from twisted.internet.defer import Deferred, gatherResults
+from twisted.internet.endpoints import clientFromString
 from ctrader_open_api import Client as CtraderClient, TcpProtocol, EndPoints, Protobuf
+from ctrader_open_api.factory import Factory
 from ctrader_open_api.messages.OpenApiCommonMessages_pb2 import *
 from ctrader_open_api.messages.OpenApiMessages_pb2 import *
 from ctrader_open_api.messages.OpenApiModelMessages_pb2 import *
+from ctrader_open_api.messages.OpenApiCommonModelMessages_pb2 import ProtoPayloadType
 
+from pepper_bot.core import metrics
 from pepper_bot.ctrader import auth
+from pepper_bot.ctrader.events import EventBus, Subscription
+from pepper_bot.ctrader.pending import RequestRegistry, RequestTimeoutError, payload_type_name
+from pepper_bot.ctrader.supervisor import ConnectionSupervisor, reconnect_policy
+from pepper_bot.ctrader.ticks import TickStream
+from pepper_bot.ctrader.tokens import REFRESH_RETRY_SECONDS, TokenManager
+
+# Payload types are resolved once at import instead of instantiating messages per frame
+APP_AUTH_REQ = ProtoOAPayloadType.PROTO_OA_APPLICATION_AUTH_REQ
+APP_AUTH_RES = ProtoOAPayloadType.PROTO_OA_APPLICATION_AUTH_RES
+ACCOUNT_AUTH_REQ = ProtoOAPayloadType.PROTO_OA_ACCOUNT_AUTH_REQ
+SUBSCRIBE_SPOTS_REQ = ProtoOAPayloadType.PROTO_OA_SUBSCRIBE_SPOTS_REQ
+ACCOUNT_LIST_RES = ProtoOAPayloadType.PROTO_OA_GET_ACCOUNTS_BY_ACCESS_TOKEN_RES
+ACCOUNT_AUTH_RES = ProtoOAPayloadType.PROTO_OA_ACCOUNT_AUTH_RES
+EXECUTION_EVENT = ProtoOAPayloadType.PROTO_OA_EXECUTION_EVENT
+SPOT_EVENT = ProtoOAPayloadType.PROTO_OA_SPOT_EVENT
+OA_ERROR_RES = ProtoOAPayloadType.PROTO_OA_ERROR_RES
+ERROR_RES = ProtoPayloadType.ERROR_RES
+ORDER_ERROR_EVENT = ProtoOAPayloadType.PROTO_OA_ORDER_ERROR_EVENT
+TOKEN_INVALIDATED_EVENT = ProtoOAPayloadType.PROTO_OA_ACCOUNTS_TOKEN_INVALIDATED_EVENT
+ERROR_PAYLOAD_TYPES = frozenset((OA_ERROR_RES, ERROR_RES, ORDER_ERROR_EVENT))
+
+APP_AUTH_TIMEOUT_SECONDS = 10.0
+
+# Requests an order error event without a clientMsgId can be the answer to
+ORDER_REQUEST_TYPES = frozenset((
+    ProtoOAPayloadType.PROTO_OA_NEW_ORDER_REQ,
+    ProtoOAPayloadType.PROTO_OA_AMEND_POSITION_SLTP_REQ,
+    ProtoOAPayloadType.PROTO_OA_AMEND_ORDER_REQ,
+    ProtoOAPayloadType.PROTO_OA_CANCEL_ORDER_REQ,
+    ProtoOAPayloadType.PROTO_OA_CLOSE_POSITION_REQ,
+))
+
+# payloadType -> message class, built once for every known Open API message
+MESSAGE_CLASSES: Dict[int, type] = dict(Protobuf.populate())
+
+# Full messages are only logged, at DEBUG, for the payload types listed here: a comma
+# separated list of names (PROTO_OA_EXECUTION_EVENT) or numbers, or "all"
+DEBUG_PAYLOADS_ENV_VAR = "PEPPER_DEBUG_PAYLOADS"
+
+_message_log = logging.getLogger("pepper_bot.ctrader.messages")
+_message_log.setLevel(logging.DEBUG)
+_debug_payload_types: FrozenSet[int] = frozenset()
+
+
+def set_debug_payload_types(payload_types: Iterable[Union[int, str]]) -> None:
+    """Logs the full content of messages of these payload types (names or numbers; "all" for every type)."""
+    global _debug_payload_types
+    selected = set()
+    for payload_type in payload_types:
+        if isinstance(payload_type, str):
+            payload_type = payload_type.strip()
+            if not payload_type:
+                continue
+            if payload_type.lower() == "all":
+                selected.update(MESSAGE_CLASSES)
+                continue
+            if payload_type.isdigit():
+                payload_type = int(payload_type)
+            else:
+                payload_type = ProtoOAPayloadType.Value(payload_type) if payload_type.startswith("PROTO_OA_") \
+                    else ProtoPayloadType.Value(payload_type)
+        selected.add(payload_type)
+    _debug_payload_types = frozenset(selected)
+
+
+set_debug_payload_types(os.environ.get(DEBUG_PAYLOADS_ENV_VAR, "").split(","))
+
+# Server to connect to; point these at a local stand-in (see fake_server.py) to test offline
+HOST_ENV_VAR = "CTRADER_HOST"
+PORT_ENV_VAR = "CTRADER_PORT"
+TLS_ENV_VAR = "CTRADER_TLS"
+
+
+def get_endpoint() -> Tuple[str, int, bool]:
+    """Returns the configured (host, port, use_tls), defaulting to the demo server over TLS."""
+    host = os.environ.get(HOST_ENV_VAR, "").strip() or EndPoints.PROTOBUF_DEMO_HOST
+    port = int(os.environ.get(PORT_ENV_VAR, "").strip() or EndPoints.PROTOBUF_PORT)
+    use_tls = os.environ.get(TLS_ENV_VAR, "1").strip().lower() not in ("0", "false", "no", "off")
+    return host, port, use_tls
+
+
+class SessionProtocol(TcpProtocol):
+    """
+    The library's TcpProtocol with a send queue of its own: TcpProtocol keeps its paced
+    queue on the class, so with two connections open either could write the other's frames.
+    """
+
+    def connectionMade(self):
+        self._send_queue = deque()
+        super().connectionMade()
+
+
+class PlainTcpClient(CtraderClient):
+    """The library's Client over plain TCP instead of TLS, for local stand-in servers."""
+
+    def __init__(self, host, port, protocol, retryPolicy=None, clock=None, prepareConnection=None,
+                 numberOfMessagesToSendPerSecond=5):
+        from twisted.internet import reactor
+
+        # Mirrors Client.__init__, which hardcodes an ssl: endpoint
+        self._runningReactor = reactor
+        self.numberOfMessagesToSendPerSecond = numberOfMessagesToSendPerSecond
+        endpoint = clientFromString(reactor, f"tcp:{host}:{port}")
+        factory = Factory.forProtocol(protocol, client=self)
+        ClientService.__init__(self, endpoint, factory, retryPolicy=retryPolicy, clock=clock,
+                               prepareConnection=prepareConnection)
+        self._events = dict()
+        self._responseDeferreds = dict()
+        self.isConnected = False
+
+
+class CTraderApiError(Exception):
+    """Raised when the cTrader Open API answers a request with an error response."""
+
+    def __init__(self, error_code: str, description: str = ""):
+        super().__init__(f"{error_code} - {description or 'No description'}")
+        self.error_code = error_code
+        self.description = description
+
 
 class CTraderApiClient:
     """A Twisted-based client for interacting with the cTrader Open API."""
 
-    def __init__(self):
+    def __init__(self, host: str = None, port: int = None, use_tls: bool = None, ticks: TickStream = None,
+                 tokens: TokenManager = None):
         logging.info("Initializing CTraderApiClient.")
         self.credentials = auth.get_credentials()
-        self.access_token = self.credentials.get("accessToken")
+        if tokens is None:
+            tokens = TokenManager()
+            tokens.load()
+        self.tokens = tokens
+        self.access_token = tokens.access_token
+        tokens.add_listener(self._on_access_token)
         self.trader_accounts = []
-        self._pending_requests: Dict[int, Deferred] = {}
+        # Outstanding requests by clientMsgId, expired after their deadline
+        self.requests = RequestRegistry()
         self._request_id = 1
-        self._execution_event_callbacks: List[Callable] = []
-        
+
+        # Handlers by payload type, account, symbol and position; payload types nobody subscribed to are never decoded
+        self.events = EventBus(MESSAGE_CLASSES)
+        self._topics = self.events.topics
+        self.received_messages = 0
+        self.dropped_messages = 0
+
+        # Message counters; the per payload type ones are created as types are first seen
+        self._received: Dict[int, metrics.Counter] = {}
+        self._dropped = metrics.counter("ctrader_messages_dropped_total",
+                                        "Messages nobody was waiting for, dropped without decoding")
+        self._unknown = metrics.counter("ctrader_messages_unknown_total", "Messages of unknown payload types")
+        self._errors = metrics.counter("ctrader_error_responses_total", "Error responses and order error events")
+        self._reconnects = metrics.counter("ctrader_reconnects_total", "Sessions restored after a lost connection")
+        self._blind_time = metrics.histogram("ctrader_reconnect_seconds",
+                                             "Time from a lost connection to the restored session")
+
+        # Spot ticks; the spot handler is only registered once something is subscribed
+        self.ticks = ticks if ticks is not None else TickStream()
+        self._spot_handler_registered = False
+
         # Track authentication state
         self._is_app_authenticated = False
 
-        # Authentication deferreds
-        self._app_auth_deferred = None
-        self._account_list_deferred = None
-        self._account_auth_deferred = None
+        # What the session consists of, replayed on every new connection
+        self.authorized_accounts: Set[int] = set()
+        self.spot_subscriptions: Dict[int, Set[int]] = {}
+        self._session_callbacks: List[Callable[[], None]] = []
+        self._disconnected_at = None
 
         self.account_id = None # Will be set during authorization
 
-        self.websocket_client = CtraderClient(
-            EndPoints.PROTOBUF_DEMO_HOST,
-            EndPoints.PROTOBUF_PORT,
-            TcpProtocol
-        )
+        default_host, default_port, default_tls = get_endpoint()
+        self.host = host or default_host
+        self.port = port or default_port
+        self.use_tls = default_tls if use_tls is None else use_tls
+        client_class = CtraderClient if self.use_tls else PlainTcpClient
+        self.websocket_client = client_class(self.host, self.port, SessionProtocol, retryPolicy=reconnect_policy())
+        self.supervisor = ConnectionSupervisor(self)
         self.websocket_client.setConnectedCallback(self._on_websocket_connected)
         self.websocket_client.setMessageReceivedCallback(self._on_websocket_message)
+        self.websocket_client.setDisconnectedCallback(self._on_websocket_disconnected)
+
+        self.register_handler(APP_AUTH_RES, self._on_app_auth_res)
+        self.register_handler(OA_ERROR_RES, self._on_error_res)
+        self.register_handler(ERROR_RES, self._on_error_res)
+        self.register_handler(ORDER_ERROR_EVENT, self._on_error_res)
+        self.register_handler(TOKEN_INVALIDATED_EVENT, self._on_token_invalidated)
         logging.info("CTraderApiClient initialized.")
 
     def _on_websocket_connected(self, client):
         logging.info(f"WebSocket client connected.")
-        self.authenticate_and_authorize()
+        self.supervisor.start()
+        self._restore_session()
 
-    def _send_request(self, request, response_payload_type: int) -> Deferred:
-        """Sends a request using requestId (correct way to match responses)"""
-        d = Deferred()
-
-        # Only use requestId for messages that support it
-        if hasattr(request, 'requestId'):
-            request.requestId = self._request_id
-            self._pending_requests[self._request_id] = d
-            self._request_id += 1
-        
-        logging.info(f"Sending request: {request}")
-        self.websocket_client.send(request)
+    def _on_websocket_disconnected(self, client, reason):
+        logging.warning(f"WebSocket client disconnected: {reason.getErrorMessage()}")
+        from twisted.internet import reactor
+        self._is_app_authenticated = False
+        if self._disconnected_at is None:
+            self._disconnected_at = reactor.seconds()
+        self.supervisor.stop()
+        self.requests.fail_all(ConnectionError("Connection to cTrader was lost"))
+
+    def is_healthy(self) -> bool:
+        """Whether the session is authenticated and the server has not gone quiet."""
+        return self._is_app_authenticated and self.websocket_client.isConnected and not self.supervisor.suspect
+
+    def add_session_callback(self, callback: Callable[[], None]) -> None:
+        """
+        Calls callback every time a session is established: after the first connection's
+        application auth, and after each reconnect once the session has been replayed.
+        """
+        self._session_callbacks.append(callback)
+
+    def _restore_session(self) -> Deferred:
+        """
+        Authenticates the application, re-authorizes the accounts and re-subscribes to
+        the spots of the previous connection. All requests are written at once, without
+        waiting for each response; the server answers them in order.
+        """
+        requests = [self.authenticate_and_authorize()] + self._account_auth_requests()
+        for account_id, symbol_ids in self.spot_subscriptions.items():
+            request = ProtoOASubscribeSpotsReq(ctidTraderAccountId=account_id, symbolId=sorted(symbol_ids),
+                                               subscribeToSpotTimestamp=True)
+            requests.append(self.send_payload(SUBSCRIBE_SPOTS_REQ, request.SerializeToString(), account_id))
+
+        d = gatherResults(requests, consumeErrors=True)
+        d.addCallbacks(self._on_session_restored, self._on_session_restore_failed)
         return d
 
-    def _on_websocket_message(self, client, message):
-        msg = Protobuf.extract(message)
-        
-        logging.info(f"Received message type: {message.payloadType}, content: {msg}")
-        
-        # First try to handle by requestId
-        if hasattr(msg, 'requestId') and msg.requestId in self._pending_requests:
-            d = self._pending_requests.pop(msg.requestId)
-            d.callback(msg)
+    def _on_session_restored(self, _):
+        if self._disconnected_at is not None:
+            from twisted.internet import reactor
+            blind_time = reactor.seconds() - self._disconnected_at
+            self._disconnected_at = None
+            self._reconnects.inc()
+            self._blind_time.record(blind_time)
+            logging.info(f"cTrader session restored after {blind_time:.2f}s: {len(self.authorized_accounts)} "
+                         f"account(s), {sum(map(len, self.spot_subscriptions.values()))} spot subscription(s).")
+        for callback in list(self._session_callbacks):
+            callback()
+
+    def _on_session_restore_failed(self, failure):
+        error = failure.value.subFailure if hasattr(failure.value, "subFailure") else failure
+        if error.check(ConnectionError):
+            # The connection dropped again; the next one replays the session
             return
-        
-        # Handle error messages
-        if hasattr(msg, 'errorCode') and msg.errorCode:
-            error_msg = f"Error received: {msg.errorCode} - {getattr(msg, 'description', 'No description')}"
-            logging.error(error_msg)
-            
-            # If there's a pending auth deferred, handle the error
-            if self._app_auth_deferred is not None:
-                if msg.errorCode == "ALREADY_LOGGED_IN":
-                    logging.info("Application already authenticated, proceeding to get account list...")
-                    self._is_app_authenticated = True
-                    self._app_auth_deferred.callback(msg)
-                else:
-                    from twisted.python.failure import Failure
-                    self._app_auth_deferred.errback(Exception(error_msg))
-                self._app_auth_deferred = None
+        logging.error(f"Could not restore the cTrader session: {error.getErrorMessage()}")
+        if error.check(RequestTimeoutError):
+            # The connection is up but lost the replay; start over on a new one
+            self.drop_connection()
+
+    def _account_auth_requests(self) -> List[Deferred]:
+        """Sends an account auth with the current access token for every authorized account, all at once."""
+        requests = []
+        for account_id in sorted(self.authorized_accounts):
+            request = ProtoOAAccountAuthReq(ctidTraderAccountId=account_id, accessToken=self.access_token)
+            requests.append(self.send_payload(ACCOUNT_AUTH_REQ, request.SerializeToString(), account_id))
+        return requests
+
+    def _on_access_token(self, access_token: str):
+        """Re-authorizes the accounts with a refreshed access token, on the current connection."""
+        self.access_token = access_token
+        if not self._is_app_authenticated or not self.authorized_accounts:
+            # The next session replay uses the new token
             return
-        
-        # Handle specific message types that don't have requestId
-        if message.payloadType == ProtoOAApplicationAuthRes().payloadType:
-            logging.info("Received application auth response - authentication successful")
-            self._is_app_authenticated = True
-            if self._app_auth_deferred is not None:
-                self._app_auth_deferred.callback(msg)
-                self._app_auth_deferred = None
+        d = gatherResults(self._account_auth_requests(), consumeErrors=True)
+        d.addCallbacks(
+            lambda _: logging.info(f"Re-authorized {len(self.authorized_accounts)} account(s) with the new token."),
+            lambda failure: logging.error(f"Could not re-authorize the accounts with the new token: "
+                                          f"{failure.value.subFailure.getErrorMessage()}"))
+
+    def _on_token_invalidated(self, event):
+        logging.warning(f"cTrader access token invalidated for accounts {list(event.ctidTraderAccountIds)}: "
+                        f"{event.reason or 'no reason given'}")
+        if self.tokens.updated_within(REFRESH_RETRY_SECONDS):
+            # The token our own refresh replaced; the accounts are re-authorized with the new one
             return
-            
-        elif message.payloadType == ProtoOAGetAccountListByAccessTokenRes().payloadType:
-            logging.info("Received account list response")
-            if self._account_list_deferred is not None:
-                self._account_list_deferred.callback(msg)
-                self._account_list_deferred = None
+        self.tokens.refresh().addErrback(lambda _: None)
+
+    def write_frame(self, frame: bytes) -> None:
+        """Writes a serialized ProtoMessage on the current connection right away, if there is one."""
+        if self.websocket_client.isConnected:
+            self.websocket_client.whenConnected().addCallback(lambda protocol: protocol.sendString(frame))
+
+    def drop_connection(self) -> None:
+        """Aborts the current connection, e.g. when it has stalled; the client then reconnects."""
+        if self.websocket_client.isConnected:
+            self.websocket_client.whenConnected().addCallback(lambda protocol: protocol.transport.abortConnection())
+
+    def register_handler(self, payload_type: int, handler: Callable) -> None:
+        """Registers a handler that is called with the decoded message for a payload type."""
+        self.events.subscribe(payload_type, handler)
+
+    def unregister_handler(self, payload_type: int, handler: Callable) -> None:
+        """Removes a handler previously added with register_handler."""
+        self.events.unsubscribe_handler(payload_type, handler)
+
+    def subscribe(self, payload_type: int, handler: Callable, account_id: int = None, symbol_id: int = None,
+                  position_id: int = None, name: str = None, timed: bool = True) -> Subscription:
+        """
+        Calls handler with the decoded messages of a payload type, limited to an account,
+        a symbol and/or a position if given. Returns the subscription, for unsubscribe.
+        Calls are timed under `name` (see EventBus) unless timed is False.
+        """
+        return self.events.subscribe(payload_type, handler, account_id, symbol_id, position_id, name, timed)
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self.events.unsubscribe(subscription)
+
+    def _send_request(self, request, response_payload_type: int, timeout: float = None) -> Deferred:
+        """
+        Sends a request, correlating the response through the envelope's clientMsgId.
+        The returned Deferred fails with RequestTimeoutError if no response arrives in time.
+        """
+        client_msg_id = str(self._request_id)
+        self._request_id += 1
+        d = self.requests.add(client_msg_id, request.payloadType, getattr(request, "ctidTraderAccountId", 0),
+                              timeout, getattr(request, "positionId", 0), getattr(request, "orderId", 0))
+
+        if request.payloadType in _debug_payload_types:
+            _message_log.debug(f"Sending request {client_msg_id}: {request}")
+        # The library keeps its own response Deferred with a timeout; responses are
+        # matched here instead, so its outcome is not needed
+        self.websocket_client.send(request, clientMsgId=client_msg_id).addErrback(lambda _: None)
+        return d
+
+    def send_payload(self, payload_type: int, payload: bytes, account_id: int = 0, timeout: float = None,
+                     position_id: int = 0, order_id: int = 0) -> Deferred:
+        """
+        Sends an already serialized request payload immediately, bypassing the
+        library's paced send queue. Used for latency-sensitive requests that are
+        built ahead of time. position_id and order_id name what the request acts on.
+        """
+        client_msg_id = str(self._request_id)
+        self._request_id += 1
+        d = self.requests.add(client_msg_id, payload_type, account_id, timeout, position_id, order_id)
+
+        frame = ProtoMessage(payloadType=payload_type, payload=payload, clientMsgId=client_msg_id).SerializeToString()
+        if payload_type in _debug_payload_types:
+            _message_log.debug(f"Sending {payload_type_name(payload_type)} {client_msg_id}: {len(payload)} bytes")
+
+        def on_send_failed(failure):
+            request = self.requests.match(client_msg_id)
+            if request is not None:
+                request.deferred.errback(failure)
+
+        # Fires synchronously when the connection is up, so the frame is written in this reactor turn
+        protocol_d = self.websocket_client.whenConnected(failAfterFailures=1)
+        protocol_d.addCallback(lambda protocol: protocol.sendString(frame))
+        protocol_d.addErrback(on_send_failed)
+        return d
+
+    def _on_websocket_message(self, client, message):
+        self.received_messages += 1
+        payload_type = message.payloadType
+        received = self._received.get(payload_type)
+        if received is None:
+            received = self._received[payload_type] = metrics.counter(
+                "ctrader_messages_received_total", "Messages received per payload type",
+                payload_type=payload_type_name(payload_type))
+        received.inc()
+
+        pending = self.requests.match(message.clientMsgId) if message.clientMsgId else None
+        topic = self._topics.get(payload_type)
+
+        if pending is None and topic is None:
+            # Nobody is interested in this payload type, so don't pay for decoding it
+            self.dropped_messages += 1
+            self._dropped.inc()
             return
-            
-        elif message.payloadType == ProtoOAAccountAuthRes().payloadType:
-            logging.info("Received account auth response")
-            if self._account_auth_deferred is not None:
-                self._account_auth_deferred.callback(msg)
-                self._account_auth_deferred = None
+
+        message_class = MESSAGE_CLASSES.get(payload_type)
+        if message_class is None:
+            self._unknown.inc()
+            logging.warning(f"Received unknown message type {payload_type}")
             return
-        
-        # Execution events
-        if message.payloadType == ProtoOAExecutionEvent().payloadType:
-            for callback in self._execution_event_callbacks:
-                callback(msg)
-        else:
-            logging.warning(f"Received unhandled message type {message.payloadType}: {msg}")
+        msg = message_class()
+        msg.ParseFromString(message.payload)
+
+        if payload_type in _debug_payload_types:
+            _message_log.debug(f"Received {payload_type_name(payload_type)}: {msg}")
+
+        if payload_type in ERROR_PAYLOAD_TYPES:
+            self._errors.inc()
+            if pending is None:
+                # Some errors come without a clientMsgId; blame the request acting on the
+                # error's position or order, else the account's oldest request
+                account_id = getattr(msg, "ctidTraderAccountId", 0)
+                if account_id:
+                    if payload_type == ORDER_ERROR_EVENT:
+                        pending = self.requests.match_error(account_id, ORDER_REQUEST_TYPES,
+                                                            msg.positionId, msg.orderId)
+                    else:
+                        pending = self.requests.match_error(account_id)
+            if pending is not None:
+                pending.deferred.errback(CTraderApiError(msg.errorCode, msg.description))
+                return
+        elif pending is not None:
+            pending.deferred.callback(msg)
+
+        if topic is not None:
+            topic.publish(msg)
+
+    def _on_error_res(self, msg):
+        error_msg = f"Error received: {msg.errorCode} - {getattr(msg, 'description', 'No description')}"
+        logging.error(error_msg)
+
+    def _on_app_auth_res(self, msg):
+        logging.info("Received application auth response - authentication successful")
 
     def authenticate_and_authorize(self):
-        """Authenticates the application."""
+        """Authenticates the application on the current connection."""
         logging.info(f"Starting authentication.")
         
         if not self.credentials:
@@ -127,14 +435,22 @@ class CTraderApiClient:
         auth_req.clientId = self.credentials["clientId"]
         auth_req.clientSecret = self.credentials["clientSecret"]
 
-        self._app_auth_deferred = Deferred()
-        self.websocket_client.send(auth_req)
-        
-        from twisted.internet import reactor
-        self._app_auth_deferred.addTimeout(10, reactor)
-        
-        self._app_auth_deferred.addErrback(self._on_auth_error)
-        return self._app_auth_deferred
+        # Sent ahead of the paced queue, so a reconnect can pipeline the rest of the session behind it
+        d = self.send_payload(APP_AUTH_REQ, auth_req.SerializeToString(), timeout=APP_AUTH_TIMEOUT_SECONDS)
+        d.addCallbacks(self._on_app_authenticated, self._on_app_auth_error)
+        return d
+
+    def _on_app_authenticated(self, response):
+        # Set before the session callbacks run, which fire from the same response
+        self._is_app_authenticated = True
+        return response
+
+    def _on_app_auth_error(self, failure):
+        if failure.check(CTraderApiError) and failure.value.error_code == "ALREADY_LOGGED_IN":
+            logging.info("Application already authenticated.")
+            self._is_app_authenticated = True
+            return None
+        return self._on_auth_error(failure)
 
     def _on_auth_error(self, failure):
         """Handle authentication errors"""
@@ -144,23 +460,17 @@ class CTraderApiClient:
     def get_account_list(self):
         """Get account list after application authentication"""
         logging.info("Getting account list...")
-        
-        self.access_token = auth.get_credentials().get("accessToken")
+
         if not self.access_token:
             raise Exception("Cannot get account list: access token is None")
             
         acc_list_req = ProtoOAGetAccountListByAccessTokenReq()
         acc_list_req.accessToken = self.access_token
 
-        self._account_list_deferred = Deferred()
-        self.websocket_client.send(acc_list_req)
-        
-        from twisted.internet import reactor
-        self._account_list_deferred.addTimeout(10, reactor)
-        
-        self._account_list_deferred.addCallback(self._on_account_list)
-        self._account_list_deferred.addErrback(self._on_auth_error)
-        return self._account_list_deferred
+        d = self._send_request(acc_list_req, ACCOUNT_LIST_RES)
+        d.addCallback(self._on_account_list)
+        d.addErrback(self._on_auth_error)
+        return d
 
     def _on_account_list(self, response):
         """Handle account list response"""
@@ -183,10 +493,11 @@ class CTraderApiClient:
         acc_auth_req.ctidTraderAccountId = ctid_trader_account_id
         acc_auth_req.accessToken = self.access_token
 
-        d = self._send_request(acc_auth_req, ProtoOAAccountAuthRes().payloadType)
+        d = self._send_request(acc_auth_req, ACCOUNT_AUTH_RES)
 
         def on_authorized(response):
             logging.info(f"Account {ctid_trader_account_id} authorized.")
+            self.authorized_accounts.add(ctid_trader_account_id)
             return response
 
         d.addCallback(on_authorized)
@@ -196,11 +507,23 @@ class CTraderApiClient:
         """Gets all available symbols for the trading account."""
         request = ProtoOASymbolsListReq()
         request.ctidTraderAccountId = ctid_trader_account_id
-        return self._send_request(request, ProtoOASymbolsListRes().payloadType)
+        return self._send_request(request, ProtoOAPayloadType.PROTO_OA_SYMBOLS_LIST_RES)
+
+    def get_symbols_by_id(self, ctid_trader_account_id: int, symbol_ids: List[int]) -> Deferred:
+        """Gets the full details (digits, lot size, volume limits...) of the given symbols."""
+        request = ProtoOASymbolByIdReq()
+        request.ctidTraderAccountId = ctid_trader_account_id
+        request.symbolId.extend(symbol_ids)
+        return self._send_request(request, ProtoOAPayloadType.PROTO_OA_SYMBOL_BY_ID_RES)
 
     def place_order(self, ctid_trader_account_id: int, symbol_id: int, order_type: ProtoOAOrderType, trade_side: ProtoOATradeSide,
-                          volume: int, stop_loss: float = None, take_profit: float = None) -> Deferred:
-        """Places a new trading order."""
+                          volume: int, stop_loss: float = None, take_profit: float = None,
+                          relative_stop_loss: int = None, relative_take_profit: int = None) -> Deferred:
+        """
+        Places a new trading order.
+        volume is in protocol units (cents of the base asset); relative stops are distances
+        in 1/100000 of a price unit, as required for market orders.
+        """
         request = ProtoOANewOrderReq()
         request.ctidTraderAccountId = ctid_trader_account_id
         request.symbolId = symbol_id
@@ -211,8 +534,12 @@ class CTraderApiClient:
             request.stopLoss = stop_loss
         if take_profit:
             request.takeProfit = take_profit
+        if relative_stop_loss:
+            request.relativeStopLoss = relative_stop_loss
+        if relative_take_profit:
+            request.relativeTakeProfit = relative_take_profit
 
-        return self._send_request(request, ProtoOANewOrderRes().payloadType)
+        return self._send_request(request, EXECUTION_EVENT)
 
     def modify_position(self, ctid_trader_account_id: int, position_id: int, stop_loss: float = None, take_profit: float = None, trailing_stop: bool = False) -> Deferred:
         """Modifies an existing position."""
@@ -226,32 +553,64 @@ class CTraderApiClient:
         if trailing_stop:
             request.trailingStopLoss = trailing_stop
 
-        return self._send_request(request, ProtoOAAmendPositionSLTPRes().payloadType)
+        return self._send_request(request, EXECUTION_EVENT)
 
     def connect(self):
         """Connects to the cTrader WebSocket."""
-        logging.info("Connecting to cTrader WebSocket...")
+        logging.info(f"Connecting to cTrader at {self.host}:{self.port}...")
         self.websocket_client.startService()
         logging.info("cTrader WebSocket connected.")
 
     def subscribe_to_ticks(self, ctid_trader_account_id: int, symbol_id: int) -> Deferred:
+        """Subscribes to spot events for a symbol; ticks are collected in self.ticks."""
+        if not self._spot_handler_registered:
+            self.register_handler(SPOT_EVENT, self.ticks.on_spot_event)
+            self._spot_handler_registered = True
+
         request = ProtoOASubscribeSpotsReq()
         request.ctidTraderAccountId = ctid_trader_account_id
         request.symbolId.append(symbol_id)
-        return self._send_request(request, ProtoOASubscribeSpotsRes().payloadType)
+        request.subscribeToSpotTimestamp = True
+        d = self._send_request(request, ProtoOAPayloadType.PROTO_OA_SUBSCRIBE_SPOTS_RES)
+
+        def on_subscribed(response):
+            self.spot_subscriptions.setdefault(ctid_trader_account_id, set()).add(symbol_id)
+            return response
+
+        d.addCallback(on_subscribed)
+        return d
 
-    def subscribe_to_execution_events(self, callback: Callable):
-        """Subscribes to execution events."""
-        self._execution_event_callbacks.append(callback)
+    def subscribe_to_execution_events(self, callback: Callable, account_id: int = None, symbol_id: int = None,
+                                      position_id: int = None) -> Subscription:
+        """Subscribes to execution events, optionally of one account, symbol and/or position only."""
+        return self.subscribe(EXECUTION_EVENT, callback, account_id, symbol_id, position_id)
 
     def is_ready(self):
         """Check if the client is fully authenticated and authorized"""
         return self._is_app_authenticated
 
-    def get_account_balance(self, ctid_trader_account_id: int) -> Deferred:
-        """Gets the balance of a trading account."""
+    def reconcile(self, ctid_trader_account_id: int) -> Deferred:
+        """Gets the open positions and pending orders of a trading account."""
+        request = ProtoOAReconcileReq()
+        request.ctidTraderAccountId = ctid_trader_account_id
+        return self._send_request(request, ProtoOAPayloadType.PROTO_OA_RECONCILE_RES)
+
+    def get_trader(self, ctid_trader_account_id: int) -> Deferred:
+        """Gets the details of a trading account (a ProtoOATrader), including its balance."""
         request = ProtoOATraderReq()
         request.ctidTraderAccountId = ctid_trader_account_id
-        d = self._send_request(request, ProtoOATraderRes().payloadType)
-        d.addCallback(lambda response: response.trader.balance)
+        d = self._send_request(request, ProtoOAPayloadType.PROTO_OA_TRADER_RES)
+        d.addCallback(lambda response: response.trader)
+        return d
+
+    def get_unrealized_pnl(self, ctid_trader_account_id: int) -> Deferred:
+        """Gets the unrealized P&L of every open position of a trading account."""
+        request = ProtoOAGetPositionUnrealizedPnLReq()
+        request.ctidTraderAccountId = ctid_trader_account_id
+        return self._send_request(request, ProtoOAPayloadType.PROTO_OA_GET_POSITION_UNREALIZED_PNL_RES)
+
+    def get_account_balance(self, ctid_trader_account_id: int) -> Deferred:
+        """Gets the balance of a trading account."""
+        d = self.get_trader(ctid_trader_account_id)
+        d.addCallback(lambda trader: trader.balance)
         return d
@@ -0,0 +1,247 @@
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pepper_bot.core import metrics
+
+# A handler call taking longer than this holds up the reactor noticeably; it is counted and logged
+SLOW_HANDLER_SECONDS = 0.005
+
+# A slow handler is logged at most once per this many seconds
+SLOW_LOG_INTERVAL_SECONDS = 60.0
+
+# (account id, symbol id, position id) of an event, 0 where it has none
+_Keys = Tuple[int, int, int]
+
+
+class Subscription:
+    """A handler of one payload type, optionally limited to an account, a symbol and/or a position."""
+    __slots__ = ("handler", "payload_type", "account_id", "symbol_id", "position_id", "name", "seq",
+                 "timing", "slow", "_logged_at")
+
+    def __init__(self, handler: Callable[[Any], None], payload_type: int, account_id: Optional[int],
+                 symbol_id: Optional[int], position_id: Optional[int], name: str, seq: int, timed: bool = True):
+        self.handler = handler
+        self.payload_type = payload_type
+        self.account_id = account_id
+        self.symbol_id = symbol_id
+        self.position_id = position_id
+        self.name = name
+        self.seq = seq
+        self.timing = None
+        self.slow = None
+        if timed:
+            self.timing = metrics.histogram("event_handler_seconds", "Time spent in each event handler",
+                                            handler=name)
+            self.slow = metrics.counter("event_handler_slow_total",
+                                        f"Handler calls taking longer than {SLOW_HANDLER_SECONDS * 1e3:.0f} ms",
+                                        handler=name)
+        self._logged_at = 0.0
+
+    @property
+    def filtered(self) -> bool:
+        return self.account_id is not None or self.symbol_id is not None or self.position_id is not None
+
+    def matches(self, keys: _Keys) -> bool:
+        account_id, symbol_id, position_id = keys
+        return ((self.account_id is None or self.account_id == account_id)
+                and (self.symbol_id is None or self.symbol_id == symbol_id)
+                and (self.position_id is None or self.position_id == position_id))
+
+    def call(self, msg: Any) -> None:
+        if self.timing is None:
+            try:
+                self.handler(msg)
+            except Exception:
+                logging.exception(f"Error in event handler {self.name}")
+            return
+        start = time.perf_counter()
+        try:
+            self.handler(msg)
+        except Exception:
+            logging.exception(f"Error in event handler {self.name}")
+        elapsed = time.perf_counter() - start
+        self.timing.record(elapsed)
+        if elapsed >= SLOW_HANDLER_SECONDS:
+            self.slow.inc()
+            now = time.monotonic()
+            if now - self._logged_at >= SLOW_LOG_INTERVAL_SECONDS:
+                self._logged_at = now
+                logging.warning(f"Event handler {self.name} took {elapsed * 1e3:.1f} ms, holding up the reactor "
+                                f"({self.slow.value} slow call(s) so far).")
+
+
+class _TopicIndex:
+    """The subscriptions of one payload type, indexed by the most selective filter of each."""
+    __slots__ = ("keys_of", "unfiltered", "by_position", "by_symbol", "by_account", "filtered")
+
+    def __init__(self, keys_of: Callable[[Any], _Keys]):
+        self.keys_of = keys_of
+        self.unfiltered: List[Subscription] = []
+        self.by_position: Dict[int, List[Subscription]] = {}
+        self.by_symbol: Dict[int, List[Subscription]] = {}
+        self.by_account: Dict[int, List[Subscription]] = {}
+        self.filtered = 0
+
+    def __bool__(self) -> bool:
+        return bool(self.unfiltered) or self.filtered > 0
+
+    def __iter__(self):
+        yield from self.unfiltered
+        for index in (self.by_position, self.by_symbol, self.by_account):
+            for subscriptions in index.values():
+                yield from subscriptions
+
+    def _slot(self, subscription: Subscription) -> Tuple[Optional[Dict[int, List[Subscription]]], Optional[int]]:
+        """The index and key a subscription is filed under; (None, None) if it has no filter."""
+        if subscription.position_id is not None:
+            return self.by_position, subscription.position_id
+        if subscription.symbol_id is not None:
+            return self.by_symbol, subscription.symbol_id
+        if subscription.account_id is not None:
+            return self.by_account, subscription.account_id
+        return None, None
+
+    # The lists are replaced rather than changed, so a handler may subscribe or
+    # unsubscribe while an event is being delivered without copying them per event
+
+    def add(self, subscription: Subscription) -> None:
+        index, key = self._slot(subscription)
+        if index is None:
+            self.unfiltered = self.unfiltered + [subscription]
+            return
+        index[key] = index.get(key, []) + [subscription]
+        self.filtered += 1
+
+    def remove(self, subscription: Subscription) -> bool:
+        index, key = self._slot(subscription)
+        if index is None:
+            if subscription not in self.unfiltered:
+                return False
+            self.unfiltered = [other for other in self.unfiltered if other is not subscription]
+            return True
+        subscriptions = index.get(key, [])
+        if subscription not in subscriptions:
+            return False
+        subscriptions = [other for other in subscriptions if other is not subscription]
+        if subscriptions:
+            index[key] = subscriptions
+        else:
+            del index[key]
+        self.filtered -= 1
+        return True
+
+    def publish(self, msg: Any) -> None:
+        if not self.filtered:
+            for subscription in self.unfiltered:
+                subscription.call(msg)
+            return
+
+        keys = self.keys_of(msg)
+        account_id, symbol_id, position_id = keys
+        targets = list(self.unfiltered)
+        for index, key in ((self.by_position, position_id), (self.by_symbol, symbol_id),
+                           (self.by_account, account_id)):
+            subscriptions = index.get(key) if key else None
+            if subscriptions:
+                targets.extend(subscription for subscription in subscriptions if subscription.matches(keys))
+        # Handlers are called in the order they subscribed, whichever filter they use
+        targets.sort(key=_seq)
+        for subscription in targets:
+            subscription.call(msg)
+
+
+def _seq(subscription: Subscription) -> int:
+    return subscription.seq
+
+
+def _keys_extractor(message_class: Optional[type]) -> Callable[[Any], _Keys]:
+    """Builds the function reading (account id, symbol id, position id) from messages of a class."""
+    # Repeated fields (e.g. the positions of a reconcile response) don't identify one account, symbol or position
+    fields = {field.name for field in message_class.DESCRIPTOR.fields
+              if field.label != field.LABEL_REPEATED} if message_class is not None else set()
+    has_account = "ctidTraderAccountId" in fields
+    has_symbol = "symbolId" in fields
+    has_position_id = "positionId" in fields
+    has_position = "position" in fields
+    has_order = "order" in fields
+
+    def keys_of(msg: Any) -> _Keys:
+        account_id = msg.ctidTraderAccountId if has_account else 0
+        symbol_id = msg.symbolId if has_symbol else 0
+        position_id = msg.positionId if has_position_id else 0
+        # Execution events carry the symbol and position in their position and order
+        if has_position and msg.HasField("position"):
+            position_id = position_id or msg.position.positionId
+            symbol_id = symbol_id or msg.position.tradeData.symbolId
+        if has_order and msg.HasField("order"):
+            position_id = position_id or msg.order.positionId
+            symbol_id = symbol_id or msg.order.tradeData.symbolId
+        return account_id, symbol_id, position_id
+
+    return keys_of
+
+
+class EventBus:
+    """
+    Delivers decoded messages to the handlers subscribed to their payload type, and of
+    those only to the ones whose account, symbol and position filters match. Handlers
+    are timed; calls slower than SLOW_HANDLER_SECONDS are counted per handler and
+    logged, since they hold up every other event behind them. Reactor thread only.
+    """
+
+    def __init__(self, message_classes: Dict[int, type]):
+        self.message_classes = message_classes
+        # Payload type -> its subscriptions; only payload types with subscriptions are present
+        self.topics: Dict[int, _TopicIndex] = {}
+        self._seq = 0
+
+    def subscribe(self, payload_type: int, handler: Callable[[Any], None], account_id: Optional[int] = None,
+                  symbol_id: Optional[int] = None, position_id: Optional[int] = None,
+                  name: Optional[str] = None, timed: bool = True) -> Subscription:
+        """
+        Calls handler(msg) for every message of payload_type matching the given filters.
+        Handlers are timed under `name`, by default their qualified name; relays to
+        another bus pass timed=False so their handlers are not counted twice.
+        """
+        message_class = self.message_classes.get(payload_type)
+        if message_class is None:
+            raise ValueError(f"Unknown payload type: {payload_type}")
+        topic = self.topics.get(payload_type)
+        if topic is None:
+            topic = self.topics[payload_type] = _TopicIndex(_keys_extractor(message_class))
+        self._seq += 1
+        subscription = Subscription(handler, payload_type, account_id, symbol_id, position_id,
+                                    name or getattr(handler, "__qualname__", repr(handler)), self._seq, timed)
+        topic.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        topic = self.topics.get(subscription.payload_type)
+        if topic is not None and topic.remove(subscription) and not topic:
+            del self.topics[subscription.payload_type]
+
+    def unsubscribe_handler(self, payload_type: int, handler: Callable[[Any], None]) -> None:
+        """Removes the first subscription of handler to payload_type."""
+        topic = self.topics.get(payload_type)
+        if topic is None:
+            return
+        subscriptions = [subscription for subscription in topic if subscription.handler == handler]
+        if subscriptions:
+            self.unsubscribe(min(subscriptions, key=_seq))
+
+    def publish(self, payload_type: int, msg: Any) -> None:
+        topic = self.topics.get(payload_type)
+        if topic is not None:
+            topic.publish(msg)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """Call counts and timings of every subscription, slowest (by maximum) first."""
+        rows = []
+        for topic in self.topics.values():
+            for subscription in topic:
+                if subscription.timing is not None:
+                    rows.append({"handler": subscription.name, "payload_type": subscription.payload_type,
+                                 "slow": subscription.slow.value, **subscription.timing.summary()})
+        rows.sort(key=lambda row: row.get("max", 0.0), reverse=True)
+        return rows
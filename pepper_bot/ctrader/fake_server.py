@@ -0,0 +1,508 @@
+"""
+A local stand-in for the cTrader Open API server, for load and latency testing offline.
+
+It speaks the same framing as the real server (a 4 byte big-endian length followed by
+a serialized ProtoMessage) over plain TCP, answers the requests the bot sends, fills
+market orders instantly at its own random-walk quotes, and can flood connected clients
+with spot and execution events. Point the client at it with CTRADER_HOST, CTRADER_PORT
+and CTRADER_TLS=0, or run it directly:
+
+    python -m pepper_bot.ctrader.fake_server --port 5035 --spot-rate 1000
+"""
+import argparse
+import itertools
+import logging
+import random
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from twisted.internet import protocol
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import Int32StringReceiver
+
+from ctrader_open_api.messages.OpenApiCommonMessages_pb2 import ProtoMessage
+from ctrader_open_api.messages.OpenApiCommonModelMessages_pb2 import ProtoPayloadType
+from ctrader_open_api.messages.OpenApiMessages_pb2 import *
+from ctrader_open_api.messages.OpenApiModelMessages_pb2 import *
+
+from pepper_bot.ctrader.ticks import PRICE_SCALE
+
+DEFAULT_PORT = 5035
+DEFAULT_ACCOUNTS = (1001, 1002)
+DEFAULT_BALANCE = 10_000_000  # In cents of the deposit currency
+
+# symbolId -> (name, digits, pipPosition, lotSize, starting bid)
+DEFAULT_SYMBOLS: Dict[int, Tuple[str, int, int, int, float]] = {
+    1: ("EURUSD", 5, 4, 10_000_000, 1.08500),
+    2: ("GBPUSD", 5, 4, 10_000_000, 1.26500),
+    41: ("XAUUSD", 2, 1, 10_000, 2350.00),
+    10015: ("USTEC", 2, 0, 100, 18000.00),
+    10026: ("BTCUSD", 2, 0, 100, 65000.00),
+    10046: ("ETHUSD", 2, 0, 100, 3200.00),
+}
+
+# Spread and random-walk step of the simulated quotes, in points
+SPREAD_POINTS = 10
+STEP_POINTS = 5
+
+# How often the flood loops run; each run sends rate * interval events
+FLOOD_INTERVAL_SECONDS = 0.01
+
+HEARTBEAT_EVENT = ProtoPayloadType.HEARTBEAT_EVENT
+
+
+class _Quote:
+    __slots__ = ("symbol_id", "name", "digits", "pip_position", "lot_size", "bid", "ask")
+
+    def __init__(self, symbol_id: int, name: str, digits: int, pip_position: int, lot_size: int, bid: float):
+        self.symbol_id = symbol_id
+        self.name = name
+        self.digits = digits
+        self.pip_position = pip_position
+        self.lot_size = lot_size
+        self.bid = bid
+        self.ask = round(bid + SPREAD_POINTS * 10.0 ** -digits, digits)
+
+    def step(self, rng: random.Random) -> None:
+        point = 10.0 ** -self.digits
+        self.bid = round(self.bid + rng.randint(-STEP_POINTS, STEP_POINTS) * point, self.digits)
+        self.ask = round(self.bid + SPREAD_POINTS * point, self.digits)
+
+
+class _Position:
+    __slots__ = ("position_id", "order_id", "account_id", "symbol_id", "trade_side", "volume", "price",
+                 "stop_loss", "take_profit", "open_timestamp")
+
+    def __init__(self, position_id: int, order_id: int, account_id: int, symbol_id: int, trade_side: int,
+                 volume: int, price: float, open_timestamp: int):
+        self.position_id = position_id
+        self.order_id = order_id
+        self.account_id = account_id
+        self.symbol_id = symbol_id
+        self.trade_side = trade_side
+        self.volume = volume
+        self.price = price
+        self.stop_loss = 0.0
+        self.take_profit = 0.0
+        self.open_timestamp = open_timestamp
+
+
+class FakeOpenApiProtocol(Int32StringReceiver):
+    MAX_LENGTH = 15000000
+
+    def connectionMade(self):
+        self.authorized: Set[int] = set()
+        self.spot_symbols: Set[int] = set()
+        self.factory.connections.append(self)
+
+    def connectionLost(self, reason):
+        if self in self.factory.connections:
+            self.factory.connections.remove(self)
+
+    def stringReceived(self, data: bytes):
+        frame = ProtoMessage()
+        frame.ParseFromString(data)
+        self.factory.received += 1
+        if self.factory.stalled:
+            return
+        if frame.payloadType == HEARTBEAT_EVENT:
+            # Clients answer heartbeats with heartbeats, so never reply to one
+            return
+        self.factory.handle(self, frame)
+
+    def send_message(self, message, client_msg_id: Optional[str] = None) -> None:
+        if self.factory.stalled:
+            return
+        frame = ProtoMessage(payloadType=message.payloadType, payload=message.SerializeToString())
+        if client_msg_id:
+            frame.clientMsgId = client_msg_id
+        self.sendString(frame.SerializeToString())
+        self.factory.sent += 1
+
+
+class FakeOpenApiServer(protocol.ServerFactory):
+    """
+    Serves any number of client connections from one shared set of accounts, symbols
+    and positions. Responses are sent immediately, or after `latency` seconds.
+    """
+    protocol = FakeOpenApiProtocol
+
+    def __init__(self, accounts=DEFAULT_ACCOUNTS, symbols: Dict[int, Tuple[str, int, int, int, float]] = None,
+                 latency: float = 0.0, seed: int = 0, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.connections: List[FakeOpenApiProtocol] = []
+        self.balances: Dict[int, int] = {account_id: DEFAULT_BALANCE for account_id in accounts}
+        self.balance_versions: Dict[int, int] = {account_id: 1 for account_id in accounts}
+        self.quotes: Dict[int, _Quote] = {
+            symbol_id: _Quote(symbol_id, *details) for symbol_id, details in (symbols or DEFAULT_SYMBOLS).items()
+        }
+        self.positions: Dict[int, _Position] = {}
+        self._ids = itertools.count(1)
+
+        self.received = 0
+        self.sent = 0
+        # While stalled, connections stay open but nothing is answered or sent
+        self.stalled = False
+        self._spot_flood: Optional[LoopingCall] = None
+        self._execution_flood: Optional[LoopingCall] = None
+
+        self._handlers: Dict[int, Callable] = {
+            ProtoOAPayloadType.PROTO_OA_APPLICATION_AUTH_REQ: self._on_app_auth,
+            ProtoOAPayloadType.PROTO_OA_VERSION_REQ: self._on_version,
+            ProtoOAPayloadType.PROTO_OA_GET_ACCOUNTS_BY_ACCESS_TOKEN_REQ: self._on_account_list,
+            ProtoOAPayloadType.PROTO_OA_ACCOUNT_AUTH_REQ: self._on_account_auth,
+            ProtoOAPayloadType.PROTO_OA_TRADER_REQ: self._on_trader,
+            ProtoOAPayloadType.PROTO_OA_SYMBOLS_LIST_REQ: self._on_symbols_list,
+            ProtoOAPayloadType.PROTO_OA_SYMBOL_BY_ID_REQ: self._on_symbol_by_id,
+            ProtoOAPayloadType.PROTO_OA_SUBSCRIBE_SPOTS_REQ: self._on_subscribe_spots,
+            ProtoOAPayloadType.PROTO_OA_NEW_ORDER_REQ: self._on_new_order,
+            ProtoOAPayloadType.PROTO_OA_AMEND_POSITION_SLTP_REQ: self._on_amend_position,
+            ProtoOAPayloadType.PROTO_OA_CLOSE_POSITION_REQ: self._on_close_position,
+            ProtoOAPayloadType.PROTO_OA_RECONCILE_REQ: self._on_reconcile,
+            ProtoOAPayloadType.PROTO_OA_GET_POSITION_UNREALIZED_PNL_REQ: self._on_unrealized_pnl,
+        }
+        # payloadType -> request class, for the requests handled above
+        self._request_classes = {
+            cls().payloadType: cls for cls in (
+                ProtoOAApplicationAuthReq, ProtoOAVersionReq, ProtoOAGetAccountListByAccessTokenReq,
+                ProtoOAAccountAuthReq, ProtoOATraderReq, ProtoOASymbolsListReq, ProtoOASymbolByIdReq,
+                ProtoOASubscribeSpotsReq, ProtoOANewOrderReq, ProtoOAAmendPositionSLTPReq, ProtoOAClosePositionReq,
+                ProtoOAReconcileReq, ProtoOAGetPositionUnrealizedPnLReq,
+            )
+        }
+
+    # Request handling
+
+    def handle(self, connection: FakeOpenApiProtocol, frame: ProtoMessage) -> None:
+        handler = self._handlers.get(frame.payloadType)
+        if handler is None:
+            self._reply(connection, frame, _error("UNSUPPORTED_MESSAGE", f"Payload type {frame.payloadType}"))
+            return
+        request = self._request_classes[frame.payloadType]()
+        request.ParseFromString(frame.payload)
+        account_id = getattr(request, "ctidTraderAccountId", 0)
+        if account_id and frame.payloadType != ProtoOAPayloadType.PROTO_OA_ACCOUNT_AUTH_REQ \
+                and account_id not in connection.authorized:
+            self._reply(connection, frame, _error("ACCOUNT_NOT_AUTHORIZED", f"Account {account_id}", account_id))
+            return
+        for response in handler(connection, request):
+            self._reply(connection, frame, response)
+            if response.payloadType == ProtoOAPayloadType.PROTO_OA_EXECUTION_EVENT:
+                # Like the real server, every session authorized on the account sees the event
+                for other in self.connections:
+                    if other is not connection and response.ctidTraderAccountId in other.authorized:
+                        other.send_message(response)
+
+    def _reply(self, connection: FakeOpenApiProtocol, frame: ProtoMessage, response) -> None:
+        if self.latency:
+            self.clock.callLater(self.latency, connection.send_message, response, frame.clientMsgId)
+        else:
+            connection.send_message(response, frame.clientMsgId)
+
+    def _on_app_auth(self, connection, request):
+        yield ProtoOAApplicationAuthRes()
+
+    def _on_version(self, connection, request):
+        yield ProtoOAVersionRes(version="fake")
+
+    def _on_account_list(self, connection, request):
+        response = ProtoOAGetAccountListByAccessTokenRes(accessToken=request.accessToken)
+        for account_id in self.balances:
+            response.ctidTraderAccount.add(ctidTraderAccountId=account_id, isLive=False, traderLogin=account_id)
+        yield response
+
+    def _on_account_auth(self, connection, request):
+        if request.ctidTraderAccountId not in self.balances:
+            yield _error("CH_CTID_TRADER_ACCOUNT_NOT_FOUND", "Unknown account", request.ctidTraderAccountId)
+            return
+        connection.authorized.add(request.ctidTraderAccountId)
+        yield ProtoOAAccountAuthRes(ctidTraderAccountId=request.ctidTraderAccountId)
+
+    def _on_trader(self, connection, request):
+        account_id = request.ctidTraderAccountId
+        response = ProtoOATraderRes(ctidTraderAccountId=account_id)
+        response.trader.ctidTraderAccountId = account_id
+        response.trader.balance = self.balances[account_id]
+        response.trader.balanceVersion = self.balance_versions[account_id]
+        response.trader.depositAssetId = 1
+        response.trader.moneyDigits = 2
+        yield response
+
+    def _on_symbols_list(self, connection, request):
+        response = ProtoOASymbolsListRes(ctidTraderAccountId=request.ctidTraderAccountId)
+        for quote in self.quotes.values():
+            response.symbol.add(symbolId=quote.symbol_id, symbolName=quote.name, enabled=True)
+        yield response
+
+    def _on_symbol_by_id(self, connection, request):
+        response = ProtoOASymbolByIdRes(ctidTraderAccountId=request.ctidTraderAccountId)
+        for symbol_id in request.symbolId:
+            quote = self.quotes.get(symbol_id)
+            if quote is not None:
+                response.symbol.add(symbolId=symbol_id, digits=quote.digits, pipPosition=quote.pip_position,
+                                    lotSize=quote.lot_size, minVolume=quote.lot_size // 100,
+                                    maxVolume=quote.lot_size * 1000, stepVolume=quote.lot_size // 100)
+        yield response
+
+    def _on_subscribe_spots(self, connection, request):
+        connection.spot_symbols.update(symbol_id for symbol_id in request.symbolId if symbol_id in self.quotes)
+        yield ProtoOASubscribeSpotsRes(ctidTraderAccountId=request.ctidTraderAccountId)
+
+    def _on_new_order(self, connection, request):
+        account_id = request.ctidTraderAccountId
+        quote = self.quotes.get(request.symbolId)
+        if quote is None:
+            yield _error("SYMBOL_NOT_FOUND", f"Symbol {request.symbolId}", account_id)
+            return
+        if request.orderType != ProtoOAOrderType.MARKET:
+            yield _error("NOT_SUPPORTED", "Only market orders are simulated", account_id)
+            return
+
+        is_buy = request.tradeSide == ProtoOATradeSide.BUY
+        price = quote.ask if is_buy else quote.bid
+        position = _Position(next(self._ids), next(self._ids), account_id, quote.symbol_id, request.tradeSide,
+                             request.volume, price, int(time.time() * 1000))
+        if request.relativeStopLoss:
+            distance = request.relativeStopLoss / PRICE_SCALE
+            position.stop_loss = round(price - distance if is_buy else price + distance, quote.digits)
+        if request.relativeTakeProfit:
+            distance = request.relativeTakeProfit / PRICE_SCALE
+            position.take_profit = round(price + distance if is_buy else price - distance, quote.digits)
+        self.positions[position.position_id] = position
+
+        # Like the real server: the order is accepted, then filled
+        yield self._execution_event(position, ProtoOAExecutionType.ORDER_ACCEPTED,
+                                    ProtoOAOrderStatus.ORDER_STATUS_ACCEPTED)
+        yield self._execution_event(position, ProtoOAExecutionType.ORDER_FILLED,
+                                    ProtoOAOrderStatus.ORDER_STATUS_FILLED)
+
+    def _on_amend_position(self, connection, request):
+        position = self.positions.get(request.positionId)
+        if position is None or position.account_id != request.ctidTraderAccountId:
+            yield _error("POSITION_NOT_FOUND", f"Position {request.positionId}", request.ctidTraderAccountId)
+            return
+        position.stop_loss = request.stopLoss
+        position.take_profit = request.takeProfit
+        yield self._execution_event(position, ProtoOAExecutionType.ORDER_REPLACED,
+                                    ProtoOAOrderStatus.ORDER_STATUS_ACCEPTED)
+
+    def _on_close_position(self, connection, request):
+        position = self.positions.get(request.positionId)
+        if position is None or position.account_id != request.ctidTraderAccountId:
+            yield _error("POSITION_NOT_FOUND", f"Position {request.positionId}", request.ctidTraderAccountId)
+            return
+        yield self._close(position)
+
+    def _on_reconcile(self, connection, request):
+        response = ProtoOAReconcileRes(ctidTraderAccountId=request.ctidTraderAccountId)
+        for position in self.positions.values():
+            if position.account_id == request.ctidTraderAccountId:
+                response.position.add().CopyFrom(
+                    self._execution_event(position, ProtoOAExecutionType.ORDER_FILLED,
+                                          ProtoOAOrderStatus.ORDER_STATUS_FILLED).position)
+        yield response
+
+    def _on_unrealized_pnl(self, connection, request):
+        account_id = request.ctidTraderAccountId
+        response = ProtoOAGetPositionUnrealizedPnLRes(ctidTraderAccountId=account_id, moneyDigits=2)
+        for position in self.positions.values():
+            if position.account_id == account_id:
+                pnl = self._pnl_cents(position)
+                response.positionUnrealizedPnL.add(positionId=position.position_id, grossUnrealizedPnL=pnl,
+                                                   netUnrealizedPnL=pnl)
+        yield response
+
+    def _pnl_cents(self, position: _Position) -> int:
+        """P&L at the current quote in cents, treating the quote currency as the deposit currency."""
+        quote = self.quotes[position.symbol_id]
+        if position.trade_side == ProtoOATradeSide.BUY:
+            return int(round((quote.bid - position.price) * position.volume))
+        return int(round((position.price - quote.ask) * position.volume))
+
+    # Server-initiated events
+
+    def close_position(self, position_id: int) -> None:
+        """Closes a position as if its stop loss was hit, notifying the connections authorized on its account."""
+        position = self.positions.get(position_id)
+        if position is not None:
+            self.broadcast(position.account_id, self._close(position))
+
+    def drop_connections(self) -> None:
+        """Aborts every client connection, as a network failure would."""
+        for connection in list(self.connections):
+            connection.transport.abortConnection()
+
+    def broadcast(self, account_id: int, message) -> None:
+        """Sends an event to every connection authorized on an account."""
+        for connection in self.connections:
+            if account_id in connection.authorized:
+                connection.send_message(message)
+
+    def start_spot_flood(self, rate: float) -> None:
+        """Sends `rate` spot events per second per subscribed symbol, the same to every connection subscribed to it."""
+        self.stop_spot_flood()
+        per_run = max(1, round(rate * FLOOD_INTERVAL_SECONDS))
+        self._spot_flood = LoopingCall(self._send_spots, per_run)
+        self._spot_flood.clock = self.clock
+        self._spot_flood.start(FLOOD_INTERVAL_SECONDS, now=False)
+
+    def stop_spot_flood(self) -> None:
+        if self._spot_flood is not None and self._spot_flood.running:
+            self._spot_flood.stop()
+        self._spot_flood = None
+
+    def start_execution_flood(self, rate: float, symbol_id: int = 1) -> None:
+        """Sends `rate` unsolicited fill events per second to every authorized account."""
+        self.stop_execution_flood()
+        per_run = max(1, round(rate * FLOOD_INTERVAL_SECONDS))
+        self._execution_flood = LoopingCall(self._send_executions, per_run, symbol_id)
+        self._execution_flood.clock = self.clock
+        self._execution_flood.start(FLOOD_INTERVAL_SECONDS, now=False)
+
+    def stop_execution_flood(self) -> None:
+        if self._execution_flood is not None and self._execution_flood.running:
+            self._execution_flood.stop()
+        self._execution_flood = None
+
+    def _send_spots(self, per_run: int) -> None:
+        symbol_ids = set()
+        for connection in self.connections:
+            symbol_ids.update(connection.spot_symbols)
+        for _ in range(per_run):
+            for symbol_id in symbol_ids:
+                # Every connection subscribed to the symbol gets the same quote
+                quote = self.quotes[symbol_id]
+                quote.step(self.rng)
+                bid, ask = int(round(quote.bid * PRICE_SCALE)), int(round(quote.ask * PRICE_SCALE))
+                timestamp = int(time.time() * 1000)
+                for connection in self.connections:
+                    if symbol_id in connection.spot_symbols:
+                        connection.send_message(ProtoOASpotEvent(
+                            ctidTraderAccountId=next(iter(connection.authorized), 0),
+                            symbolId=symbol_id, bid=bid, ask=ask, timestamp=timestamp,
+                        ))
+
+    def _send_executions(self, per_run: int, symbol_id: int) -> None:
+        quote = self.quotes[symbol_id]
+        for _ in range(per_run):
+            for connection in self.connections:
+                for account_id in connection.authorized:
+                    position = _Position(next(self._ids), next(self._ids), account_id, symbol_id,
+                                         ProtoOATradeSide.BUY, quote.lot_size, quote.ask, int(time.time() * 1000))
+                    connection.send_message(self._execution_event(position, ProtoOAExecutionType.ORDER_FILLED,
+                                                                  ProtoOAOrderStatus.ORDER_STATUS_FILLED))
+
+    def _close(self, position: _Position) -> ProtoOAExecutionEvent:
+        del self.positions[position.position_id]
+        quote = self.quotes[position.symbol_id]
+        exit_price = quote.bid if position.trade_side == ProtoOATradeSide.BUY else quote.ask
+        pnl = self._pnl_cents(position)
+        account_id = position.account_id
+        self.balances[account_id] += pnl
+        self.balance_versions[account_id] += 1
+
+        event = self._execution_event(position, ProtoOAExecutionType.ORDER_FILLED,
+                                      ProtoOAOrderStatus.ORDER_STATUS_FILLED,
+                                      ProtoOAPositionStatus.POSITION_STATUS_CLOSED)
+        event.order.executionPrice = exit_price
+        event.order.closingOrder = True
+
+        now = int(time.time() * 1000)
+        deal = event.deal
+        deal.dealId = next(self._ids)
+        deal.orderId = position.order_id
+        deal.positionId = position.position_id
+        deal.volume = deal.filledVolume = position.volume
+        deal.symbolId = position.symbol_id
+        deal.createTimestamp = deal.executionTimestamp = now
+        deal.executionPrice = exit_price
+        deal.tradeSide = ProtoOATradeSide.SELL if position.trade_side == ProtoOATradeSide.BUY else ProtoOATradeSide.BUY
+        deal.dealStatus = ProtoOADealStatus.FILLED
+        deal.moneyDigits = 2
+        detail = deal.closePositionDetail
+        detail.entryPrice = position.price
+        detail.grossProfit = pnl
+        detail.swap = 0
+        detail.commission = 0
+        detail.balance = self.balances[account_id]
+        detail.balanceVersion = self.balance_versions[account_id]
+        detail.moneyDigits = 2
+        return event
+
+    def _execution_event(self, position: _Position, execution_type: int, order_status: int,
+                         position_status: int = ProtoOAPositionStatus.POSITION_STATUS_OPEN) -> ProtoOAExecutionEvent:
+        event = ProtoOAExecutionEvent(ctidTraderAccountId=position.account_id, executionType=execution_type)
+        trade_data = event.position.tradeData
+        trade_data.symbolId = position.symbol_id
+        trade_data.volume = position.volume
+        trade_data.tradeSide = position.trade_side
+        trade_data.openTimestamp = position.open_timestamp
+        event.position.positionId = position.position_id
+        event.position.positionStatus = position_status
+        event.position.swap = 0
+        event.position.price = position.price
+        if position.stop_loss:
+            event.position.stopLoss = position.stop_loss
+        if position.take_profit:
+            event.position.takeProfit = position.take_profit
+
+        event.order.orderId = position.order_id
+        event.order.tradeData.CopyFrom(trade_data)
+        event.order.orderType = ProtoOAOrderType.MARKET
+        event.order.orderStatus = order_status
+        event.order.positionId = position.position_id
+        if order_status == ProtoOAOrderStatus.ORDER_STATUS_FILLED:
+            event.order.executionPrice = position.price
+        return event
+
+
+def _error(error_code: str, description: str, account_id: int = 0) -> ProtoOAErrorRes:
+    error = ProtoOAErrorRes(errorCode=error_code, description=description)
+    if account_id:
+        error.ctidTraderAccountId = account_id
+    return error
+
+
+def listen(server: FakeOpenApiServer, port: int = DEFAULT_PORT, interface: str = "127.0.0.1"):
+    """Starts serving on a port (0 picks a free one); returns the listening port."""
+    from twisted.internet import reactor
+
+    return reactor.listenTCP(port, server, interface=interface)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the cTrader Open API server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before each response")
+    parser.add_argument("--spot-rate", type=float, default=0.0,
+                        help="Spot events per second per subscribed symbol")
+    parser.add_argument("--execution-rate", type=float, default=0.0,
+                        help="Unsolicited execution events per second per authorized account")
+    args = parser.parse_args()
+
+    from twisted.internet import reactor
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    server = FakeOpenApiServer(latency=args.latency)
+    port = listen(server, args.port, args.host)
+    if args.spot_rate:
+        server.start_spot_flood(args.spot_rate)
+    if args.execution_rate:
+        server.start_execution_flood(args.execution_rate)
+
+    def report():
+        logging.info(f"{len(server.connections)} connections, {server.received} messages received, "
+                     f"{server.sent} sent, {len(server.positions)} open positions.")
+
+    LoopingCall(report).start(5.0, now=False)
+    logging.info(f"cTrader Open API stand-in listening on {args.host}:{port.getHost().port}")
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
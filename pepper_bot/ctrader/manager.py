@@ -1,18 +1,75 @@
 import asyncio
+import dataclasses
 import logging
-from typing import Dict, Any
+import time
+from typing import Dict, Any, Callable, List, Optional, Tuple, Union
 from twisted.internet import defer, reactor
 
-from pepper_bot.ctrader.client import CTraderApiClient
+from pepper_bot.core.config import get_settings
+from pepper_bot.core.runtime import is_single_loop
+from pepper_bot.ctrader.client import CTraderApiClient, EXECUTION_EVENT
+from pepper_bot.ctrader.recorder import TickRecorder
+from pepper_bot.ctrader.redundant import RedundantClient, is_standby_enabled
+from pepper_bot.ctrader.sharding import ShardedClient, get_account_pairs, get_connection_count
+from pepper_bot.ctrader.symbols import SymbolCatalogue
+from pepper_bot.ctrader.tokens import TokenManager
+from pepper_bot.trading.journal import StateJournal
+from pepper_bot.trading.position_manager import PositionManager
+from pepper_bot.trading.reconcile import reconcile_positions
+
+# How long polled account figures are served from the cache
+ACCOUNT_CACHE_TTL_SECONDS = 5.0
+
+# Amounts without an explicit moneyDigits are in cents
+DEFAULT_MONEY_DIGITS = 2
+
+
+@dataclasses.dataclass(frozen=True)
+class AccountSnapshot:
+    """
+    Balance and equity of a trading account, in the deposit currency.
+    The balance follows execution events as they arrive; the unrealized P&L, and so
+    the equity, is as of updated_at (a time.monotonic() value).
+    """
+    account_id: int
+    is_live: bool
+    trader_login: int
+    balance: float
+    unrealized_pnl: float
+    balance_version: int
+    updated_at: float
+
+    @property
+    def equity(self) -> float:
+        return self.balance + self.unrealized_pnl
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.updated_at
+
 
 class CTraderManager:
     """
-    Manages the CTrader API client.
+    Manages the CTrader API client: one connection, a hot-standby pair of them
+    (CTRADER_STANDBY) or a pool with the account pairs spread across it (CTRADER_CONNECTIONS).
+    When the asyncio reactor is installed on the manager's loop, client calls are made
+    directly and their Deferreds awaited natively; otherwise they are marshalled to the
+    reactor thread and back.
     """
     def __init__(self):
         logging.info("Initializing CTraderManager.")
-        self.client: CTraderApiClient = None
+        self.client: Union[CTraderApiClient, RedundantClient, ShardedClient] = None
+        self.tokens: TokenManager = None
+        # The (BUY account, SELL account) pairs straddles are placed on
+        self.account_pairs: List[Tuple[int, int]] = []
+        self.symbols: SymbolCatalogue = None
+        self.recorder: TickRecorder = None
+        self.position_manager: PositionManager = None
+        self.journal: StateJournal = None
+        # Account snapshots by account id; replaced whole, so readers on any thread see consistent figures
+        self.accounts: Dict[int, AccountSnapshot] = {}
         self.loop = asyncio.get_event_loop()
+        self.single_loop = is_single_loop(self.loop)
         self.ready_future = self.loop.create_future()
         logging.info("CTraderManager initialized.")
 
@@ -22,48 +79,229 @@ class CTraderManager:
         Returns a Future that completes when the client is ready.
         """
         logging.info("CTraderManager starting...")
-        reactor.callFromThread(self._start_client)
+        if self.single_loop:
+            self._start_client()
+        else:
+            reactor.callFromThread(self._start_client)
         return self.ready_future
 
     def _start_client(self):
-        self.client = CTraderApiClient()
-        self.client.websocket_client.setConnectedCallback(self._on_client_connected)
-        self.client.connect()
-
-    def _on_client_connected(self, _):
-        """Callback for when a client connects."""
-        logging.info("Client connected, authenticating...")
-        d = self.client.authenticate_and_authorize()
-        d.addCallback(self._on_client_ready)
-
-    def _on_client_ready(self, _):
-        """Callback for when the client is fully authenticated and ready."""
+        self.tokens = TokenManager()
+        self.tokens.load()
+        connections = get_connection_count()
+        if connections > 1:
+            self.client = ShardedClient(connections, tokens=self.tokens, standby=is_standby_enabled())
+        elif is_standby_enabled():
+            self.client = RedundantClient(tokens=self.tokens)
+        else:
+            self.client = CTraderApiClient(tokens=self.tokens)
+        self.symbols = SymbolCatalogue()
+        if get_settings().record_ticks:
+            # Recordings are stored by symbol name, which is how the backtests look them up
+            self.recorder = TickRecorder(symbol_name=self._symbol_name)
+            self.recorder.attach(self.client.ticks)
+        self.client.register_handler(EXECUTION_EVENT, self._on_execution_event)
+        self.client.add_session_callback(self._on_client_ready)
+        # Cached tokens are used as they are; tokens of unknown age are refreshed before connecting
+        self.tokens.start().addCallback(lambda _: self.client.connect())
+
+    def _on_client_ready(self):
+        """Callback for when the client is fully authenticated and ready, on every (re)connection."""
         logging.info("Client is ready.")
-        self.loop.call_soon_threadsafe(self.ready_future.set_result, None)
+        if self.single_loop:
+            if not self.ready_future.done():
+                self.ready_future.set_result(None)
+        else:
+            self.loop.call_soon_threadsafe(_set_result, self.ready_future, None)
 
-    def get_trader_accounts(self):
-        future = asyncio.Future()
-        reactor.callFromThread(self._get_trader_accounts, future)
-        return future
+        if self.position_manager is not None:
+            # Execution events sent while the connection was down are lost; catch up from the positions
+            d = reconcile_positions(self.client, sorted(self.client.authorized_accounts), self.position_manager,
+                                    self.position_manager.symbols, self.account_pairs)
+            d.addErrback(lambda failure: logging.error(f"Reconcile after reconnecting failed: "
+                                                       f"{failure.getErrorMessage()}"))
 
-    def _get_trader_accounts(self, future):
-        d = self.client.get_account_list()
-        d.addCallback(lambda result: asyncio.get_running_loop().call_soon_threadsafe(future.set_result, result.traderAccount))
+    def _call(self, method: Callable, *args) -> asyncio.Future:
+        """Calls a client method returning a Deferred and returns an awaitable for its result."""
+        if self.single_loop:
+            return defer.maybeDeferred(method, *args).asFuture(self.loop)
 
-    def get_account_balance(self, ctid_trader_account_id: int):
-        future = asyncio.Future()
-        reactor.callFromThread(self._get_account_balance, ctid_trader_account_id, future)
+        future = self.loop.create_future()
+
+        def call():
+            d = defer.maybeDeferred(method, *args)
+            d.addCallbacks(
+                lambda result: self.loop.call_soon_threadsafe(_set_result, future, result),
+                lambda failure: self.loop.call_soon_threadsafe(_set_exception, future, failure.value),
+            )
+
+        reactor.callFromThread(call)
         return future
 
-    def _get_account_balance(self, ctid_trader_account_id, future):
-        d = self.client.get_account_balance(ctid_trader_account_id)
-        d.addCallback(lambda result: asyncio.get_running_loop().call_soon_threadsafe(future.set_result, result))
+    async def warm_start(self) -> Dict[str, int]:
+        """
+        Authorizes every trading account and restores the straddles left open by a
+        previous run from the state journal, then reconciles them with the accounts'
+        positions, resuming trailing on their winning legs.
+        Call once the client is ready and before accepting commands.
+        """
+        accounts = await self.get_trader_accounts()
+        account_ids = [account.ctidTraderAccountId for account in accounts]
+        self.account_pairs = get_account_pairs(account_ids)
+        await self._call(self._authorize_accounts, account_ids)
+        return await self._call(self._restore_positions, account_ids)
+
+    def _symbol_name(self, symbol_id: int) -> Optional[str]:
+        info = self.symbols.get(symbol_id)
+        return info.name if info is not None else None
+
+    def _authorize_accounts(self, account_ids: List[int]) -> defer.Deferred:
+        """Authorizes the given accounts concurrently, each on its connection. Reactor thread only."""
+        if isinstance(self.client, ShardedClient):
+            self.client.assign(self.account_pairs)
+        return defer.gatherResults([self.client.authorize_trading_account(account_id) for account_id in account_ids],
+                                   consumeErrors=True)
+
+    def _restore_positions(self, account_ids: List[int]) -> defer.Deferred:
+        """Loads the configured symbols, then reconciles the accounts' positions. Reactor thread only."""
+        symbols = self.symbols
+        names = [name for name, enabled in get_settings().pairs.items() if enabled]
+        d = symbols.load(self.client, account_ids[0], names) if account_ids else defer.succeed([])
+        # Cached symbols are still usable if the broker could not be asked for the rest
+        d.addErrback(lambda failure: logging.warning(f"Could not load symbol details: {failure.getErrorMessage()}"))
+
+        def reconcile(_):
+            if not self.account_pairs:
+                logging.info("No pair of trading accounts; no straddles to restore.")
+                return {}
+            # One PositionManager for every pair: straddles carry their own accounts
+            self.journal = StateJournal()
+            self.position_manager = PositionManager(self.client, *self.account_pairs[0], symbols=symbols,
+                                                    journal=self.journal)
+            self.position_manager.recover()
+            return reconcile_positions(self.client, account_ids, self.position_manager, symbols, self.account_pairs)
+
+        d.addCallback(reconcile)
+        return d
+
+    def stop(self):
+        """
+        Writes out and compacts the state journal, writes out the recorded ticks and
+        stops refreshing tokens. Call on shutdown.
+        """
+        if self.journal is not None:
+            self.journal.stop()
+        if self.recorder is not None:
+            self.recorder.stop()
+        if self.tokens is not None:
+            if self.single_loop:
+                self.tokens.stop()
+            else:
+                reactor.callFromThread(self.tokens.stop)
+
+    def get_trader_accounts(self):
+        return self._call(self.client.get_account_list)
+
+    def get_account_balance(self, ctid_trader_account_id: int):
+        return self._call(self.client.get_account_balance, ctid_trader_account_id)
 
     def authorize_trading_account(self, ctid_trader_account_id: int):
-        future = asyncio.Future()
-        reactor.callFromThread(self._authorize_trading_account, ctid_trader_account_id, future)
-        return future
+        return self._call(self.client.authorize_trading_account, ctid_trader_account_id)
+
+    async def get_account_snapshots(self, max_age: float = ACCOUNT_CACHE_TTL_SECONDS) -> List[AccountSnapshot]:
+        """
+        Returns a snapshot of every trading account. Accounts whose snapshot is older
+        than max_age are refreshed, all with concurrent requests in one round trip.
+        """
+        accounts = self.client.trader_accounts or await self.get_trader_accounts()
+        stale = [account for account in accounts
+                 if account.ctidTraderAccountId not in self.accounts
+                 or self.accounts[account.ctidTraderAccountId].age > max_age]
+        if stale:
+            await self._call(self._refresh_accounts, stale)
+        return [self.accounts[account.ctidTraderAccountId] for account in accounts
+                if account.ctidTraderAccountId in self.accounts]
+
+    async def get_account_snapshot(self, ctid_trader_account_id: int,
+                                   max_age: float = ACCOUNT_CACHE_TTL_SECONDS) -> Optional[AccountSnapshot]:
+        """Returns the snapshot of one account, refreshing it if it is older than max_age."""
+        snapshot = self.accounts.get(ctid_trader_account_id)
+        if snapshot is None or snapshot.age > max_age:
+            for account in self.client.trader_accounts or await self.get_trader_accounts():
+                if account.ctidTraderAccountId == ctid_trader_account_id:
+                    await self._call(self._refresh_accounts, [account])
+                    break
+        return self.accounts.get(ctid_trader_account_id)
+
+    def _refresh_accounts(self, accounts: List[Any]) -> defer.Deferred:
+        """Requests the trader details and unrealized P&L of the given accounts concurrently. Reactor thread only."""
+        requests = []
+        for account in accounts:
+            account_id = account.ctidTraderAccountId
+            d = defer.gatherResults([self.client.get_trader(account_id), self.client.get_unrealized_pnl(account_id)],
+                                    consumeErrors=True)
+            d.addCallbacks(self._on_account_refreshed, self._on_account_refresh_failed,
+                           callbackArgs=(account,), errbackArgs=(account_id,))
+            requests.append(d)
+        return defer.DeferredList(requests)
+
+    def _on_account_refreshed(self, results: List[Any], account: Any) -> AccountSnapshot:
+        trader, pnl = results
+        scale = 10 ** (trader.moneyDigits or DEFAULT_MONEY_DIGITS)
+        pnl_scale = 10 ** (pnl.moneyDigits or DEFAULT_MONEY_DIGITS)
+        snapshot = AccountSnapshot(
+            account_id=account.ctidTraderAccountId,
+            is_live=account.isLive,
+            trader_login=account.traderLogin,
+            balance=trader.balance / scale,
+            unrealized_pnl=sum(p.netUnrealizedPnL for p in pnl.positionUnrealizedPnL) / pnl_scale,
+            balance_version=trader.balanceVersion,
+            updated_at=time.monotonic(),
+        )
+        self.accounts[snapshot.account_id] = snapshot
+        return snapshot
+
+    def _on_account_refresh_failed(self, failure, account_id: int):
+        logging.warning(f"Could not refresh account {account_id}: {failure.getErrorMessage()}")
+
+    def _on_execution_event(self, event: Any):
+        """Keeps cached balances current from closing deals and balance operations."""
+        if event.deal.HasField("closePositionDetail"):
+            detail = event.deal.closePositionDetail
+            self._update_balance(event.ctidTraderAccountId, detail.balance, detail.balanceVersion,
+                                 detail.moneyDigits or event.deal.moneyDigits, realized=True)
+        elif event.HasField("depositWithdraw"):
+            operation = event.depositWithdraw
+            self._update_balance(event.ctidTraderAccountId, operation.balance, operation.balanceVersion,
+                                 operation.moneyDigits, realized=False)
+
+    def _update_balance(self, account_id: int, balance: int, balance_version: int, money_digits: int,
+                        realized: bool):
+        """
+        Applies a new balance to an account's snapshot. realized is True when the change
+        is P&L realized by a close, False for deposits and withdrawals.
+        """
+        snapshot = self.accounts.get(account_id)
+        if snapshot is None or (balance_version and balance_version <= snapshot.balance_version):
+            return
+        new_balance = balance / 10 ** (money_digits or DEFAULT_MONEY_DIGITS)
+        unrealized_pnl = snapshot.unrealized_pnl
+        if realized:
+            # A close moves P&L from unrealized to balance, so the equity stays where it was
+            unrealized_pnl -= new_balance - snapshot.balance
+        self.accounts[account_id] = dataclasses.replace(
+            snapshot,
+            balance=new_balance,
+            unrealized_pnl=unrealized_pnl,
+            balance_version=balance_version or snapshot.balance_version,
+        )
+
+
+def _set_result(future: asyncio.Future, result: Any):
+    if not future.done():
+        future.set_result(result)
+
 
-    def _authorize_trading_account(self, ctid_trader_account_id, future):
-        d = self.client.authorize_trading__account(ctid_trader_account_id)
-        d.addCallback(lambda result: asyncio.get_running_loop().call_soon_threadsafe(future.set_result, result))
+def _set_exception(future: asyncio.Future, exception: BaseException):
+    if not future.done():
+        future.set_exception(exception)
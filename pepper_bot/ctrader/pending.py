@@ -0,0 +1,207 @@
+from typing import Collection, Dict, List, Optional, Set
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import LoopingCall
+
+from pepper_bot.core import metrics
+from ctrader_open_api.messages.OpenApiCommonModelMessages_pb2 import ProtoPayloadType
+from ctrader_open_api.messages.OpenApiModelMessages_pb2 import ProtoOAPayloadType
+
+DEFAULT_TIMEOUT = 10.0
+WHEEL_TICK = 0.25
+WHEEL_SIZE = 256
+
+
+_payload_type_names: Dict[int, str] = {}
+
+
+def payload_type_name(payload_type: int) -> str:
+    """Returns the enum name of a payload type (e.g. PROTO_OA_NEW_ORDER_REQ), for logs and metric labels."""
+    name = _payload_type_names.get(payload_type)
+    if name is None:
+        for enum in (ProtoOAPayloadType, ProtoPayloadType):
+            if payload_type in enum.values():
+                name = enum.Name(payload_type)
+                break
+        else:
+            name = str(payload_type)
+        _payload_type_names[payload_type] = name
+    return name
+
+
+class RequestTimeoutError(TimeoutError):
+    """Raised into a request's Deferred when no response arrived before its deadline."""
+
+
+class PendingRequest:
+    """A request waiting for its response."""
+    __slots__ = ("client_msg_id", "payload_type", "account_id", "position_id", "order_id", "deferred",
+                 "deadline_tick", "sent_at")
+
+    def __init__(self, client_msg_id: str, payload_type: int, account_id: int, deadline_tick: int, sent_at: float,
+                 position_id: int = 0, order_id: int = 0):
+        self.client_msg_id = client_msg_id
+        self.payload_type = payload_type
+        self.account_id = account_id
+        # The position or order the request acts on, 0 if none
+        self.position_id = position_id
+        self.order_id = order_id
+        self.deferred = Deferred()
+        self.deadline_tick = deadline_tick
+        self.sent_at = sent_at
+
+
+class RequestRegistry:
+    """
+    Tracks outstanding requests by clientMsgId and expires them in bulk with a hashed
+    timing wheel: each request is filed in the slot of its deadline tick, and every
+    tick only that slot is inspected, however many requests are outstanding.
+    """
+
+    def __init__(self, clock=None, default_timeout: float = DEFAULT_TIMEOUT,
+                 tick: float = WHEEL_TICK, wheel_size: int = WHEEL_SIZE):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.default_timeout = default_timeout
+        self.tick = tick
+        self._wheel: List[Set[str]] = [set() for _ in range(wheel_size)]
+        self._current_tick = 0
+        self._ticker: Optional[LoopingCall] = None
+
+        self._requests: Dict[str, PendingRequest] = {}
+        # Per account, in send order, for correlating errors that carry no clientMsgId
+        self._by_account: Dict[int, Dict[str, PendingRequest]] = {}
+
+        self.matched = 0
+        self.timed_out = 0
+        self.errored = 0
+        # Round-trip histograms and timeout counters per request payload type
+        self._round_trips: Dict[int, metrics.LatencyHistogram] = {}
+        self._timeouts: Dict[int, metrics.Counter] = {}
+
+    @property
+    def outstanding(self) -> int:
+        return len(self._requests)
+
+    def __contains__(self, client_msg_id: str) -> bool:
+        return client_msg_id in self._requests
+
+    def add(self, client_msg_id: str, payload_type: int, account_id: int = 0, timeout: float = None,
+            position_id: int = 0, order_id: int = 0) -> Deferred:
+        """
+        Registers a request and returns the Deferred that fires with its response.
+        position_id and order_id name what the request acts on, for matching errors.
+        """
+        timeout = self.default_timeout if timeout is None else timeout
+        deadline_tick = self._current_tick + max(1, int(-(-timeout // self.tick)))
+        request = PendingRequest(client_msg_id, payload_type, account_id, deadline_tick, self.clock.seconds(),
+                                 position_id, order_id)
+
+        self._requests[client_msg_id] = request
+        self._by_account.setdefault(account_id, {})[client_msg_id] = request
+        self._wheel[deadline_tick % len(self._wheel)].add(client_msg_id)
+
+        if self._ticker is None or not self._ticker.running:
+            self._ticker = LoopingCall(self._advance)
+            self._ticker.clock = self.clock
+            self._ticker.start(self.tick, now=False)
+        return request.deferred
+
+    def _remove(self, client_msg_id: str) -> Optional[PendingRequest]:
+        request = self._requests.pop(client_msg_id, None)
+        if request is None:
+            return None
+        self._wheel[request.deadline_tick % len(self._wheel)].discard(client_msg_id)
+        account_requests = self._by_account.get(request.account_id)
+        if account_requests is not None:
+            account_requests.pop(client_msg_id, None)
+            if not account_requests:
+                del self._by_account[request.account_id]
+        return request
+
+    def match(self, client_msg_id: str) -> Optional[PendingRequest]:
+        """Removes and returns the request a response belongs to, if it is still outstanding."""
+        request = self._remove(client_msg_id)
+        if request is not None:
+            self.matched += 1
+            self._round_trip(request.payload_type).record(self.clock.seconds() - request.sent_at)
+        return request
+
+    def _round_trip(self, payload_type: int) -> metrics.LatencyHistogram:
+        histogram = self._round_trips.get(payload_type)
+        if histogram is None:
+            histogram = self._round_trips[payload_type] = metrics.histogram(
+                "ctrader_request_seconds", "Request to response time per request payload type",
+                payload_type=payload_type_name(payload_type))
+        return histogram
+
+    def match_error(self, account_id: int, payload_types: Collection[int] = None, position_id: int = 0,
+                    order_id: int = 0) -> Optional[PendingRequest]:
+        """
+        Removes and returns the request of an account (optionally restricted to some
+        request payload types) an error sent without a clientMsgId belongs to: the oldest
+        one acting on the error's position or order, else the oldest one not acting on
+        another position or order.
+        """
+        account_requests = self._by_account.get(account_id)
+        if not account_requests:
+            return None
+        candidate = None
+        for request in account_requests.values():
+            if payload_types is not None and request.payload_type not in payload_types:
+                continue
+            if ((position_id and request.position_id == position_id)
+                    or (order_id and request.order_id == order_id)):
+                candidate = request
+                break
+            if candidate is None and not ((position_id and request.position_id)
+                                         or (order_id and request.order_id)):
+                candidate = request
+        if candidate is None:
+            return None
+        self.errored += 1
+        return self._remove(candidate.client_msg_id)
+
+    def cancel(self, client_msg_id: str) -> None:
+        """Forgets a request without firing its Deferred."""
+        self._remove(client_msg_id)
+
+    def fail_all(self, exception: Exception) -> None:
+        """Errbacks every outstanding request, e.g. when the connection is lost."""
+        requests = list(self._requests.values())
+        self._requests.clear()
+        self._by_account.clear()
+        for slot in self._wheel:
+            slot.clear()
+        for request in requests:
+            request.deferred.errback(exception)
+
+    def _advance(self):
+        self._current_tick += 1
+        slot = self._wheel[self._current_tick % len(self._wheel)]
+        if slot:
+            expired = [self._requests[i] for i in slot if self._requests[i].deadline_tick <= self._current_tick]
+            for request in expired:
+                self._remove(request.client_msg_id)
+                self.timed_out += 1
+                timeouts = self._timeouts.get(request.payload_type)
+                if timeouts is None:
+                    timeouts = self._timeouts[request.payload_type] = metrics.counter(
+                        "ctrader_request_timeouts_total", "Requests that got no response before their deadline",
+                        payload_type=payload_type_name(request.payload_type))
+                timeouts.inc()
+                elapsed = self.clock.seconds() - request.sent_at
+                request.deferred.errback(RequestTimeoutError(
+                    f"No response to request {request.client_msg_id} (payload type {request.payload_type}) "
+                    f"after {elapsed:.1f}s"))
+        if not self._requests:
+            self._ticker.stop()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "outstanding": self.outstanding,
+            "matched": self.matched,
+            "timed_out": self.timed_out,
+            "errored": self.errored,
+        }
@@ -0,0 +1,195 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from typing import BinaryIO, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from pepper_bot.ctrader.ticks import TickRing, TickStream
+
+# Build the absolute path to the default recording directory
+TICKS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "core", "ticks"))
+
+# File layout: a 16 byte header followed by fixed-width little-endian records of
+# (timestamp in ms since the epoch, bid, ask)
+MAGIC = b"PTCK"
+VERSION = 1
+HEADER = struct.Struct("<4sIII")
+RECORD = struct.Struct("<qdd")
+HEADER_SIZE = HEADER.size
+RECORD_SIZE = RECORD.size
+
+FLUSH_INTERVAL_SECONDS = 0.5
+
+# NumPy dtype matching RECORD, built on first use so NumPy stays optional
+_dtype = None
+
+
+def tick_file_path(directory: str, symbol: str, day: str) -> str:
+    """Returns the file holding the ticks of a symbol on a 'YYYY-MM-DD' (UTC) day."""
+    return os.path.join(directory, symbol, f"{day}.ticks")
+
+
+def _day_of(timestamp_ms: int) -> str:
+    return datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+class TickRecorder:
+    """
+    Appends every tick seen by a TickStream to per-symbol, per-day binary files.
+    The tick callback only appends to an in-memory deque; a background thread packs
+    and writes the records, so the reactor thread never waits on the disk.
+    """
+
+    def __init__(self, directory: str = TICKS_DIR, symbol_name: Callable[[int], Optional[str]] = None,
+                 flush_interval: float = FLUSH_INTERVAL_SECONDS):
+        self.directory = directory
+        # Maps a symbol id to the name used for its directory; falls back to the id
+        self.symbol_name = symbol_name
+        self.flush_interval = flush_interval
+        self._pending: Deque[Tuple[int, int, float, float]] = deque()
+        self._files: Dict[Tuple[int, str], BinaryIO] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._stream: Optional[TickStream] = None
+        self.recorded = 0
+
+    def attach(self, stream: TickStream) -> None:
+        """Starts recording the ticks of a stream."""
+        self._stream = stream
+        stream.subscribe(self.on_tick)
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="tick-recorder", daemon=True)
+            self._thread.start()
+
+    def on_tick(self, ring: TickRing) -> None:
+        # deque.append is atomic, so no lock is needed between the reactor and the writer
+        self._pending.append((ring.symbol_id, ring.timestamp, ring.bid, ring.ask))
+
+    def stop(self) -> None:
+        """Stops recording and writes out everything still queued."""
+        if self._stream is not None:
+            self._stream.unsubscribe(self.on_tick)
+            self._stream = None
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self._close_files()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def flush(self) -> None:
+        """Writes the queued ticks to their files. Called from the writer thread."""
+        pending = self._pending
+        if not pending:
+            return
+        batches: Dict[Tuple[int, str], bytearray] = {}
+        try:
+            while True:
+                symbol_id, timestamp, bid, ask = pending.popleft()
+                key = (symbol_id, _day_of(timestamp))
+                buffer = batches.get(key)
+                if buffer is None:
+                    buffer = batches[key] = bytearray()
+                buffer += RECORD.pack(timestamp, bid, ask)
+        except IndexError:
+            pass
+
+        for key, buffer in batches.items():
+            try:
+                f = self._file(*key)
+                f.write(buffer)
+                f.flush()
+                self.recorded += len(buffer) // RECORD_SIZE
+            except OSError as e:
+                logging.error(f"Failed to record ticks for symbol {key[0]}: {e}")
+
+    def _file(self, symbol_id: int, day: str) -> BinaryIO:
+        f = self._files.get((symbol_id, day))
+        if f is not None:
+            return f
+
+        # A new day for this symbol: close the previous day's file
+        for old_key in [k for k in self._files if k[0] == symbol_id]:
+            self._files.pop(old_key).close()
+
+        name = (self.symbol_name(symbol_id) if self.symbol_name else None) or str(symbol_id)
+        path = tick_file_path(self.directory, name, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = open(path, "ab")
+        if f.tell() == 0:
+            f.write(HEADER.pack(MAGIC, VERSION, RECORD_SIZE, 0))
+        self._files[(symbol_id, day)] = f
+        return f
+
+    def _close_files(self):
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+
+def _check_header(data, path: str) -> None:
+    if len(data) < HEADER_SIZE:
+        raise ValueError(f"{path} is not a tick file (too short)")
+    magic, version, record_size, _ = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION or record_size != RECORD_SIZE:
+        raise ValueError(f"{path} is not a version {VERSION} tick file")
+
+
+def iter_ticks(path: str) -> Iterator[Tuple[int, float, float]]:
+    """Yields (timestamp, bid, ask) records from a tick file without needing NumPy."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= HEADER_SIZE:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            _check_header(data, path)
+            # Ignore a trailing partial record left by a write in progress
+            end = HEADER_SIZE + (len(data) - HEADER_SIZE) // RECORD_SIZE * RECORD_SIZE
+            unpack_from = RECORD.unpack_from
+            for offset in range(HEADER_SIZE, end, RECORD_SIZE):
+                yield unpack_from(data, offset)
+
+
+def read_ticks(path: str):
+    """
+    Maps a tick file into memory and returns it as a read-only NumPy structured array
+    with 'timestamp', 'bid' and 'ask' fields; nothing is parsed or copied up front.
+    """
+    global _dtype
+    try:
+        import numpy as np
+    except ImportError as e:
+        raise ImportError("NumPy is required to read tick files as arrays; use iter_ticks instead") from e
+    if _dtype is None:
+        _dtype = np.dtype([("timestamp", "<i8"), ("bid", "<f8"), ("ask", "<f8")])
+
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        _check_header(f.read(HEADER_SIZE), path)
+    count = (size - HEADER_SIZE) // RECORD_SIZE
+    if count == 0:
+        return np.empty(0, dtype=_dtype)
+    return np.memmap(path, dtype=_dtype, mode="r", offset=HEADER_SIZE, shape=(count,))
+
+
+def list_tick_files(directory: str, symbol: str, start_day: str = None, end_day: str = None) -> List[str]:
+    """Returns the tick files of a symbol between two 'YYYY-MM-DD' days (inclusive), oldest first."""
+    symbol_dir = os.path.join(directory, symbol)
+    if not os.path.isdir(symbol_dir):
+        return []
+    paths = []
+    for name in sorted(os.listdir(symbol_dir)):
+        if not name.endswith(".ticks"):
+            continue
+        day = name[:-len(".ticks")]
+        if (start_day and day < start_day) or (end_day and day > end_day):
+            continue
+        paths.append(os.path.join(symbol_dir, name))
+    return paths
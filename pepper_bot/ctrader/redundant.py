@@ -0,0 +1,245 @@
+import logging
+import os
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+from twisted.internet.defer import Deferred
+
+from pepper_bot.core import metrics
+from pepper_bot.ctrader.client import CTraderApiClient, MESSAGE_CLASSES, EXECUTION_EVENT
+from pepper_bot.ctrader.events import EventBus, Subscription
+from pepper_bot.ctrader.ticks import PRICE_SCALE, TickStream
+from pepper_bot.ctrader.tokens import TokenManager
+
+# Set to 1 to run a second session as a hot standby, e.g. CTRADER_STANDBY=1
+STANDBY_ENV_VAR = "CTRADER_STANDBY"
+
+# How many recent events are remembered to recognise their copy from the other session
+DEDUPE_WINDOW = 4096
+
+
+def is_standby_enabled() -> bool:
+    return os.environ.get(STANDBY_ENV_VAR, "").strip().lower() in ("1", "true", "yes", "on")
+
+
+class DedupingTickStream(TickStream):
+    """
+    A TickStream fed by two sessions: a tick is dropped if it is older than the
+    symbol's latest, or the same quote at the same time, i.e. the other session's copy.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.duplicates = metrics.counter("ctrader_duplicate_spots_total",
+                                          "Spot events already seen on the other session")
+
+    def on_spot_event(self, event) -> None:
+        ring = self.latest(event.symbolId)
+        if ring is not None and event.timestamp:
+            if event.timestamp < ring.timestamp or (
+                    event.timestamp == ring.timestamp
+                    and (not event.bid or event.bid / PRICE_SCALE == ring.bid)
+                    and (not event.ask or event.ask / PRICE_SCALE == ring.ask)):
+                self.duplicates.inc()
+                return
+        super().on_spot_event(event)
+
+
+def _execution_key(event: Any) -> Tuple:
+    # Execution events carry no sequence number; these ids and timestamps tell them apart
+    return (event.ctidTraderAccountId, event.executionType, event.order.orderId, event.order.utcLastUpdateTimestamp,
+            event.position.positionId, event.position.utcLastUpdateTimestamp, event.deal.dealId)
+
+
+class RedundantClient:
+    """
+    Two authenticated sessions to cTrader, a primary and a hot standby, behind the
+    CTraderApiClient interface. Both sessions authorize the same accounts and subscribe
+    to the same spots, and every event is delivered once, whichever session has it first.
+    Requests go to the primary while it is healthy and to the standby as soon as the
+    primary disconnects or goes quiet (see ConnectionSupervisor), so orders and trailing
+    amends keep flowing while the primary reconnects.
+    """
+
+    def __init__(self, primary: CTraderApiClient = None, standby: CTraderApiClient = None,
+                 tokens: TokenManager = None, ticks: DedupingTickStream = None):
+        if tokens is None:
+            tokens = TokenManager()
+            tokens.load()
+        self.tokens = tokens
+        self.ticks = ticks if ticks is not None else DedupingTickStream()
+        self.primary = primary or CTraderApiClient(ticks=self.ticks, tokens=tokens)
+        self.standby = standby or CTraderApiClient(ticks=self.ticks, tokens=tokens)
+        self.clients = (self.primary, self.standby)
+
+        # Fed by one deduplicating relay per payload type on each session
+        self.events = EventBus(MESSAGE_CLASSES)
+        self._relays: Dict[int, List[Subscription]] = {}
+        self._seen: Dict[Tuple, None] = {}
+        self._session_callbacks: List[Callable[[], None]] = []
+        self._on_standby = False
+        self._duplicates = metrics.counter("ctrader_duplicate_events_total", "Events already seen on the other session")
+        self._failovers = metrics.counter("ctrader_failovers_total", "Switches of request traffic between sessions")
+
+        for client in self.clients:
+            client.add_session_callback(lambda client=client: self._on_session(client))
+
+    def connect(self):
+        for client in self.clients:
+            client.connect()
+
+    def _other(self, client: CTraderApiClient) -> CTraderApiClient:
+        return self.standby if client is self.primary else self.primary
+
+    def _active(self) -> CTraderApiClient:
+        """The session requests go to: the primary while healthy, otherwise the standby if it is."""
+        on_standby = not self.primary.is_healthy() and self.standby.is_healthy()
+        if on_standby != self._on_standby:
+            self._on_standby = on_standby
+            self._failovers.inc()
+            if on_standby:
+                logging.warning("Primary cTrader session is down or quiet; sending requests through the standby.")
+            else:
+                logging.info("Primary cTrader session is healthy again; sending requests through it.")
+        return self.standby if on_standby else self.primary
+
+    def is_ready(self):
+        return self.primary.is_ready() or self.standby.is_ready()
+
+    # Sessions
+
+    def add_session_callback(self, callback: Callable[[], None]) -> None:
+        """
+        Calls callback when a session is established while the other one is not healthy,
+        i.e. at startup and after both sessions were down, when events may have been missed.
+        """
+        self._session_callbacks.append(callback)
+
+    def _on_session(self, client: CTraderApiClient):
+        if self._other(client).is_healthy():
+            logging.info("cTrader session established; the other session covered the gap.")
+            return
+        for callback in list(self._session_callbacks):
+            callback()
+
+    @property
+    def trader_accounts(self) -> List[Any]:
+        return self.primary.trader_accounts or self.standby.trader_accounts
+
+    @property
+    def authorized_accounts(self) -> Set[int]:
+        return self.primary.authorized_accounts | self.standby.authorized_accounts
+
+    def authorize_trading_account(self, ctid_trader_account_id: int) -> Deferred:
+        """Authorizes an account on both sessions; fires with the active session's response."""
+        return self._on_both(lambda client: client.authorize_trading_account(ctid_trader_account_id),
+                             lambda client: client.authorized_accounts.add(ctid_trader_account_id),
+                             f"authorize account {ctid_trader_account_id}")
+
+    def subscribe_to_ticks(self, ctid_trader_account_id: int, symbol_id: int) -> Deferred:
+        """Subscribes to spot events on both sessions; fires with the active session's response."""
+        return self._on_both(lambda client: client.subscribe_to_ticks(ctid_trader_account_id, symbol_id),
+                             lambda client: client.spot_subscriptions.setdefault(ctid_trader_account_id,
+                                                                                 set()).add(symbol_id),
+                             f"subscribe to symbol {symbol_id}")
+
+    def _on_both(self, request: Callable[[CTraderApiClient], Deferred], remember: Callable[[CTraderApiClient], Any],
+                 description: str) -> Deferred:
+        active = self._active()
+        other = self._other(active)
+
+        def on_failed(failure):
+            # Replayed with the rest of the session when the other session next connects
+            remember(other)
+            logging.warning(f"The other cTrader session could not {description}: {failure.getErrorMessage()}")
+
+        request(other).addErrback(on_failed)
+        return request(active)
+
+    # Events
+
+    def register_handler(self, payload_type: int, handler: Callable) -> None:
+        """Registers a handler that is called once per event, whichever session receives it first."""
+        self.subscribe(payload_type, handler)
+
+    def unregister_handler(self, payload_type: int, handler: Callable) -> None:
+        self.events.unsubscribe_handler(payload_type, handler)
+        self._drop_relay(payload_type)
+
+    def subscribe(self, payload_type: int, handler: Callable, account_id: int = None, symbol_id: int = None,
+                  position_id: int = None, name: str = None, timed: bool = True) -> Subscription:
+        """Like CTraderApiClient.subscribe, calling handler once per event whichever session receives it first."""
+        subscription = self.events.subscribe(payload_type, handler, account_id, symbol_id, position_id, name, timed)
+        if payload_type not in self._relays:
+            relay = self._relay(payload_type)
+            self._relays[payload_type] = [client.events.subscribe(payload_type, relay, name="RedundantClient relay",
+                                                                  timed=False)
+                                          for client in self.clients]
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self.events.unsubscribe(subscription)
+        self._drop_relay(subscription.payload_type)
+
+    def subscribe_to_execution_events(self, callback: Callable, account_id: int = None, symbol_id: int = None,
+                                      position_id: int = None) -> Subscription:
+        return self.subscribe(EXECUTION_EVENT, callback, account_id, symbol_id, position_id)
+
+    def _drop_relay(self, payload_type: int) -> None:
+        # Once nothing is subscribed to a payload type, the sessions can skip decoding it again
+        if payload_type not in self.events.topics and payload_type in self._relays:
+            for client, relay in zip(self.clients, self._relays.pop(payload_type)):
+                client.events.unsubscribe(relay)
+
+    def _relay(self, payload_type: int) -> Callable:
+        seen = self._seen
+        duplicates = self._duplicates
+        publish = self.events.publish
+        if payload_type == EXECUTION_EVENT:
+            key_of = _execution_key
+        else:
+            key_of = lambda msg: (payload_type, msg.SerializeToString())
+
+        def relay(msg):
+            key = key_of(msg)
+            if key in seen:
+                duplicates.inc()
+                return
+            seen[key] = None
+            if len(seen) > DEDUPE_WINDOW:
+                del seen[next(iter(seen))]
+            publish(payload_type, msg)
+
+        return relay
+
+    # Requests, sent through the active session
+
+    def send_payload(self, payload_type: int, payload: bytes, account_id: int = 0, timeout: float = None,
+                     position_id: int = 0, order_id: int = 0) -> Deferred:
+        return self._active().send_payload(payload_type, payload, account_id, timeout, position_id, order_id)
+
+    def place_order(self, *args, **kwargs) -> Deferred:
+        return self._active().place_order(*args, **kwargs)
+
+    def modify_position(self, *args, **kwargs) -> Deferred:
+        return self._active().modify_position(*args, **kwargs)
+
+    def reconcile(self, ctid_trader_account_id: int) -> Deferred:
+        return self._active().reconcile(ctid_trader_account_id)
+
+    def get_account_list(self) -> Deferred:
+        return self._active().get_account_list()
+
+    def get_trader(self, ctid_trader_account_id: int) -> Deferred:
+        return self._active().get_trader(ctid_trader_account_id)
+
+    def get_unrealized_pnl(self, ctid_trader_account_id: int) -> Deferred:
+        return self._active().get_unrealized_pnl(ctid_trader_account_id)
+
+    def get_account_balance(self, ctid_trader_account_id: int) -> Deferred:
+        return self._active().get_account_balance(ctid_trader_account_id)
+
+    def get_symbols(self, ctid_trader_account_id: int) -> Deferred:
+        return self._active().get_symbols(ctid_trader_account_id)
+
+    def get_symbols_by_id(self, ctid_trader_account_id: int, symbol_ids: List[int]) -> Deferred:
+        return self._active().get_symbols_by_id(ctid_trader_account_id, symbol_ids)
@@ -0,0 +1,212 @@
+import logging
+import os
+from typing import Any, Callable, Dict, Iterable, List, Set, Tuple, Union
+
+from twisted.internet.defer import Deferred, succeed
+
+from pepper_bot.ctrader.client import CTraderApiClient, EXECUTION_EVENT, MESSAGE_CLASSES
+from pepper_bot.ctrader.events import EventBus, Subscription
+from pepper_bot.ctrader.redundant import DedupingTickStream, RedundantClient
+from pepper_bot.ctrader.tokens import TokenManager
+
+# How many connections the accounts are spread across, e.g. CTRADER_CONNECTIONS=4
+CONNECTIONS_ENV_VAR = "CTRADER_CONNECTIONS"
+
+# The account pairs straddles are placed on, as BUY:SELL account ids separated by commas,
+# e.g. PEPPER_ACCOUNT_PAIRS=1001:1002,1003:1004. By default consecutive accounts are paired.
+ACCOUNT_PAIRS_ENV_VAR = "PEPPER_ACCOUNT_PAIRS"
+
+AccountPair = Tuple[int, int]
+
+
+def get_connection_count() -> int:
+    value = os.environ.get(CONNECTIONS_ENV_VAR, "").strip()
+    return max(1, int(value)) if value else 1
+
+
+def get_account_pairs(account_ids: Iterable[int]) -> List[AccountPair]:
+    """
+    Returns the configured account pairs among account_ids, or pairs them in order
+    (first with second, third with fourth...) if none are configured.
+    """
+    account_ids = list(account_ids)
+    value = os.environ.get(ACCOUNT_PAIRS_ENV_VAR, "").strip()
+    if not value:
+        return list(zip(account_ids[0::2], account_ids[1::2]))
+
+    known = set(account_ids)
+    pairs = []
+    for item in value.split(","):
+        buy_id, sell_id = (int(part) for part in item.split(":"))
+        if buy_id in known and sell_id in known:
+            pairs.append((buy_id, sell_id))
+        else:
+            logging.warning(f"Ignoring account pair {buy_id}:{sell_id}: not an account of this access token.")
+    return pairs
+
+
+class ShardedClient:
+    """
+    A pool of cTrader connections behind the CTraderApiClient interface, each carrying
+    the traffic of some of the accounts: both accounts of a pair go to the same
+    connection, and the pairs are spread across the connections round robin. Requests
+    for an account go to its connection; events from every connection reach the
+    handlers, and spots are deduplicated across connections in one shared tick stream.
+    With standby set, every connection is a RedundantClient.
+    """
+
+    def __init__(self, size: int, tokens: TokenManager = None, standby: bool = False):
+        if tokens is None:
+            tokens = TokenManager()
+            tokens.load()
+        self.tokens = tokens
+        self.ticks = DedupingTickStream()
+        if standby:
+            self.shards: List[Union[CTraderApiClient, RedundantClient]] = [
+                RedundantClient(tokens=tokens, ticks=self.ticks) for _ in range(size)]
+        else:
+            self.shards = [CTraderApiClient(ticks=self.ticks, tokens=tokens) for _ in range(size)]
+
+        # Fed by one relay per payload type on each connection
+        self.events = EventBus(MESSAGE_CLASSES)
+        self._relays: Dict[int, List[Subscription]] = {}
+        self._shard_of: Dict[int, Union[CTraderApiClient, RedundantClient]] = {}
+        self._spot_symbols: Set[int] = set()
+        self._session_callbacks: List[Callable[[], None]] = []
+        self._connected: Set[int] = set()
+
+        for index, shard in enumerate(self.shards):
+            shard.add_session_callback(lambda index=index: self._on_session(index))
+
+    def connect(self):
+        for shard in self.shards:
+            shard.connect()
+
+    def is_ready(self):
+        return all(shard.is_ready() for shard in self.shards)
+
+    # Account placement
+
+    def assign(self, pairs: Iterable[AccountPair]) -> None:
+        """Places each account pair on a connection, round robin. Call before authorizing the accounts."""
+        for index, pair in enumerate(pairs):
+            shard = self.shards[index % len(self.shards)]
+            for account_id in pair:
+                self._shard_of[account_id] = shard
+        logging.info(f"Spread {len(self._shard_of)} account(s) across {len(self.shards)} cTrader connection(s).")
+
+    def shard(self, ctid_trader_account_id: int) -> Union[CTraderApiClient, RedundantClient]:
+        """The connection of an account; accounts outside any pair are placed by their id."""
+        shard = self._shard_of.get(ctid_trader_account_id)
+        if shard is None:
+            shard = self.shards[ctid_trader_account_id % len(self.shards)]
+        return shard
+
+    # Sessions
+
+    def add_session_callback(self, callback: Callable[[], None]) -> None:
+        """
+        Calls callback once every connection has its first session, and again each time
+        a connection's session is restored after that.
+        """
+        self._session_callbacks.append(callback)
+
+    def _on_session(self, index: int):
+        first = len(self._connected) < len(self.shards)
+        self._connected.add(index)
+        if first and len(self._connected) < len(self.shards):
+            return
+        for callback in list(self._session_callbacks):
+            callback()
+
+    @property
+    def trader_accounts(self) -> List[Any]:
+        return self.shards[0].trader_accounts
+
+    @property
+    def authorized_accounts(self) -> Set[int]:
+        return set().union(*(shard.authorized_accounts for shard in self.shards))
+
+    # Events, from every connection
+
+    def register_handler(self, payload_type: int, handler: Callable) -> None:
+        self.subscribe(payload_type, handler)
+
+    def unregister_handler(self, payload_type: int, handler: Callable) -> None:
+        self.events.unsubscribe_handler(payload_type, handler)
+        self._drop_relay(payload_type)
+
+    def subscribe(self, payload_type: int, handler: Callable, account_id: int = None, symbol_id: int = None,
+                  position_id: int = None, name: str = None, timed: bool = True) -> Subscription:
+        """Like CTraderApiClient.subscribe, for the events of every connection."""
+        subscription = self.events.subscribe(payload_type, handler, account_id, symbol_id, position_id, name, timed)
+        if payload_type not in self._relays:
+            publish = self.events.publish
+            self._relays[payload_type] = [
+                shard.subscribe(payload_type, lambda msg: publish(payload_type, msg), name="ShardedClient relay",
+                                timed=False)
+                for shard in self.shards]
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self.events.unsubscribe(subscription)
+        self._drop_relay(subscription.payload_type)
+
+    def subscribe_to_execution_events(self, callback: Callable, account_id: int = None, symbol_id: int = None,
+                                      position_id: int = None) -> Subscription:
+        return self.subscribe(EXECUTION_EVENT, callback, account_id, symbol_id, position_id)
+
+    def _drop_relay(self, payload_type: int) -> None:
+        if payload_type not in self.events.topics and payload_type in self._relays:
+            for shard, relay in zip(self.shards, self._relays.pop(payload_type)):
+                shard.unsubscribe(relay)
+
+    def subscribe_to_ticks(self, ctid_trader_account_id: int, symbol_id: int) -> Deferred:
+        """Subscribes to a symbol's spots on the account's connection, unless a connection already has."""
+        if symbol_id in self._spot_symbols:
+            return succeed(None)
+        self._spot_symbols.add(symbol_id)
+
+        def on_failed(failure):
+            self._spot_symbols.discard(symbol_id)
+            return failure
+
+        return self.shard(ctid_trader_account_id).subscribe_to_ticks(ctid_trader_account_id, symbol_id) \
+            .addErrback(on_failed)
+
+    # Requests, sent on the account's connection
+
+    def send_payload(self, payload_type: int, payload: bytes, account_id: int = 0, timeout: float = None,
+                     position_id: int = 0, order_id: int = 0) -> Deferred:
+        return self.shard(account_id).send_payload(payload_type, payload, account_id, timeout,
+                                                   position_id, order_id)
+
+    def authorize_trading_account(self, ctid_trader_account_id: int) -> Deferred:
+        return self.shard(ctid_trader_account_id).authorize_trading_account(ctid_trader_account_id)
+
+    def place_order(self, ctid_trader_account_id: int, *args, **kwargs) -> Deferred:
+        return self.shard(ctid_trader_account_id).place_order(ctid_trader_account_id, *args, **kwargs)
+
+    def modify_position(self, ctid_trader_account_id: int, *args, **kwargs) -> Deferred:
+        return self.shard(ctid_trader_account_id).modify_position(ctid_trader_account_id, *args, **kwargs)
+
+    def reconcile(self, ctid_trader_account_id: int) -> Deferred:
+        return self.shard(ctid_trader_account_id).reconcile(ctid_trader_account_id)
+
+    def get_account_list(self) -> Deferred:
+        return self.shards[0].get_account_list()
+
+    def get_trader(self, ctid_trader_account_id: int) -> Deferred:
+        return self.shard(ctid_trader_account_id).get_trader(ctid_trader_account_id)
+
+    def get_unrealized_pnl(self, ctid_trader_account_id: int) -> Deferred:
+        return self.shard(ctid_trader_account_id).get_unrealized_pnl(ctid_trader_account_id)
+
+    def get_account_balance(self, ctid_trader_account_id: int) -> Deferred:
+        return self.shard(ctid_trader_account_id).get_account_balance(ctid_trader_account_id)
+
+    def get_symbols(self, ctid_trader_account_id: int) -> Deferred:
+        return self.shard(ctid_trader_account_id).get_symbols(ctid_trader_account_id)
+
+    def get_symbols_by_id(self, ctid_trader_account_id: int, symbol_ids: List[int]) -> Deferred:
+        return self.shard(ctid_trader_account_id).get_symbols_by_id(ctid_trader_account_id, symbol_ids)
@@ -0,0 +1,115 @@
+import logging
+import random
+from typing import Callable, Optional
+
+from twisted.application.internet import backoffPolicy
+from twisted.internet.defer import Deferred
+from twisted.internet.task import LoopingCall
+from ctrader_open_api.messages.OpenApiCommonMessages_pb2 import ProtoMessage
+from ctrader_open_api.messages.OpenApiCommonModelMessages_pb2 import ProtoPayloadType
+from ctrader_open_api.messages.OpenApiMessages_pb2 import ProtoOAVersionReq
+from ctrader_open_api.messages.OpenApiModelMessages_pb2 import ProtoOAPayloadType
+
+from pepper_bot.core import metrics
+from pepper_bot.ctrader.pending import RequestTimeoutError
+
+CHECK_INTERVAL_SECONDS = 0.5
+
+# The server drops sessions that stay silent for about 30 s
+HEARTBEAT_INTERVAL_SECONDS = 10.0
+
+# A connection that has received nothing for this long is probed with a version request,
+# and dropped if the answer does not come within PROBE_TIMEOUT_SECONDS
+PROBE_AFTER_SECONDS = 3.0
+PROBE_TIMEOUT_SECONDS = 2.0
+
+# Reconnects are retried after 0.2 s, 0.4 s, 0.8 s... up to 30 s, each plus up to 0.25 s of jitter
+RECONNECT_INITIAL_DELAY_SECONDS = 0.1
+RECONNECT_MAX_DELAY_SECONDS = 30.0
+RECONNECT_JITTER_SECONDS = 0.25
+
+_HEARTBEAT_FRAME = ProtoMessage(payloadType=ProtoPayloadType.HEARTBEAT_EVENT).SerializeToString()
+_VERSION_REQ = ProtoOAPayloadType.PROTO_OA_VERSION_REQ
+_VERSION_PAYLOAD = ProtoOAVersionReq().SerializeToString()
+
+
+def reconnect_policy() -> Callable[[int], float]:
+    """The delay before each reconnect attempt: exponential backoff with jitter."""
+    return backoffPolicy(initialDelay=RECONNECT_INITIAL_DELAY_SECONDS, maxDelay=RECONNECT_MAX_DELAY_SECONDS,
+                         factor=2.0, jitter=lambda: random.uniform(0, RECONNECT_JITTER_SECONDS))
+
+
+class ConnectionSupervisor:
+    """
+    Watches a client's connection while it is up: sends heartbeats, and probes the
+    server when nothing has been received for a while, dropping the connection if the
+    probe goes unanswered. The client's ClientService then reconnects with backoff, and
+    the client replays its session on the new connection.
+    """
+
+    def __init__(self, client, clock=None, heartbeat_interval: float = HEARTBEAT_INTERVAL_SECONDS,
+                 probe_after: float = PROBE_AFTER_SECONDS, probe_timeout: float = PROBE_TIMEOUT_SECONDS):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.client = client
+        self.clock = clock
+        self.heartbeat_interval = heartbeat_interval
+        self.probe_after = probe_after
+        self.probe_timeout = probe_timeout
+        self._loop: Optional[LoopingCall] = None
+        self._probe: Optional[Deferred] = None
+        self._last_received = 0
+        self._last_activity = 0.0
+        self._last_heartbeat = 0.0
+        self._stalls = metrics.counter("ctrader_stalls_total", "Connections dropped for not answering a probe")
+
+    def start(self) -> None:
+        """Starts watching a new connection."""
+        self.stop()
+        now = self.clock.seconds()
+        self._last_received = self.client.received_messages
+        self._last_activity = now
+        self._last_heartbeat = now
+        self._loop = LoopingCall(self._check)
+        self._loop.clock = self.clock
+        self._loop.start(CHECK_INTERVAL_SECONDS, now=False)
+
+    @property
+    def suspect(self) -> bool:
+        """True while a probe is unanswered, i.e. the server has been quiet for longer than probe_after."""
+        return self._probe is not None
+
+    def stop(self) -> None:
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        self._probe = None
+
+    def _check(self) -> None:
+        now = self.clock.seconds()
+        received = self.client.received_messages
+        if received != self._last_received:
+            self._last_received = received
+            self._last_activity = now
+
+        if now - self._last_heartbeat >= self.heartbeat_interval:
+            self._last_heartbeat = now
+            self.client.write_frame(_HEARTBEAT_FRAME)
+
+        if self._probe is None and now - self._last_activity >= self.probe_after:
+            probe = self._probe = self.client.send_payload(_VERSION_REQ, _VERSION_PAYLOAD, timeout=self.probe_timeout)
+            probe.addCallbacks(self._on_probe_answered, self._on_probe_failed, errbackArgs=(probe, received))
+
+    def _on_probe_answered(self, _):
+        self._probe = None
+
+    def _on_probe_failed(self, failure, probe: Deferred, received: int):
+        if self._probe is not probe:
+            # The connection this probe was sent on is already gone
+            return
+        self._probe = None
+        if failure.check(RequestTimeoutError) and self.client.received_messages == received:
+            self._stalls.inc()
+            logging.warning(f"cTrader connection stalled: nothing received for "
+                            f"{self.clock.seconds() - self._last_activity:.1f}s. Reconnecting.")
+            self.client.drop_connection()
@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import tempfile
+from typing import Any, Dict, Iterable, List, Optional
+
+from twisted.internet.defer import Deferred, gatherResults, succeed
+
+from pepper_bot.ctrader.ticks import PRICE_SCALE
+
+# Build the absolute path to the symbol cache file
+_CACHE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "core"))
+SYMBOLS_CACHE_FILE = os.path.join(_CACHE_DIR, "symbols_cache.json")
+
+# ProtoOASymbolByIdReq accepts a list of ids; keep each request reasonably small
+_DETAILS_BATCH_SIZE = 50
+
+
+class SymbolInfo:
+    """
+    Trading details of a symbol with the unit conversions needed on the order path
+    precomputed, so sending an order needs no lookups beyond this object.
+    """
+    __slots__ = ("symbol_id", "name", "digits", "pip_position", "lot_size", "min_volume", "max_volume",
+                 "step_volume", "point_size", "pip_size")
+
+    def __init__(self, symbol_id: int, name: str, digits: int, pip_position: int, lot_size: int,
+                 min_volume: int = 0, max_volume: int = 0, step_volume: int = 0):
+        self.symbol_id = symbol_id
+        self.name = name
+        self.digits = digits
+        self.pip_position = pip_position
+        self.lot_size = lot_size  # In cents of the base asset, like all Open API volumes
+        self.min_volume = min_volume
+        self.max_volume = max_volume
+        self.step_volume = step_volume
+        self.point_size = 10.0 ** -digits
+        self.pip_size = 10.0 ** -pip_position
+
+    @classmethod
+    def from_proto(cls, name: str, symbol: Any) -> "SymbolInfo":
+        return cls(symbol.symbolId, name, symbol.digits, symbol.pipPosition, symbol.lotSize,
+                   symbol.minVolume, symbol.maxVolume, symbol.stepVolume)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "SymbolInfo":
+        return cls(data["symbol_id"], data["name"], data["digits"], data["pip_position"], data["lot_size"],
+                   data.get("min_volume", 0), data.get("max_volume", 0), data.get("step_volume", 0))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "symbol_id": self.symbol_id,
+            "name": self.name,
+            "digits": self.digits,
+            "pip_position": self.pip_position,
+            "lot_size": self.lot_size,
+            "min_volume": self.min_volume,
+            "max_volume": self.max_volume,
+            "step_volume": self.step_volume,
+        }
+
+    def lots_to_volume(self, lots: float) -> int:
+        """Converts a volume in lots to protocol volume units, snapped to the symbol's volume step."""
+        volume = int(round(lots * self.lot_size))
+        if self.step_volume:
+            volume -= volume % self.step_volume
+        if self.min_volume and volume < self.min_volume:
+            volume = self.min_volume
+        if self.max_volume and volume > self.max_volume:
+            volume = self.max_volume
+        return volume
+
+    def volume_to_lots(self, volume: int) -> float:
+        return volume / self.lot_size
+
+    def points_to_relative(self, points: float) -> int:
+        """
+        Converts a distance in points to a relativeStopLoss/relativeTakeProfit value, in
+        1/100000 of a price unit. Rounded only at the end: a point of a symbol with more
+        than 5 digits is less than one unit.
+        """
+        return int(round(points * self.point_size * PRICE_SCALE))
+
+    def points_to_price(self, points: float) -> float:
+        return points * self.point_size
+
+    def pips_to_price(self, pips: float) -> float:
+        return pips * self.pip_size
+
+    def round_price(self, price: float) -> float:
+        return round(price, self.digits)
+
+    def __repr__(self):
+        return f"SymbolInfo({self.name}, id={self.symbol_id}, digits={self.digits}, lot_size={self.lot_size})"
+
+
+class SymbolCatalogue:
+    """
+    Loads symbol details from the broker once and keeps them in memory, persisting
+    them to a local cache file so restarts don't need the round trips. Without a
+    cache file (e.g. in a backtest) it only holds the symbols added to it.
+    """
+
+    def __init__(self, cache_file: Optional[str] = SYMBOLS_CACHE_FILE):
+        self.cache_file = cache_file
+        self._by_id: Dict[int, SymbolInfo] = {}
+        self._by_name: Dict[str, SymbolInfo] = {}
+        if cache_file is not None:
+            self.load_cache()
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._by_name
+
+    def get(self, symbol_id: int) -> Optional[SymbolInfo]:
+        return self._by_id.get(symbol_id)
+
+    def by_name(self, name: str) -> Optional[SymbolInfo]:
+        return self._by_name.get(name)
+
+    def add(self, info: SymbolInfo) -> None:
+        self._by_id[info.symbol_id] = info
+        self._by_name[info.name] = info
+
+    def load_cache(self) -> None:
+        try:
+            with open(self.cache_file, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable symbol cache {self.cache_file}: {e}")
+            return
+        for entry in data.get("symbols", []):
+            self.add(SymbolInfo.from_dict(entry))
+        logging.info(f"Loaded {len(self._by_id)} symbols from cache.")
+
+    def save_cache(self) -> None:
+        if self.cache_file is None:
+            return
+        data = {"symbols": [info.to_dict() for info in self._by_id.values()]}
+        directory = os.path.dirname(self.cache_file)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".symbols.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp_path, self.cache_file)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def load(self, client, ctid_trader_account_id: int, names: Iterable[str], refresh: bool = False) -> Deferred:
+        """
+        Makes sure details for the given symbol names are loaded, fetching only the
+        ones missing from the cache (or all of them if refresh is True).
+        Fires with the list of SymbolInfo for the names that exist on the account.
+        """
+        names = list(names)
+        missing = names if refresh else [name for name in names if name not in self._by_name]
+        if not missing:
+            return succeed([self._by_name[name] for name in names])
+
+        d = client.get_symbols(ctid_trader_account_id)
+        d.addCallback(self._on_symbol_list, client, ctid_trader_account_id, missing)
+        d.addCallback(lambda _: [self._by_name[name] for name in names if name in self._by_name])
+        return d
+
+    def _on_symbol_list(self, response, client, ctid_trader_account_id: int, wanted: List[str]) -> Deferred:
+        wanted_names = set(wanted)
+        names_by_id = {s.symbolId: s.symbolName for s in response.symbol if s.symbolName in wanted_names}
+        unknown = wanted_names.difference(names_by_id.values())
+        if unknown:
+            logging.warning(f"Symbols not available on account {ctid_trader_account_id}: {sorted(unknown)}")
+
+        ids = list(names_by_id)
+        requests = []
+        for i in range(0, len(ids), _DETAILS_BATCH_SIZE):
+            d = client.get_symbols_by_id(ctid_trader_account_id, ids[i:i + _DETAILS_BATCH_SIZE])
+            d.addCallback(self._on_symbol_details, names_by_id)
+            requests.append(d)
+
+        d = gatherResults(requests, consumeErrors=True)
+        d.addCallback(lambda _: self.save_cache())
+        return d
+
+    def _on_symbol_details(self, response, names_by_id: Dict[int, str]) -> None:
+        for symbol in response.symbol:
+            self.add(SymbolInfo.from_proto(names_by_id[symbol.symbolId], symbol))
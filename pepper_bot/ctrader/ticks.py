@@ -0,0 +1,125 @@
+import time
+from array import array
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Spot prices are sent as integers in 1/100000 of a price unit
+PRICE_SCALE = 100000.0
+
+DEFAULT_CAPACITY = 4096
+
+
+class TickRing:
+    """
+    A fixed-size ring buffer of (bid, ask, timestamp) ticks for one symbol.
+    The storage is allocated once as flat arrays; the latest quote is kept in
+    plain attributes so readers don't allocate.
+    """
+    __slots__ = ("symbol_id", "capacity", "bids", "asks", "timestamps", "count", "_next",
+                 "bid", "ask", "timestamp")
+
+    def __init__(self, symbol_id: int, capacity: int = DEFAULT_CAPACITY):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.symbol_id = symbol_id
+        self.capacity = capacity
+        self.bids = array("d", bytes(8 * capacity))
+        self.asks = array("d", bytes(8 * capacity))
+        self.timestamps = array("q", bytes(8 * capacity))
+        self.count = 0
+        self._next = 0
+
+        # Latest quote
+        self.bid = 0.0
+        self.ask = 0.0
+        self.timestamp = 0
+
+    def append(self, bid: float, ask: float, timestamp: int) -> None:
+        i = self._next
+        self.bids[i] = bid
+        self.asks[i] = ask
+        self.timestamps[i] = timestamp
+        self._next = i + 1 if i + 1 < self.capacity else 0
+        if self.count < self.capacity:
+            self.count += 1
+        self.bid = bid
+        self.ask = ask
+        self.timestamp = timestamp
+
+    @property
+    def mid(self) -> float:
+        return (self.bid + self.ask) * 0.5
+
+    def latest(self) -> Tuple[float, float, int]:
+        return self.bid, self.ask, self.timestamp
+
+    def last(self, n: int) -> Tuple[List[float], List[float], List[int]]:
+        """Returns copies of the last n ticks, oldest first."""
+        n = min(n, self.count)
+        start = (self._next - n) % self.capacity
+        if start + n <= self.capacity:
+            end = start + n
+            return self.bids[start:end].tolist(), self.asks[start:end].tolist(), self.timestamps[start:end].tolist()
+        tail = self.capacity - start
+        head = n - tail
+        return (
+            self.bids[start:].tolist() + self.bids[:head].tolist(),
+            self.asks[start:].tolist() + self.asks[:head].tolist(),
+            self.timestamps[start:].tolist() + self.timestamps[:head].tolist(),
+        )
+
+
+class TickStream:
+    """
+    Decodes ProtoOASpotEvent messages into per-symbol TickRings and notifies
+    subscribers with the updated ring.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._rings: Dict[int, TickRing] = {}
+        self._subscribers: Dict[int, List[Callable[[TickRing], None]]] = {}
+        self._global_subscribers: List[Callable[[TickRing], None]] = []
+
+    def ring(self, symbol_id: int) -> TickRing:
+        """Returns the ring for a symbol, creating it if needed."""
+        ring = self._rings.get(symbol_id)
+        if ring is None:
+            ring = self._rings[symbol_id] = TickRing(symbol_id, self.capacity)
+        return ring
+
+    def latest(self, symbol_id: int) -> Optional[TickRing]:
+        """Returns the ring holding the latest quote of a symbol, or None if no tick was seen yet."""
+        ring = self._rings.get(symbol_id)
+        if ring is None or not ring.count:
+            return None
+        return ring
+
+    def subscribe(self, callback: Callable[[TickRing], None], symbol_id: Optional[int] = None) -> None:
+        """Calls callback(ring) on every tick of symbol_id, or of every symbol if symbol_id is None."""
+        if symbol_id is None:
+            self._global_subscribers.append(callback)
+        else:
+            self._subscribers.setdefault(symbol_id, []).append(callback)
+
+    def unsubscribe(self, callback: Callable[[TickRing], None], symbol_id: Optional[int] = None) -> None:
+        subscribers = self._global_subscribers if symbol_id is None else self._subscribers.get(symbol_id, [])
+        if callback in subscribers:
+            subscribers.remove(callback)
+
+    def on_spot_event(self, event) -> None:
+        """Handler for ProtoOASpotEvent."""
+        ring = self.ring(event.symbolId)
+        # Only the side(s) that changed are sent; carry the other one forward
+        bid = event.bid / PRICE_SCALE if event.bid else ring.bid
+        ask = event.ask / PRICE_SCALE if event.ask else ring.ask
+        timestamp = event.timestamp or int(time.time() * 1000)
+        self.push(ring, bid, ask, timestamp)
+
+    def push(self, ring: TickRing, bid: float, ask: float, timestamp: int) -> None:
+        ring.append(bid, ask, timestamp)
+        subscribers = self._subscribers.get(ring.symbol_id)
+        if subscribers:
+            for callback in subscribers:
+                callback(ring)
+        for callback in self._global_subscribers:
+            callback(ring)
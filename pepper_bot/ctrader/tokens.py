@@ -0,0 +1,212 @@
+import argparse
+import json
+import logging
+import os
+import stat
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+
+from pepper_bot.ctrader import auth
+
+# Build the absolute path to the token file
+_CACHE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "core"))
+TOKENS_FILE = os.path.join(_CACHE_DIR, "tokens.json")
+
+# Seed tokens, used when there is no token file yet
+ACCESS_TOKEN_ENV_VAR = "CTRADER_ACCESS_TOKEN"
+REFRESH_TOKEN_ENV_VAR = "CTRADER_REFRESH_TOKEN"
+
+# Access tokens live for about 30 days; they are refreshed this long before they expire
+REFRESH_BEFORE_EXPIRY_SECONDS = 24 * 3600
+
+# A failed refresh is retried after this long, for as long as it keeps failing
+REFRESH_RETRY_SECONDS = 60.0
+
+
+class TokenManager:
+    """
+    Holds the OAuth tokens of the cTrader Open API in memory and in a file only the
+    owner can read, and refreshes the access token ahead of its expiry. Listeners are
+    called with each new access token, so clients can re-authorize their accounts on
+    the connection they already have. Reactor thread only.
+    """
+
+    def __init__(self, path: str = TOKENS_FILE, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.path = path
+        self.clock = clock
+        self.access_token: Optional[str] = None
+        self.refresh_token: Optional[str] = None
+        self.expires_at: Optional[float] = None  # Unix time; None if unknown
+        self.updated_at: Optional[float] = None  # Unix time of the last refresh or exchange in this process
+        self._listeners: List[Callable[[str], None]] = []
+        self._waiting: List[Deferred] = []
+        self._scheduled = None
+
+    def load(self) -> None:
+        """Loads the tokens from the token file, or from the environment if there is none yet."""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            self.access_token = os.environ.get(ACCESS_TOKEN_ENV_VAR) or None
+            self.refresh_token = os.environ.get(REFRESH_TOKEN_ENV_VAR) or None
+            self.expires_at = None
+            if self.access_token:
+                logging.info(f"Using the access token from {ACCESS_TOKEN_ENV_VAR}.")
+            return
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not read the token file {self.path}: {e}")
+            return
+
+        if os.name == "posix" and os.stat(self.path).st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+            logging.warning(f"{self.path} was readable by other users; restricting it to its owner.")
+            os.chmod(self.path, 0o600)
+        self.access_token = data.get("access_token")
+        self.refresh_token = data.get("refresh_token")
+        self.expires_at = data.get("expires_at")
+        logging.info(f"Loaded cTrader tokens from {self.path}.")
+
+    def save(self) -> None:
+        """Writes the tokens to the token file, readable and writable by its owner only."""
+        data = {"access_token": self.access_token, "refresh_token": self.refresh_token,
+                "expires_at": self.expires_at}
+        tmp_path = self.path + ".tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.error(f"Could not save the token file {self.path}: {e}")
+
+    def updated_within(self, seconds: float) -> bool:
+        """Whether the tokens were replaced in the last `seconds`."""
+        return self.updated_at is not None and time.time() - self.updated_at < seconds
+
+    def add_listener(self, callback: Callable[[str], None]) -> None:
+        """Calls callback with the new access token after every refresh."""
+        self._listeners.append(callback)
+
+    # Lifecycle
+
+    def start(self) -> Deferred:
+        """
+        Schedules the next refresh. Tokens of unknown age (seeded from the environment)
+        or close to expiry are refreshed right away; the returned Deferred fires once
+        that is done, or at once if the tokens can be used as they are.
+        """
+        if not self.refresh_token:
+            logging.warning("No cTrader refresh token; the access token will not be refreshed.")
+            return succeed(None)
+        delay = self._refresh_delay()
+        if delay > 0:
+            self._schedule(delay)
+            return succeed(None)
+        d = self.refresh()
+        d.addErrback(lambda _: None)
+        return d
+
+    def stop(self) -> None:
+        if self._scheduled is not None and self._scheduled.active():
+            self._scheduled.cancel()
+        self._scheduled = None
+
+    def _refresh_delay(self) -> float:
+        if self.expires_at is None:
+            return 0.0
+        return self.expires_at - REFRESH_BEFORE_EXPIRY_SECONDS - time.time()
+
+    def _schedule(self, delay: float) -> None:
+        self.stop()
+        self._scheduled = self.clock.callLater(max(delay, 0.0), self._refresh_scheduled)
+        logging.info(f"Next cTrader token refresh in {max(delay, 0.0):.0f}s.")
+
+    def _refresh_scheduled(self):
+        self._scheduled = None
+        self.refresh().addErrback(lambda _: None)
+
+    # Token requests
+
+    def exchange(self, authorization_code: str, redirect_uri: str) -> Deferred:
+        """Exchanges an authorization code for new tokens and saves them."""
+        d = auth.get_access_token(authorization_code, redirect_uri)
+        d.addCallback(self._update)
+        return d
+
+    def refresh(self) -> Deferred:
+        """
+        Refreshes the access token now; fires with the new access token. Concurrent
+        calls share one request. A failed refresh is retried after REFRESH_RETRY_SECONDS.
+        """
+        d = Deferred()
+        self._waiting.append(d)
+        if len(self._waiting) == 1:
+            logging.info("Refreshing the cTrader access token.")
+            self.stop()
+            request = maybeDeferred(auth.refresh_access_token, self.refresh_token)
+            request.addCallbacks(self._on_refreshed, self._on_refresh_failed)
+        return d
+
+    def _on_refreshed(self, token_data: Dict[str, Any]):
+        self._update(token_data)
+        logging.info("cTrader access token refreshed.")
+        if self.expires_at is not None:
+            self._schedule(self._refresh_delay())
+        for listener in list(self._listeners):
+            try:
+                listener(self.access_token)
+            except Exception:
+                logging.exception("Error in an access token listener")
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(self.access_token)
+
+    def _on_refresh_failed(self, failure):
+        logging.error(f"Could not refresh the cTrader access token: {failure.getErrorMessage()}")
+        self._schedule(REFRESH_RETRY_SECONDS)
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.errback(failure)
+
+    def _update(self, token_data: Dict[str, Any]) -> Dict[str, Any]:
+        self.access_token = token_data["accessToken"]
+        self.refresh_token = token_data.get("refreshToken") or self.refresh_token
+        expires_in = token_data.get("expiresIn")
+        self.updated_at = time.time()
+        self.expires_at = self.updated_at + expires_in if expires_in else None
+        self.save()
+        return token_data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exchanges a cTrader OAuth authorization code for tokens "
+                                                 "and saves them to the token file.")
+    parser.add_argument("--code", required=True, help="The authorization code from the redirect")
+    parser.add_argument("--redirect-uri", required=True, help="The redirect URI the code was issued for")
+    args = parser.parse_args()
+
+    from twisted.internet import reactor
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    tokens = TokenManager()
+
+    def on_saved(_):
+        logging.info(f"Tokens saved to {tokens.path}.")
+
+    def on_failed(failure):
+        logging.error(f"Token exchange failed: {failure.getErrorMessage()}")
+
+    d = tokens.exchange(args.code, args.redirect_uri)
+    d.addCallbacks(on_saved, on_failed)
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
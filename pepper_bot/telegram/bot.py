@@ -12,14 +12,18 @@ import asyncio
 from twisted.internet import defer, reactor
 
 
+from pepper_bot.core import metrics
 from pepper_bot.core.config import get_all_settings, set_setting
-from pepper_bot.core.database import get_all_trades
+from pepper_bot.core.database import get_trades_page, get_trade_report, get_trade_summary
 from pepper_bot.ctrader.auth import get_credentials
-from pepper_bot.telegram.menus import main_menu, settings_menu, pair_selection_menu
+from pepper_bot.telegram.menus import main_menu, settings_menu, pair_selection_menu, trade_history_menu
 
 # Authorized chat ID - only this user can use the bot
 AUTHORIZED_CHAT_ID = 5705498219
 
+# Number of trades shown per page of the trade history
+HISTORY_PAGE_SIZE = 10
+
 # States for conversation
 SELECTING_ACTION, SELECTING_PAIR_SL, SETTING_SL, SELECTING_PAIR_TS, SETTING_TS, SELECTING_PAIR_VOL, SETTING_VOL, SELECTING_ACCOUNTS = range(8)
 
@@ -51,12 +55,9 @@ async def select_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Starts the account selection process."""
     global _ctrader_manager
     ctrader_manager = _ctrader_manager
-    accounts = await ctrader_manager.get_trader_accounts()
-
-    account_details = []
-    for account in accounts:
-        balance = await ctrader_manager.get_account_balance(account.ctidTraderAccountId)
-        account_details.append((account, balance / 100.0))
+    # One concurrent refresh for every account, served from the cache when recent
+    snapshots = await ctrader_manager.get_account_snapshots()
+    account_details = [(snapshot, snapshot.balance) for snapshot in snapshots]
 
     if len(account_details) < 2:
         await update.message.reply_text(
@@ -77,8 +78,9 @@ async def select_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Get user selection
         message = "📊 *Available Trading Accounts*\n\n"
         for i, (account, balance) in enumerate(account_details):
-            message += f"{i+1}. ID: `{account.ctidTraderAccountId}`\n"
-            message += f"   Balance: {balance:.2f} {getattr(account, 'currency', 'USD')}\n\n"
+            message += f"{i+1}. ID: `{account.account_id}`\n"
+            message += f"   Balance: {balance:.2f} {getattr(account, 'currency', 'USD')}\n"
+            message += f"   Equity: {account.equity:.2f} {getattr(account, 'currency', 'USD')}\n\n"
         message += "Reply with two numbers (BUY SELL):\n"
         message += "Example: `1 2`"
         await update.message.reply_text(message, parse_mode="Markdown")
@@ -121,11 +123,72 @@ async def set_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return ConversationHandler.END
 
-# Placeholder handler functions
+async def _show_trade_history(update: Update, before_id: int = None):
+    """Shows one page of the trade history, newest first."""
+    trades, next_cursor = await asyncio.to_thread(get_trades_page, HISTORY_PAGE_SIZE, before_id)
+
+    if not trades:
+        message = "📋 *Trade History*\n\nNo trades yet."
+    else:
+        message = "📋 *Trade History*\n\n"
+        for trade in trades:
+            message += (f"`{trade['timestamp']}` {trade['symbol']} {trade['side'].upper()}\n"
+                        f"   {trade['entry_price']} → {trade['exit_price']}  P&L: {trade['pnl']:.2f}\n")
+    await update.callback_query.edit_message_text(
+        message, reply_markup=trade_history_menu(next_cursor), parse_mode="Markdown"
+    )
+    return SELECTING_ACTION
+
+async def _show_trade_summary(update: Update):
+    """Shows the aggregated P&L report."""
+    # All three read the materialized daily summary, in a single worker thread call
+    summary, by_symbol, by_side = await asyncio.to_thread(
+        lambda: (get_trade_summary(), get_trade_report("symbol"), get_trade_report("side")))
+
+    message = "📈 *Performance*\n\n"
+    message += f"Trades: {summary['trades']}  P&L: {summary['pnl']:.2f}\n"
+    if summary["trades"]:
+        message += (f"Win rate: {summary['win_rate'] * 100:.1f}%  "
+                    f"Avg duration: {summary['avg_duration_seconds']:.0f}s\n")
+    for title, rows, key in (("By symbol", by_symbol, "symbol"), ("By side", by_side, "side")):
+        if rows:
+            message += f"\n*{title}*\n"
+            for row in rows:
+                message += (f"{row[key]}: {row['trades']} trades, P&L {row['pnl']:.2f}, "
+                            f"win {row['win_rate'] * 100:.0f}%\n")
+    await update.callback_query.edit_message_text(
+        message, reply_markup=trade_history_menu(None), parse_mode="Markdown"
+    )
+    return SELECTING_ACTION
+
+@check_authorized
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows the message counters and latency histograms."""
+    snapshot = metrics.REGISTRY.snapshot()
+    lines = []
+    for name, summary in snapshot["histograms"].items():
+        lines.append(f"{name}\n  n={summary['count']} p50={summary['p50']:.1f}ms "
+                     f"p99={summary['p99']:.1f}ms max={summary['max']:.1f}ms")
+    for name, value in snapshot["counters"].items():
+        if value:
+            lines.append(f"{name} {value}")
+    body = "\n".join(lines) if lines else "Nothing recorded yet."
+    await update.message.reply_text(f"📊 *Stats*\n\n```\n{body}\n```", parse_mode="Markdown")
+
 @check_authorized
 async def main_menu_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for main menu buttons."""
-    pass
+    query = update.callback_query
+    await query.answer()
+
+    if query.data == "trade_history":
+        return await _show_trade_history(update)
+    if query.data.startswith("trade_history_"):
+        return await _show_trade_history(update, int(query.data[len("trade_history_"):]))
+    if query.data == "trade_summary":
+        return await _show_trade_summary(update)
+
+# Placeholder handler functions
 
 @check_authorized
 async def settings_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -186,6 +249,7 @@ async def run_bot(token: str, ctrader_manager):
     )
 
     application.add_handler(conv_handler)
+    application.add_handler(CommandHandler("stats", stats_command))
 
     await application.initialize()
     await application.start()
@@ -1,6 +1,6 @@
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 
-from pepper_bot.core.config import get_all_settings
+from pepper_bot.core.config import get_settings
 
 def main_menu() -> Dict[str, List[List[Dict[str, str]]]]:
     """Returns the main menu keyboard."""
@@ -19,8 +19,7 @@ def main_menu() -> Dict[str, List[List[Dict[str, str]]]]:
 
 def settings_menu() -> Dict[str, List[List[Dict[str, str]]]]:
     """Returns the settings menu keyboard."""
-    settings = get_all_settings()
-    pairs = settings["pairs"]
+    pairs = get_settings().pairs
 
     keyboard = []
     for pair, enabled in pairs.items():
@@ -36,8 +35,7 @@ def settings_menu() -> Dict[str, List[List[Dict[str, str]]]]:
 
 def pair_selection_menu(setting: str) -> Dict[str, List[List[Dict[str, str]]]]:
     """Returns a keyboard with the available pairs for a given setting."""
-    settings = get_all_settings()
-    pairs = settings["pairs"]
+    pairs = get_settings().pairs
 
     keyboard = []
     for pair, enabled in pairs.items():
@@ -46,3 +44,12 @@ def pair_selection_menu(setting: str) -> Dict[str, List[List[Dict[str, str]]]]:
 
     keyboard.append([{"text": "⬅️ Back to Settings", "callback_data": "settings"}])
     return {"inline_keyboard": keyboard}
+
+def trade_history_menu(next_cursor: Optional[int]) -> Dict[str, List[List[Dict[str, str]]]]:
+    """Returns the keyboard below a page of trade history."""
+    keyboard = []
+    if next_cursor is not None:
+        keyboard.append([{"text": "Older ➡️", "callback_data": f"trade_history_{next_cursor}"}])
+    keyboard.append([{"text": "📈 Summary", "callback_data": "trade_summary"}])
+    keyboard.append([{"text": "⬅️ Back to Main Menu", "callback_data": "main_menu"}])
+    return {"inline_keyboard": keyboard}
@@ -0,0 +1,274 @@
+import logging
+import os
+import struct
+import threading
+from collections import deque
+from typing import BinaryIO, Deque, Dict, List, Optional
+
+from pepper_bot.trading.straddle import Straddle, StraddleLeg, OPEN, ONE_LEG_CLOSED, CLOSED
+
+# Build the absolute path to the default journal directory
+JOURNAL_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "core", "journal"))
+
+JOURNAL_FILE = "straddles.journal"
+SNAPSHOT_FILE = "straddles.snapshot"
+
+FLUSH_INTERVAL_SECONDS = 0.1
+
+# The journal is folded into a new snapshot once it holds this many records
+COMPACT_EVERY = 10_000
+
+# Both files start with a header and hold the same records; a snapshot only has ADDs.
+# ADD carries a whole straddle (id, symbol id, state, length of the symbol name) and
+# both legs as (account, order, position, entry price, volume, closed), followed by
+# the UTF-8 symbol name; the other records change one field of one leg:
+# (op, straddle id, leg, integer value, price).
+MAGIC = b"PJRN"
+VERSION = 2
+HEADER = struct.Struct("<4sI")
+ADD = struct.Struct("<BqIBH" + "qqqdqB" * 2)
+UPDATE = struct.Struct("<BqBqd")
+
+OP_ADD = 1
+OP_POSITION = 2
+OP_PRICE = 3
+OP_LEG_CLOSED = 4
+OP_REMOVE = 5
+
+# Sizes of the records; an ADD's is that plus the length of its symbol name
+_SIZES = {OP_ADD: ADD.size, OP_POSITION: UPDATE.size, OP_PRICE: UPDATE.size,
+          OP_LEG_CLOSED: UPDATE.size, OP_REMOVE: UPDATE.size}
+_STATES = (OPEN, ONE_LEG_CLOSED, CLOSED)
+_STATE_CODES = {state: code for code, state in enumerate(_STATES)}
+
+# A straddle as the writer thread keeps it: [symbol, symbol id, state code, buy leg, sell leg],
+# each leg being [account, order, position, entry price, volume, closed]
+_Entry = list
+
+
+class StateJournal:
+    """
+    A write-ahead journal of straddle state transitions, so that a restart can rebuild
+    the PositionManager's straddles from local disk in milliseconds.
+
+    Recording a transition only appends a tuple to an in-memory deque; a background
+    thread packs the records, appends them to the journal file and keeps its own copy
+    of the state, which it writes out as a snapshot (and then empties the journal) every
+    COMPACT_EVERY records. Records reach the OS within FLUSH_INTERVAL_SECONDS, so a
+    crash of the bot loses at most that window, which the broker reconcile covers.
+    """
+
+    def __init__(self, directory: str = JOURNAL_DIR, flush_interval: float = FLUSH_INTERVAL_SECONDS,
+                 compact_every: int = COMPACT_EVERY):
+        self.directory = directory
+        self.journal_path = os.path.join(directory, JOURNAL_FILE)
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+        self.flush_interval = flush_interval
+        self.compact_every = compact_every
+        self._pending: Deque[tuple] = deque()
+        self._state: Dict[int, _Entry] = {}
+        self._file: Optional[BinaryIO] = None
+        self._records = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # Recording, called from the reactor thread
+
+    def added(self, straddle: Straddle) -> None:
+        self._pending.append((OP_ADD, straddle.straddle_id, straddle.symbol, straddle.symbol_id,
+                              _STATE_CODES[straddle.state], _leg_entry(straddle.buy), _leg_entry(straddle.sell)))
+
+    def position_indexed(self, leg: StraddleLeg) -> None:
+        self._pending.append((OP_POSITION, leg.straddle.straddle_id, leg is leg.straddle.sell, leg.position_id, 0.0))
+
+    def price_updated(self, leg: StraddleLeg) -> None:
+        self._pending.append((OP_PRICE, leg.straddle.straddle_id, leg is leg.straddle.sell, 0, leg.entry_price))
+
+    def leg_closed(self, leg: StraddleLeg) -> None:
+        straddle = leg.straddle
+        self._pending.append((OP_LEG_CLOSED, straddle.straddle_id, leg is straddle.sell,
+                              _STATE_CODES[straddle.state], 0.0))
+
+    def removed(self, straddle: Straddle) -> None:
+        self._pending.append((OP_REMOVE, straddle.straddle_id, 0, 0, 0.0))
+
+    # Lifecycle
+
+    def recover(self) -> List[Straddle]:
+        """
+        Rebuilds the straddles from the snapshot and the journal, then starts a fresh
+        journal on a new snapshot and starts the writer thread. Call once, before recording.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self._state = {}
+        records = _read(self.snapshot_path, self._state) + _read(self.journal_path, self._state)
+        self._compact()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="state-journal", daemon=True)
+        self._thread.start()
+
+        straddles = [_straddle(straddle_id, entry) for straddle_id, entry in self._state.items()]
+        logging.info(f"Recovered {len(straddles)} straddle(s) from {records} journal record(s).")
+        return straddles
+
+    def stop(self) -> None:
+        """Writes out everything still queued, compacts the journal and stops the writer thread."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if self._file is not None:
+            self._compact()
+            self._file.close()
+            self._file = None
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    # Writer thread
+
+    def flush(self) -> None:
+        """Appends the queued records to the journal. Called from the writer thread."""
+        pending = self._pending
+        if not pending:
+            return
+        buffer = bytearray()
+        try:
+            while True:
+                record = pending.popleft()
+                _apply(self._state, record)
+                buffer += _pack(record)
+                self._records += 1
+        except IndexError:
+            pass
+
+        try:
+            self._file.write(buffer)
+            self._file.flush()
+        except OSError as e:
+            logging.error(f"Failed to write the state journal: {e}")
+        if self._records >= self.compact_every:
+            self._compact()
+
+    def _compact(self) -> None:
+        """Writes the current state as the snapshot and starts an empty journal."""
+        buffer = bytearray(HEADER.pack(MAGIC, VERSION))
+        for straddle_id, (symbol, symbol_id, state, buy, sell) in self._state.items():
+            buffer += _pack((OP_ADD, straddle_id, symbol, symbol_id, state, buy, sell))
+        try:
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(buffer)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+
+            # Replaying the old journal over the new snapshot is harmless, so a crash here loses nothing
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.journal_path, "wb")
+            self._file.write(HEADER.pack(MAGIC, VERSION))
+            self._file.flush()
+            self._records = 0
+        except OSError as e:
+            logging.error(f"Failed to compact the state journal: {e}")
+
+
+def _leg_entry(leg: StraddleLeg) -> _Entry:
+    return [leg.account_id, leg.order_id, leg.position_id, leg.entry_price, leg.volume, leg.closed]
+
+
+def _pack(record: tuple) -> bytes:
+    if record[0] == OP_ADD:
+        op, straddle_id, symbol, symbol_id, state, buy, sell = record
+        name = symbol.encode("utf-8")
+        return ADD.pack(op, straddle_id, symbol_id, state, len(name), *buy, *sell) + name
+    return UPDATE.pack(*record)
+
+
+def _record_size(data, offset: int) -> Optional[int]:
+    """The size of the record at offset, or None if it is not a complete record."""
+    size = _SIZES.get(data[offset])
+    if size is None or offset + size > len(data):
+        return None
+    if data[offset] == OP_ADD:
+        size += ADD.unpack_from(data, offset)[4]
+        if offset + size > len(data):
+            return None
+    return size
+
+
+def _unpack(data, offset: int) -> tuple:
+    op = data[offset]
+    if op == OP_ADD:
+        values = ADD.unpack_from(data, offset)
+        _, straddle_id, symbol_id, state, name_length = values[:5]
+        start = offset + ADD.size
+        symbol = bytes(data[start:start + name_length]).decode("utf-8")
+        return op, straddle_id, symbol, symbol_id, state, list(values[5:11]), list(values[11:17])
+    return UPDATE.unpack_from(data, offset)
+
+
+def _apply(state: Dict[int, _Entry], record: tuple) -> None:
+    """Applies a record to the writer's copy of the state; applying one twice changes nothing."""
+    op, straddle_id = record[0], record[1]
+    if op == OP_ADD:
+        state[straddle_id] = list(record[2:])
+        return
+    entry = state.get(straddle_id)
+    if entry is None:
+        return
+    if op == OP_REMOVE:
+        del state[straddle_id]
+        return
+    leg = entry[4] if record[2] else entry[3]
+    if op == OP_POSITION:
+        leg[2] = record[3]
+    elif op == OP_PRICE:
+        leg[3] = record[4]
+    elif op == OP_LEG_CLOSED:
+        leg[5] = True
+        entry[2] = record[3]
+
+
+def _read(path: str, state: Dict[int, _Entry]) -> int:
+    """Applies the records of a journal or snapshot file to state and returns how many there were."""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return 0
+    if len(data) < HEADER.size or HEADER.unpack_from(data, 0) != (MAGIC, VERSION):
+        logging.warning(f"Ignoring {path}: not a version {VERSION} state journal.")
+        return 0
+
+    offset = HEADER.size
+    records = 0
+    while offset < len(data):
+        size = _record_size(data, offset)
+        try:
+            record = _unpack(data, offset) if size is not None else None
+        except UnicodeDecodeError:
+            record = None
+        if record is None:
+            # A partial record left by a write in progress, or garbage after it
+            logging.warning(f"Ignoring {len(data) - offset} trailing byte(s) of {path}.")
+            break
+        _apply(state, record)
+        offset += size
+        records += 1
+    return records
+
+
+def _straddle(straddle_id: int, entry: _Entry) -> Straddle:
+    symbol, symbol_id, state, buy, sell = entry
+    legs = []
+    for side, (account_id, order_id, position_id, entry_price, volume, closed) in (("buy", buy), ("sell", sell)):
+        leg = StraddleLeg(side, account_id, order_id, position_id, entry_price, volume)
+        leg.closed = bool(closed)
+        legs.append(leg)
+    straddle = Straddle(symbol, legs[0], legs[1], symbol_id=symbol_id, straddle_id=straddle_id)
+    straddle.state = _STATES[state]
+    return straddle
@@ -1,71 +1,175 @@
-from typing import Dict, Any
+import logging
+from typing import Any, Callable
 
-from pepper_bot.core.config import get_all_settings
+from pepper_bot.core.config import Settings, get_settings
 from pepper_bot.core.database import log_trade
 from pepper_bot.ctrader.client import CTraderApiClient
-from ctrader_open_api.messages.OpenApiModelMessages_pb2 import ProtoOAExecutionType, ProtoOATradeSide
+from pepper_bot.ctrader.symbols import SymbolCatalogue
+from pepper_bot.trading.trailing import TrailingStopEngine, DEFAULT_POINT_SIZE, DEFAULT_DIGITS
+from pepper_bot.trading.journal import StateJournal
+from pepper_bot.trading.straddle import (Straddle, StraddleLeg, StraddleRegistry, OPEN, ONE_LEG_CLOSED, CLOSED,
+                                         reserve_straddle_ids)
+from ctrader_open_api.messages.OpenApiModelMessages_pb2 import ProtoOAExecutionType, ProtoOAPositionStatus
+
+_FILL_EVENTS = (ProtoOAExecutionType.ORDER_FILLED, ProtoOAExecutionType.ORDER_PARTIAL_FILL)
+
 
 class PositionManager:
     """
     Manages the open positions and the state machine for the straddle trade.
+    Straddles carry their own accounts, so one PositionManager serves any number of
+    account pairs; account1_id and account2_id are the default pair.
     """
-    def __init__(self, client: CTraderApiClient, account1_id: int, account2_id: int):
+    def __init__(self, client: CTraderApiClient, account1_id: int, account2_id: int,
+                 trailing_engine: TrailingStopEngine = None, symbols: SymbolCatalogue = None,
+                 settings: Callable[[], Settings] = get_settings, journal: StateJournal = None):
         self.client = client
         self.account1_id = account1_id
         self.account2_id = account2_id
-        self.active_straddles: Dict[str, Any] = {}
+        self.active_straddles = StraddleRegistry()
+        # An engine tracking nothing is falsy, so compare against None
+        self.trailing_engine = trailing_engine if trailing_engine is not None else TrailingStopEngine(client)
+        self.symbols = symbols
+        self.settings = settings
+        # Records every state transition for crash recovery, when set
+        self.journal = journal
+        self._monitoring = False
 
     def start_monitoring(self):
-        """Starts monitoring the execution events."""
-        self.client.subscribe_to_execution_events(self.handle_execution_event)
+        """Starts monitoring the execution events; calling it again changes nothing."""
+        if not self._monitoring:
+            self._monitoring = True
+            self.client.subscribe_to_execution_events(self.handle_execution_event)
 
     def handle_execution_event(self, event: Any):
         """Handles an execution event from the cTrader API."""
-        if event.executionType != ProtoOAExecutionType.ORDER_FILLED and event.executionType != ProtoOAExecutionType.ORDER_CLOSED:
+        if event.executionType not in _FILL_EVENTS:
             return
 
-        position_id = event.order.positionId
+        position_id = event.position.positionId or event.order.positionId
+        leg = self.active_straddles.find_leg(position_id, event.order.orderId)
+        if leg is None:
+            return
 
-        for symbol, straddle in self.active_straddles.items():
-            if straddle["buy"].order.positionId == position_id:
-                self.handle_straddle_event(symbol, "buy", event)
-            elif straddle["sell"].order.positionId == position_id:
-                self.handle_straddle_event(symbol, "sell", event)
+        if position_id and leg.position_id != position_id:
+            # The order was accepted before the position existed; index it now
+            self.active_straddles.index_position(leg, position_id)
+            if self.journal is not None:
+                self.journal.position_indexed(leg)
 
-    def handle_straddle_event(self, symbol: str, side: str, event: Any):
-        """Handles an execution event for a straddle trade."""
-        straddle = self.active_straddles[symbol]
+        if event.position.positionStatus == ProtoOAPositionStatus.POSITION_STATUS_CLOSED:
+            self.handle_straddle_event(leg, event)
+        elif event.position.price and event.position.price != leg.entry_price:
+            leg.entry_price = event.position.price
+            if self.journal is not None:
+                self.journal.price_updated(leg)
 
-        if straddle["state"] == "OPEN" and event.executionType == ProtoOAExecutionType.ORDER_CLOSED:
+    def handle_straddle_event(self, leg: StraddleLeg, event: Any):
+        """Handles the closing of one leg of a straddle trade."""
+        if leg.closed:
+            return
+        leg.closed = True
+        straddle = leg.straddle
+
+        if straddle.state == OPEN:
             # One leg of the straddle has closed, so the other is the winner
-            winner_side = "buy" if side == "sell" else "sell"
-            winner = straddle[winner_side]
-
-            # Move the winner's stop loss to break-even and activate the trailing stop
-            settings = get_all_settings()
-            trailing_stop = settings["trailing_stop"][symbol]
-
-            self.client.modify_position(
-                ctid_trader_account_id=winner.order.ctidTraderAccountId,
-                position_id=winner.order.positionId,
-                stop_loss=winner.order.openPrice,
-                trailing_stop=trailing_stop
-            )
-
-            straddle["state"] = "ONE_LEG_CLOSED"
-        elif straddle["state"] == "ONE_LEG_CLOSED" and event.executionType == ProtoOAExecutionType.ORDER_CLOSED:
+            winner = straddle.other(leg)
+
+            # Move the winner's stop loss to break-even, then trail it locally from the spot stream
+            self._trail(straddle, winner, winner.entry_price, amend=True)
+
+            straddle.state = ONE_LEG_CLOSED
+            if self.journal is not None:
+                self.journal.leg_closed(leg)
+        elif straddle.state == ONE_LEG_CLOSED:
             # The second leg of the straddle has closed, so the trade is complete
             # Log the trade to the database
             # This is a placeholder for the actual logic
-            print(f"Straddle trade for {symbol} is complete.")
+            logging.info(f"Straddle trade #{straddle.straddle_id} for {straddle.symbol} is complete.")
+
+            straddle.state = CLOSED
+            self.discard_straddle(straddle)
+
+    def _trail(self, straddle: Straddle, winner: StraddleLeg, stop: float, amend: bool):
+        """Starts trailing the winning leg's stop loss from `stop`, with the symbol's trailing settings."""
+        settings = self.settings()
+        trailing_stop = settings.trailing_stop[straddle.symbol]
+        trailing_step = settings.trailing_step.get(straddle.symbol, 1)
+        symbol = self.symbols.get(straddle.symbol_id) if self.symbols is not None else None
+        point_size = symbol.point_size if symbol is not None else DEFAULT_POINT_SIZE
+
+        self.trailing_engine.track(
+            account_id=winner.account_id,
+            position_id=winner.position_id,
+            symbol_id=straddle.symbol_id,
+            is_buy=winner is straddle.buy,
+            distance=trailing_stop * point_size,
+            stop=stop,
+            min_step=trailing_step * point_size,
+            digits=symbol.digits if symbol is not None else DEFAULT_DIGITS,
+            amend=amend,
+        )
+
+    def _register(self, straddle: Straddle) -> Straddle:
+        self.active_straddles.add(straddle)
+        if self.journal is not None:
+            self.journal.added(straddle)
+        return straddle
+
+    def discard_straddle(self, straddle: Straddle):
+        """Stops managing a straddle, e.g. once both of its legs have closed."""
+        for leg in (straddle.buy, straddle.sell):
+            if leg.position_id:
+                self.trailing_engine.untrack(leg.position_id)
+        self.active_straddles.remove(straddle)
+        if self.journal is not None:
+            self.journal.removed(straddle)
+
+    def recover(self) -> int:
+        """
+        Re-registers the straddles recorded in the journal, without trailing anything yet:
+        the stops to trail from come with the broker reconcile (see resume_trailing).
+        Returns how many straddles were recovered.
+        """
+        if self.journal is None:
+            return 0
+        straddles = self.journal.recover()
+        for straddle in straddles:
+            self.active_straddles.add(straddle)
+        reserve_straddle_ids(max((straddle.straddle_id for straddle in straddles), default=0))
+        return len(straddles)
+
+    def resume_trailing(self, straddle: Straddle, stop_loss: float):
+        """Resumes trailing the open leg of a recovered straddle from its current stop loss (0 if it has none)."""
+        winner = straddle.sell if straddle.buy.closed else straddle.buy
+        if not stop_loss:
+            stop_loss = float("-inf") if winner is straddle.buy else float("inf")
+        self._trail(straddle, winner, stop_loss, amend=False)
 
-            del self.active_straddles[symbol]
+    def restore_straddle(self, symbol: str, symbol_id: int, buy: StraddleLeg, sell: StraddleLeg) -> Straddle:
+        """Re-registers a straddle whose two legs are still open, e.g. after a restart."""
+        return self._register(Straddle(symbol, buy, sell, symbol_id=symbol_id))
 
+    def restore_winner(self, symbol: str, symbol_id: int, winner: StraddleLeg, stop_loss: float) -> Straddle:
+        """
+        Re-registers the open leg of a straddle whose other leg has closed, and resumes
+        trailing it from its current stop loss (0 if it has none).
+        """
+        is_buy = winner.side == "buy"
+        loser = StraddleLeg("sell" if is_buy else "buy", 0)
+        loser.closed = True
+        straddle = Straddle(symbol, winner if is_buy else loser, loser if is_buy else winner, symbol_id=symbol_id)
+        straddle.state = ONE_LEG_CLOSED
+        self._register(straddle)
+        self.resume_trailing(straddle, stop_loss)
+        return straddle
 
-    def add_straddle(self, symbol: str, buy_order: Any, sell_order: Any):
+    def add_straddle(self, symbol: str, buy_order: Any, sell_order: Any, symbol_id: int = 0) -> Straddle:
         """Adds a new straddle trade to the position manager."""
-        self.active_straddles[symbol] = {
-            "buy": buy_order,
-            "sell": sell_order,
-            "state": "OPEN",  # Can be OPEN, ONE_LEG_CLOSED
-        }
+        straddle = Straddle(
+            symbol,
+            StraddleLeg.from_execution("buy", buy_order),
+            StraddleLeg.from_execution("sell", sell_order),
+            symbol_id=symbol_id or buy_order.order.tradeData.symbolId,
+        )
+        return self._register(straddle)
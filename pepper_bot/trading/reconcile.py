@@ -0,0 +1,143 @@
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from twisted.internet.defer import Deferred, gatherResults
+
+from pepper_bot.ctrader.client import EXECUTION_EVENT
+from pepper_bot.ctrader.symbols import SymbolCatalogue
+from pepper_bot.trading.position_manager import PositionManager
+from pepper_bot.trading.straddle import StraddleLeg, ONE_LEG_CLOSED
+from ctrader_open_api.messages.OpenApiModelMessages_pb2 import ProtoOATradeSide
+
+# Both legs of a straddle are sent together, so their open times lie well within this of each other
+PAIRING_WINDOW_MS = 5000
+
+
+def reconcile_positions(client: Any, account_ids: Iterable[int], position_manager: PositionManager,
+                        symbols: SymbolCatalogue = None,
+                        account_pairs: Optional[Iterable[Tuple[int, int]]] = None) -> Deferred:
+    """
+    Requests the open positions of every account concurrently, brings the straddles
+    already in position_manager (e.g. recovered from its journal) up to date with them,
+    rebuilds the straddles the others belong to and resumes trailing their winning legs.
+    Execution events arriving meanwhile are held back and replayed once the straddles
+    are restored, so a leg closing mid-reconcile is not missed.
+    Fires with the counts returned by restore_straddles. Reactor thread only.
+    """
+    account_ids = list(account_ids)
+    held_back: List[Any] = []
+    client.register_handler(EXECUTION_EVENT, held_back.append)
+
+    def on_reconciled(responses):
+        positions = [(response.ctidTraderAccountId, position)
+                     for response in responses for position in response.position]
+        return restore_straddles(position_manager, positions, symbols, account_pairs)
+
+    def finish(result):
+        client.unregister_handler(EXECUTION_EVENT, held_back.append)
+        position_manager.start_monitoring()
+        for event in held_back:
+            position_manager.handle_execution_event(event)
+        return result
+
+    d = gatherResults([client.reconcile(account_id) for account_id in account_ids], consumeErrors=True)
+    d.addCallback(on_reconciled)
+    d.addBoth(finish)
+    return d
+
+
+def restore_straddles(position_manager: PositionManager, positions: List[Tuple[int, Any]],
+                      symbols: SymbolCatalogue = None,
+                      account_pairs: Optional[Iterable[Tuple[int, int]]] = None) -> Dict[str, int]:
+    """
+    Matches (account id, ProtoOAPosition) entries against the straddles position_manager
+    already knows: legs missing from the positions closed while the bot was down or
+    disconnected. The remaining positions are paired into straddles: a BUY and a SELL on
+    the same symbol with the same volume, on different accounts (the two accounts of one
+    of account_pairs, if given), opened within PAIRING_WINDOW_MS of each other. Pairs are
+    restored as open straddles and lone legs on a configured pair as straddles whose
+    other leg has closed; anything else is left alone.
+    """
+    counts = {"known": 0, "straddles": 0, "single_legs": 0, "orphans": 0}
+    open_positions = {position.positionId: position for _, position in positions}
+    for straddle in position_manager.active_straddles:
+        counts["known"] += 1
+        legs = [leg for leg in (straddle.buy, straddle.sell) if not leg.closed]
+        closed = [leg for leg in legs if leg.position_id not in open_positions]
+        if len(closed) == len(legs):
+            logging.info(f"Straddle #{straddle.straddle_id} on {straddle.symbol} closed while its execution events "
+                         f"were missed.")
+            position_manager.discard_straddle(straddle)
+        elif closed:
+            # Its first leg closed while its events were missed: move the winner to break-even as usual
+            position_manager.handle_straddle_event(closed[0], None)
+        elif straddle.state == ONE_LEG_CLOSED:
+            position_manager.resume_trailing(straddle, open_positions[legs[0].position_id].stopLoss)
+
+    groups: Dict[Tuple[int, int], Tuple[List[Tuple[int, Any]], List[Tuple[int, Any]]]] = {}
+    for account_id, position in positions:
+        if position_manager.active_straddles.find_leg(position.positionId) is not None:
+            continue
+        key = (position.tradeData.symbolId, position.tradeData.volume)
+        buys, sells = groups.setdefault(key, ([], []))
+        (buys if position.tradeData.tradeSide == ProtoOATradeSide.BUY else sells).append((account_id, position))
+
+    partners = _partners(account_pairs) if account_pairs is not None else None
+    pairs = position_manager.settings().pairs
+    for (symbol_id, _), (buys, sells) in groups.items():
+        symbol = symbols.get(symbol_id) if symbols is not None else None
+        if symbol is None or not pairs.get(symbol.name):
+            counts["orphans"] += len(buys) + len(sells)
+            logging.warning(f"Leaving {len(buys) + len(sells)} open position(s) on symbol {symbol_id} unmanaged: "
+                            f"not a configured pair.")
+            continue
+
+        for buy, sell in _pair_legs(buys, sells, partners):
+            if buy is not None and sell is not None:
+                position_manager.restore_straddle(symbol.name, symbol_id,
+                                                  StraddleLeg.from_position("buy", buy[0], buy[1]),
+                                                  StraddleLeg.from_position("sell", sell[0], sell[1]))
+                counts["straddles"] += 1
+            else:
+                account_id, position = buy or sell
+                side = "buy" if buy is not None else "sell"
+                position_manager.restore_winner(symbol.name, symbol_id,
+                                                StraddleLeg.from_position(side, account_id, position),
+                                                position.stopLoss)
+                counts["single_legs"] += 1
+
+    logging.info(f"Reconciled {len(positions)} open position(s) against {counts['known']} known straddle(s): "
+                 f"{counts['straddles']} straddle(s) and {counts['single_legs']} single leg(s) rebuilt, "
+                 f"{counts['orphans']} unmanaged.")
+    return counts
+
+
+def _partners(account_pairs: Iterable[Tuple[int, int]]) -> Dict[int, Set[int]]:
+    partners: Dict[int, Set[int]] = {}
+    for first, second in account_pairs:
+        partners.setdefault(first, set()).add(second)
+        partners.setdefault(second, set()).add(first)
+    return partners
+
+
+def _pair_legs(buys: List[Tuple[int, Any]], sells: List[Tuple[int, Any]],
+               partners: Optional[Dict[int, Set[int]]] = None) -> List[Tuple[Any, Any]]:
+    """
+    Matches each BUY with the SELL opened closest to it on another account (on a partner
+    account, if partners are given); unmatched legs pair with None.
+    """
+    buys = sorted(buys, key=lambda leg: leg[1].tradeData.openTimestamp)
+    sells = sorted(sells, key=lambda leg: leg[1].tradeData.openTimestamp)
+    result = []
+    for buy in buys:
+        opened = buy[1].tradeData.openTimestamp
+        best = None
+        for i, sell in enumerate(sells):
+            if sell[0] == buy[0] or (partners is not None and sell[0] not in partners.get(buy[0], ())):
+                continue
+            gap = abs(sell[1].tradeData.openTimestamp - opened)
+            if gap <= PAIRING_WINDOW_MS and (best is None or gap < best[1]):
+                best = (i, gap)
+        result.append((buy, sells.pop(best[0]) if best is not None else None))
+    result.extend((None, sell) for sell in sells)
+    return result
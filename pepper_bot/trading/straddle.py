@@ -0,0 +1,144 @@
+import itertools
+from typing import Dict, Iterator, Optional, Tuple, Any
+
+OPEN = "OPEN"
+ONE_LEG_CLOSED = "ONE_LEG_CLOSED"
+CLOSED = "CLOSED"
+
+_straddle_ids = itertools.count(1)
+
+
+def reserve_straddle_ids(last_id: int) -> None:
+    """Makes new straddles get ids above last_id, e.g. once journaled straddles are restored."""
+    global _straddle_ids
+    _straddle_ids = itertools.count(max(next(_straddle_ids), last_id + 1))
+
+
+class StraddleLeg:
+    """One side (BUY or SELL) of a straddle, living on a single trading account."""
+    __slots__ = ("straddle", "side", "account_id", "order_id", "position_id", "entry_price", "volume", "closed")
+
+    def __init__(self, side: str, account_id: int, order_id: int = 0, position_id: int = 0,
+                 entry_price: float = 0.0, volume: int = 0):
+        self.straddle: Optional["Straddle"] = None
+        self.side = side
+        self.account_id = account_id
+        self.order_id = order_id
+        self.position_id = position_id
+        self.entry_price = entry_price
+        self.volume = volume
+        self.closed = False
+
+    @classmethod
+    def from_execution(cls, side: str, event: Any) -> "StraddleLeg":
+        """Builds a leg from the execution event returned for a new order."""
+        order = event.order
+        position_id = order.positionId or event.position.positionId
+        entry_price = event.position.price or order.executionPrice
+        return cls(side, event.ctidTraderAccountId, order.orderId, position_id, entry_price, order.tradeData.volume)
+
+    @classmethod
+    def from_position(cls, side: str, account_id: int, position: Any) -> "StraddleLeg":
+        """Builds a leg from an open position, e.g. one returned by a reconcile request."""
+        return cls(side, account_id, 0, position.positionId, position.price, position.tradeData.volume)
+
+    def __repr__(self):
+        return (f"StraddleLeg({self.side}, account={self.account_id}, order={self.order_id}, "
+                f"position={self.position_id}, closed={self.closed})")
+
+
+class Straddle:
+    """A BUY leg and a SELL leg on the same symbol, held on two different accounts."""
+    __slots__ = ("straddle_id", "symbol", "symbol_id", "buy", "sell", "state")
+
+    def __init__(self, symbol: str, buy: StraddleLeg, sell: StraddleLeg, symbol_id: int = 0,
+                 straddle_id: Optional[int] = None):
+        self.straddle_id = straddle_id if straddle_id is not None else next(_straddle_ids)
+        self.symbol = symbol
+        self.symbol_id = symbol_id
+        self.buy = buy
+        self.sell = sell
+        self.state = OPEN
+        buy.straddle = self
+        sell.straddle = self
+
+    @property
+    def pair_key(self) -> Tuple[str, int, int]:
+        return (self.symbol, self.buy.account_id, self.sell.account_id)
+
+    def other(self, leg: StraddleLeg) -> StraddleLeg:
+        return self.sell if leg is self.buy else self.buy
+
+    def __repr__(self):
+        return f"Straddle(#{self.straddle_id} {self.symbol} {self.state} buy={self.buy!r} sell={self.sell!r})"
+
+
+class StraddleRegistry:
+    """
+    Indexes open straddles by positionId, orderId and (symbol, buy account, sell account),
+    so that execution events are routed to their leg in constant time.
+    """
+
+    def __init__(self):
+        self._straddles: Dict[int, Straddle] = {}
+        self._by_position: Dict[int, StraddleLeg] = {}
+        self._by_order: Dict[int, StraddleLeg] = {}
+        self._by_pair: Dict[Tuple[str, int, int], Dict[int, Straddle]] = {}
+
+    def __len__(self) -> int:
+        return len(self._straddles)
+
+    def __iter__(self) -> Iterator[Straddle]:
+        # Iterate over a copy so callers may remove straddles while iterating
+        return iter(list(self._straddles.values()))
+
+    def __contains__(self, straddle_id: int) -> bool:
+        return straddle_id in self._straddles
+
+    def get(self, straddle_id: int) -> Optional[Straddle]:
+        return self._straddles.get(straddle_id)
+
+    def add(self, straddle: Straddle) -> Straddle:
+        self._straddles[straddle.straddle_id] = straddle
+        self._by_pair.setdefault(straddle.pair_key, {})[straddle.straddle_id] = straddle
+        for leg in (straddle.buy, straddle.sell):
+            if leg.order_id:
+                self._by_order[leg.order_id] = leg
+            if leg.position_id:
+                self._by_position[leg.position_id] = leg
+        return straddle
+
+    def remove(self, straddle: Straddle) -> None:
+        if self._straddles.pop(straddle.straddle_id, None) is None:
+            return
+        pair = self._by_pair.get(straddle.pair_key)
+        if pair is not None:
+            pair.pop(straddle.straddle_id, None)
+            if not pair:
+                del self._by_pair[straddle.pair_key]
+        for leg in (straddle.buy, straddle.sell):
+            if self._by_order.get(leg.order_id) is leg:
+                del self._by_order[leg.order_id]
+            if self._by_position.get(leg.position_id) is leg:
+                del self._by_position[leg.position_id]
+
+    def index_position(self, leg: StraddleLeg, position_id: int) -> None:
+        """Records the positionId of a leg once the broker has assigned it."""
+        if leg.position_id and self._by_position.get(leg.position_id) is leg:
+            del self._by_position[leg.position_id]
+        leg.position_id = position_id
+        self._by_position[position_id] = leg
+
+    def find_leg(self, position_id: int = 0, order_id: int = 0) -> Optional[StraddleLeg]:
+        """Returns the leg owning the given positionId or orderId, if any."""
+        if position_id:
+            leg = self._by_position.get(position_id)
+            if leg is not None:
+                return leg
+        if order_id:
+            return self._by_order.get(order_id)
+        return None
+
+    def for_pair(self, symbol: str, buy_account_id: int, sell_account_id: int) -> Iterator[Straddle]:
+        """Returns the open straddles on a symbol for a given account pair."""
+        return iter(list(self._by_pair.get((symbol, buy_account_id, sell_account_id), {}).values()))
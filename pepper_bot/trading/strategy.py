@@ -1,45 +1,38 @@
-from twisted.internet.defer import Deferred, gatherResults
+import logging
+from typing import Dict, Tuple
 
-from pepper_bot.core.config import get_all_settings
-from pepper_bot.ctrader.client import CTraderApiClient
-from ctrader_open_api.messages.OpenApiModelMessages_pb2 import ProtoOAOrderType, ProtoOATradeSide
+from twisted.internet.defer import Deferred
 
-def place_straddle_trade(client1: CTraderApiClient, client2: CTraderApiClient, symbol_id: int, symbol_name: str) -> Deferred:
-    """
-    Places a straddle trade (simultaneous BUY and SELL orders) on the given symbol.
-    """
-    settings = get_all_settings()
-    volume = settings["volume"][symbol_name]
-    stop_loss = settings["stop_loss"][symbol_name]
+from pepper_bot.ctrader.client import CTraderApiClient
+from pepper_bot.ctrader.symbols import SymbolInfo
+from pepper_bot.trading.submission import StraddleSubmitter
 
-    print(f"Placing straddle trade for symbol {symbol_name} with volume {volume} and stop loss {stop_loss} ticks...")
+# One submitter per client pair, so order templates and latency stats are kept across trades
+_submitters: Dict[Tuple[CTraderApiClient, CTraderApiClient], StraddleSubmitter] = {}
 
-    # We need to convert the volume and stop loss to the correct format for the API.
-    # For now, we'll just pass them as is.
 
-    buy_order_deferred = client1.place_order(
-        symbol_id=symbol_id,
-        order_type=ProtoOAOrderType.MARKET,
-        trade_side=ProtoOATradeSide.BUY,
-        volume=volume,
-        stop_loss=stop_loss
-    )
+def get_submitter(client1: CTraderApiClient, client2: CTraderApiClient) -> StraddleSubmitter:
+    """Returns the straddle submitter for a BUY/SELL client pair."""
+    submitter = _submitters.get((client1, client2))
+    if submitter is None:
+        submitter = _submitters[(client1, client2)] = StraddleSubmitter(client1, client2)
+    return submitter
 
-    sell_order_deferred = client2.place_order(
-        symbol_id=symbol_id,
-        order_type=ProtoOAOrderType.MARKET,
-        trade_side=ProtoOATradeSide.SELL,
-        volume=volume,
-        stop_loss=stop_loss
-    )
 
-    d = gatherResults([buy_order_deferred, sell_order_deferred])
+def place_straddle_trade(client1: CTraderApiClient, client2: CTraderApiClient, symbol: SymbolInfo,
+                         account1_id: int, account2_id: int) -> Deferred:
+    """
+    Places a straddle trade (simultaneous BUY and SELL orders) on the given symbol.
+    The BUY leg goes to account1_id on client1 and the SELL leg to account2_id on client2.
+    Must be called from the reactor thread.
+    """
+    logging.info(f"Placing straddle trade for symbol {symbol.name}...")
+    d = get_submitter(client1, client2).submit(symbol, account1_id, account2_id)
 
     def on_orders_placed(results):
         buy_order, sell_order = results
-        print(f"Straddle trade placed successfully:")
-        print(f"  BUY order: {buy_order}")
-        print(f"  SELL order: {sell_order}")
+        logging.info(f"Straddle trade on {symbol.name} placed: BUY order {buy_order.order.orderId}, "
+                     f"SELL order {sell_order.order.orderId}.")
         return buy_order, sell_order
 
     d.addCallback(on_orders_placed)
@@ -0,0 +1,178 @@
+import logging
+import time
+from typing import Any, Callable, Dict, Tuple
+
+from twisted.internet.defer import Deferred, gatherResults
+
+from pepper_bot.core import metrics
+from pepper_bot.core.config import Settings, get_settings
+from pepper_bot.ctrader.client import CTraderApiClient, EXECUTION_EVENT
+from pepper_bot.ctrader.symbols import SymbolInfo
+from ctrader_open_api.messages.OpenApiMessages_pb2 import ProtoOANewOrderReq
+from ctrader_open_api.messages.OpenApiModelMessages_pb2 import (
+    ProtoOAExecutionType, ProtoOAOrderType, ProtoOAPayloadType, ProtoOATradeSide,
+)
+
+NEW_ORDER_REQ = ProtoOAPayloadType.PROTO_OA_NEW_ORDER_REQ
+
+_FILL_TYPES = (ProtoOAExecutionType.ORDER_FILLED, ProtoOAExecutionType.ORDER_PARTIAL_FILL)
+
+# Orders ending without a fill; they are no longer awaited
+_END_TYPES = (ProtoOAExecutionType.ORDER_REJECTED, ProtoOAExecutionType.ORDER_CANCELLED,
+              ProtoOAExecutionType.ORDER_EXPIRED)
+
+
+class OrderTemplate:
+    """A market order for one symbol, account and side, serialized ahead of time."""
+    __slots__ = ("symbol_id", "account_id", "trade_side", "volume", "relative_stop_loss", "payload", "settings")
+
+    def __init__(self, symbol: SymbolInfo, account_id: int, trade_side: int, settings: Settings):
+        self.symbol_id = symbol.symbol_id
+        self.account_id = account_id
+        self.trade_side = trade_side
+        # Settings hold the volume in lots and the stop loss in points
+        self.volume = symbol.lots_to_volume(settings.volume[symbol.name])
+        self.relative_stop_loss = symbol.points_to_relative(settings.stop_loss[symbol.name])
+        # The settings snapshot this template was built from; a new snapshot invalidates it
+        self.settings = settings
+
+        request = ProtoOANewOrderReq()
+        request.ctidTraderAccountId = account_id
+        request.symbolId = symbol.symbol_id
+        request.orderType = ProtoOAOrderType.MARKET
+        request.tradeSide = trade_side
+        request.volume = self.volume
+        if self.relative_stop_loss:
+            request.relativeStopLoss = self.relative_stop_loss
+        self.payload = request.SerializeToString()
+
+
+class LegTiming:
+    """Send, acknowledgement and fill times of one leg, in perf_counter nanoseconds."""
+    __slots__ = ("submission", "order_id", "sent_ns", "ack_ns", "fill_ns")
+
+    def __init__(self, submission: "StraddleSubmission"):
+        self.submission = submission
+        self.order_id = 0
+        self.sent_ns = 0
+        self.ack_ns = 0
+        self.fill_ns = 0
+
+
+class StraddleSubmission:
+    __slots__ = ("symbol", "buy", "sell", "failed")
+
+    def __init__(self, symbol: str):
+        self.symbol = symbol
+        self.buy = LegTiming(self)
+        self.sell = LegTiming(self)
+        self.failed = False
+
+
+class StraddleSubmitter:
+    """
+    Submits both legs of a straddle back to back from pre-built order templates and
+    records send-to-accept, accept-to-fill and send-to-fill latency per leg plus the
+    fill skew between legs, in the process-wide metrics.
+    Must be used from the reactor thread.
+    """
+
+    def __init__(self, buy_client: CTraderApiClient, sell_client: CTraderApiClient,
+                 settings: Callable[[], Settings] = get_settings):
+        self.buy_client = buy_client
+        self.sell_client = sell_client
+        self.settings = settings
+        self._templates: Dict[Tuple[int, int, int], OrderTemplate] = {}
+        self._awaiting_fill: Dict[int, LegTiming] = {}
+
+        self.send_to_ack = metrics.histogram("order_send_to_accept_seconds", "New order sent to first execution event")
+        self.ack_to_fill = metrics.histogram("order_accept_to_fill_seconds", "New order accepted to filled")
+        self.send_to_fill = metrics.histogram("order_send_to_fill_seconds", "New order sent to filled")
+        self.fill_skew = metrics.histogram("straddle_fill_skew_seconds", "Time between the fills of a straddle's legs")
+
+        buy_client.register_handler(EXECUTION_EVENT, self._on_execution_event)
+        if sell_client is not buy_client:
+            sell_client.register_handler(EXECUTION_EVENT, self._on_execution_event)
+
+    def template(self, symbol: SymbolInfo, account_id: int, trade_side: int) -> OrderTemplate:
+        """Returns the order template for a symbol, account and side, rebuilding it if the settings changed."""
+        settings = self.settings()
+        key = (symbol.symbol_id, account_id, trade_side)
+        template = self._templates.get(key)
+        if template is None or template.settings is not settings:
+            template = self._templates[key] = OrderTemplate(symbol, account_id, trade_side, settings)
+        return template
+
+    def prepare(self, symbol: SymbolInfo, buy_account_id: int, sell_account_id: int) -> None:
+        """Builds the templates for a straddle ahead of time."""
+        self.template(symbol, buy_account_id, ProtoOATradeSide.BUY)
+        self.template(symbol, sell_account_id, ProtoOATradeSide.SELL)
+
+    def submit(self, symbol: SymbolInfo, buy_account_id: int, sell_account_id: int) -> Deferred:
+        """
+        Sends the BUY and SELL market orders in the same reactor turn.
+        Fires with the (buy, sell) execution events acknowledging the orders.
+        """
+        buy = self.template(symbol, buy_account_id, ProtoOATradeSide.BUY)
+        sell = self.template(symbol, sell_account_id, ProtoOATradeSide.SELL)
+        submission = StraddleSubmission(symbol.name)
+
+        submission.buy.sent_ns = time.perf_counter_ns()
+        buy_d = self.buy_client.send_payload(NEW_ORDER_REQ, buy.payload, buy_account_id)
+        submission.sell.sent_ns = time.perf_counter_ns()
+        sell_d = self.sell_client.send_payload(NEW_ORDER_REQ, sell.payload, sell_account_id)
+
+        buy_d.addCallback(self._on_ack, submission.buy)
+        sell_d.addCallback(self._on_ack, submission.sell)
+        d = gatherResults([buy_d, sell_d], consumeErrors=True)
+        d.addCallbacks(tuple, self._on_submit_failed, errbackArgs=(submission,))
+        return d
+
+    def _on_ack(self, event: Any, leg: LegTiming) -> Any:
+        leg.ack_ns = time.perf_counter_ns()
+        self.send_to_ack.record((leg.ack_ns - leg.sent_ns) / 1e9)
+        if event.executionType in _FILL_TYPES:
+            self._on_fill(leg, leg.ack_ns)
+        elif event.executionType not in _END_TYPES and not leg.submission.failed:
+            leg.order_id = event.order.orderId
+            self._awaiting_fill[leg.order_id] = leg
+        return event
+
+    def _on_submit_failed(self, failure, submission: StraddleSubmission):
+        # The straddle is not managed, so the fill times of a leg that went through are not wanted
+        submission.failed = True
+        for leg in (submission.buy, submission.sell):
+            if leg.order_id:
+                self._awaiting_fill.pop(leg.order_id, None)
+        return failure
+
+    def _on_execution_event(self, event: Any) -> None:
+        if not self._awaiting_fill:
+            return
+        if event.executionType in _FILL_TYPES:
+            leg = self._awaiting_fill.pop(event.order.orderId, None)
+            if leg is not None:
+                self._on_fill(leg, time.perf_counter_ns())
+        elif event.executionType in _END_TYPES:
+            self._awaiting_fill.pop(event.order.orderId, None)
+
+    def _on_fill(self, leg: LegTiming, fill_ns: int) -> None:
+        if leg.fill_ns:
+            return
+        leg.fill_ns = fill_ns
+        self.send_to_fill.record((fill_ns - leg.sent_ns) / 1e9)
+        self.ack_to_fill.record((fill_ns - leg.ack_ns) / 1e9)
+
+        submission = leg.submission
+        if submission.buy.fill_ns and submission.sell.fill_ns:
+            skew_ms = abs(submission.buy.fill_ns - submission.sell.fill_ns) / 1e6
+            self.fill_skew.record(skew_ms / 1e3)
+            logging.info(f"Straddle on {submission.symbol} filled with {skew_ms:.2f} ms skew between legs.")
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {
+            "send_to_ack_ms": self.send_to_ack.summary(),
+            "ack_to_fill_ms": self.ack_to_fill.summary(),
+            "send_to_fill_ms": self.send_to_fill.summary(),
+            "fill_skew_ms": self.fill_skew.summary(),
+        }
@@ -0,0 +1,227 @@
+import logging
+from typing import Dict, Optional
+
+from pepper_bot.core import metrics
+from pepper_bot.ctrader.client import CTraderApiClient, CTraderApiError
+from pepper_bot.ctrader.ticks import TickRing, PRICE_SCALE
+from ctrader_open_api.messages.OpenApiMessages_pb2 import ProtoOAAmendPositionSLTPReq
+from ctrader_open_api.messages.OpenApiModelMessages_pb2 import ProtoOAPayloadType
+
+AMEND_REQ = ProtoOAPayloadType.PROTO_OA_AMEND_POSITION_SLTP_REQ
+
+# Price distance of one point when no symbol details are known (5 digit FX quotes)
+DEFAULT_POINT_SIZE = 1 / PRICE_SCALE
+DEFAULT_DIGITS = 5
+
+# Amend errors meaning the position is gone; it is no longer trailed
+CLOSED_POSITION_ERRORS = frozenset({"POSITION_NOT_FOUND", "POSITION_NOT_OPEN"})
+
+# Amends rejected by the broker for other reasons (e.g. TRADING_BAD_STOPS) are retried with
+# exponential backoff from min_interval up to this delay, at most MAX_AMEND_REJECTIONS times in a row
+MAX_REJECTED_RETRY_SECONDS = 30.0
+MAX_AMEND_REJECTIONS = 5
+
+
+class TrailingPosition:
+    """Trailing state of a single position."""
+    __slots__ = ("account_id", "position_id", "symbol_id", "is_buy", "distance", "min_step", "digits",
+                 "stop", "pending_stop", "in_flight", "last_sent_at", "retry_call", "rejections", "request")
+
+    def __init__(self, account_id: int, position_id: int, symbol_id: int, is_buy: bool,
+                 distance: float, min_step: float, stop: float, digits: int):
+        self.account_id = account_id
+        self.position_id = position_id
+        self.symbol_id = symbol_id
+        self.is_buy = is_buy
+        self.distance = distance
+        self.min_step = min_step
+        self.digits = digits
+        self.stop = stop  # Last stop level confirmed by the broker
+        self.pending_stop: Optional[float] = None  # Best level not yet sent
+        self.in_flight = False
+        self.last_sent_at = 0.0
+        self.retry_call = None
+        self.rejections = 0  # Consecutive amends rejected by the broker
+        # Only the stop loss changes between amends
+        self.request = ProtoOAAmendPositionSLTPReq(ctidTraderAccountId=account_id, positionId=position_id)
+
+    def improves(self, level: float, reference: float) -> bool:
+        """True if level is at least min_step better than reference."""
+        if self.is_buy:
+            return level - reference >= self.min_step
+        return reference - level >= self.min_step
+
+
+class TrailingStopEngine:
+    """
+    Trails stop losses locally from the spot stream.
+    Each tick moves the desired stop of the positions on that symbol; amend requests
+    are coalesced so that at most one is in flight per position, a new one is only
+    sent when the stop moves by at least min_step, and sends per position are spaced
+    at least min_interval seconds apart.
+    """
+
+    def __init__(self, client: CTraderApiClient, min_interval: float = 0.25, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.client = client
+        self.min_interval = min_interval
+        self.clock = clock
+        self._positions: Dict[int, TrailingPosition] = {}
+        self._by_symbol: Dict[int, Dict[int, TrailingPosition]] = {}
+        self.amends_sent = 0
+        self.amends_failed = 0
+        self.amend_latency = metrics.histogram("trailing_amend_seconds", "Stop loss amend sent to confirmed")
+        self._amend_failures = metrics.counter("trailing_amends_failed_total", "Stop loss amends that failed")
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def get(self, position_id: int) -> Optional[TrailingPosition]:
+        return self._positions.get(position_id)
+
+    def track(self, account_id: int, position_id: int, symbol_id: int, is_buy: bool, distance: float,
+              stop: float, min_step: float = DEFAULT_POINT_SIZE, digits: int = DEFAULT_DIGITS,
+              amend: bool = False) -> TrailingPosition:
+        """
+        Starts trailing a position whose stop loss currently sits at `stop`, or which
+        should first be moved to `stop` if amend is True (e.g. to break-even).
+        distance and min_step are price distances. Tracking a position again replaces
+        its trailing state.
+        """
+        previous = self._positions.get(position_id)
+        if previous is not None and previous.retry_call is not None and previous.retry_call.active():
+            previous.retry_call.cancel()
+        position = TrailingPosition(account_id, position_id, symbol_id, is_buy, distance, min_step, stop, digits)
+        if amend:
+            position.stop = float("-inf") if is_buy else float("inf")
+            position.pending_stop = round(stop, digits)
+        self._positions[position_id] = position
+
+        symbol_positions = self._by_symbol.get(symbol_id)
+        if symbol_positions is None:
+            # Includes positions left without ticks by a failed subscription
+            symbol_positions = self._by_symbol[symbol_id] = {
+                other.position_id: other for other in self._positions.values() if other.symbol_id == symbol_id}
+            self.client.ticks.subscribe(self.on_tick, symbol_id)
+            self.client.subscribe_to_ticks(account_id, symbol_id).addErrback(
+                self._on_subscribe_failed, symbol_id, symbol_positions)
+        symbol_positions[position_id] = position
+
+        # Start trailing right away from the last known quote
+        ring = self.client.ticks.latest(symbol_id)
+        if ring is not None:
+            self._update(position, ring)
+        self._flush(position)
+        return position
+
+    def untrack(self, position_id: int) -> None:
+        """Stops trailing a position, e.g. once it has been closed."""
+        position = self._positions.pop(position_id, None)
+        if position is None:
+            return
+        if position.retry_call is not None and position.retry_call.active():
+            position.retry_call.cancel()
+        symbol_positions = self._by_symbol.get(position.symbol_id)
+        if symbol_positions is not None:
+            symbol_positions.pop(position_id, None)
+            if not symbol_positions:
+                del self._by_symbol[position.symbol_id]
+                self.client.ticks.unsubscribe(self.on_tick, position.symbol_id)
+
+    def _on_subscribe_failed(self, failure, symbol_id: int, symbol_positions: Dict[int, TrailingPosition]):
+        logging.error(f"Could not subscribe to the spots of symbol {symbol_id} for trailing: "
+                      f"{failure.getErrorMessage()}")
+        # The next track() on the symbol subscribes again
+        if self._by_symbol.get(symbol_id) is symbol_positions:
+            del self._by_symbol[symbol_id]
+            self.client.ticks.unsubscribe(self.on_tick, symbol_id)
+
+    def on_tick(self, ring: TickRing) -> None:
+        positions = self._by_symbol.get(ring.symbol_id)
+        if positions:
+            for position in positions.values():
+                self._update(position, ring)
+
+    def _update(self, position: TrailingPosition, ring: TickRing) -> None:
+        # A long position is stopped out on the bid, a short one on the ask
+        if position.is_buy:
+            if not ring.bid:
+                return
+            level = round(ring.bid - position.distance, position.digits)
+        else:
+            if not ring.ask:
+                return
+            level = round(ring.ask + position.distance, position.digits)
+
+        reference = position.pending_stop if position.pending_stop is not None else position.stop
+        if not position.improves(level, reference):
+            return
+        position.pending_stop = level
+        self._flush(position)
+
+    def _flush(self, position: TrailingPosition) -> None:
+        """Sends the pending stop unless an amend is in flight or the position is throttled."""
+        if position.in_flight or position.pending_stop is None:
+            return
+        if position.retry_call is not None and position.retry_call.active():
+            return
+
+        wait = position.last_sent_at + self.min_interval - self.clock.seconds()
+        if wait > 0:
+            position.retry_call = self.clock.callLater(wait, self._flush, position)
+            return
+
+        stop = position.pending_stop
+        position.pending_stop = None
+        position.in_flight = True
+        position.last_sent_at = self.clock.seconds()
+        self.amends_sent += 1
+
+        # Sent right away rather than through the library's paced queue, like orders
+        position.request.stopLoss = stop
+        d = self.client.send_payload(AMEND_REQ, position.request.SerializeToString(), position.account_id,
+                                     position_id=position.position_id)
+        d.addCallbacks(self._on_amended, self._on_amend_failed,
+                       callbackArgs=(position, stop), errbackArgs=(position, stop))
+
+    def _on_amended(self, _, position: TrailingPosition, stop: float):
+        self.amend_latency.record(self.clock.seconds() - position.last_sent_at)
+        position.in_flight = False
+        position.rejections = 0
+        position.stop = stop
+        if position.pending_stop is not None and not position.improves(position.pending_stop, stop):
+            position.pending_stop = None
+        if self._positions.get(position.position_id) is position:
+            self._flush(position)
+
+    def _on_amend_failed(self, failure, position: TrailingPosition, stop: float):
+        position.in_flight = False
+        self.amends_failed += 1
+        self._amend_failures.inc()
+        if self._positions.get(position.position_id) is not position:
+            return
+        error = failure.value
+        if isinstance(error, CTraderApiError):
+            if error.error_code in CLOSED_POSITION_ERRORS:
+                logging.info(f"Position {position.position_id} is closed; no longer trailing it.")
+                self.untrack(position.position_id)
+                return
+            position.rejections += 1
+            if position.rejections > MAX_AMEND_REJECTIONS:
+                logging.error(f"Trailing amend of position {position.position_id} rejected "
+                              f"{position.rejections} times in a row ({error}); no longer trailing it.")
+                self.untrack(position.position_id)
+                return
+
+        logging.warning(f"Trailing amend of position {position.position_id} to {stop} failed: "
+                        f"{failure.getErrorMessage()}")
+        # Retry with the best level seen since, or the failed one if the market hasn't moved
+        if position.pending_stop is None and position.improves(stop, position.stop):
+            position.pending_stop = stop
+        if position.rejections:
+            # Rejections back off; timeouts and lost connections retry at the usual pace
+            delay = min(self.min_interval * 2 ** position.rejections, MAX_REJECTED_RETRY_SECONDS)
+            position.retry_call = self.clock.callLater(delay, self._flush, position)
+        else:
+            self._flush(position)